@@ -0,0 +1,483 @@
+"""
+离线基准测试
+
+在本地子进程中启动一个模拟 OpenRouter 的 aiohttp 服务（/api/v1/chat/completions、/v1/chat/completions、
+/v1/images/generations），按指定并发驱动 generate_image_openrouter，统计吞吐量、延迟分位数、
+峰值内存（RSS）和事件循环延迟。模拟服务可以注入延迟分布、429/402、截断的响应体和大尺寸内联 base64 图像。
+
+需要在安装了 AstrBot 的环境中运行（插件模块依赖 astrbot.api），不需要真实的 API 密钥和网络。
+
+用法:
+    python bench/bench_generate.py --requests 200 --concurrency 16 --image-mb 5
+    python bench/bench_generate.py --latency lognormal:1.0,0.4 --rate-limit-burst 20 --truncate-prob 0.05
+    python bench/bench_generate.py --json bench_output.json                 # 保存结果
+    python bench/bench_generate.py --compare bench_output.json              # 与之前的结果对比
+
+相同参数（包括 --seed）下的结果可以在不同提交之间对比，结果中会记录当前的 git 提交。
+"""
+
+import argparse
+import asyncio
+import base64
+import importlib
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+from pathlib import Path
+
+PLUGIN_ROOT = Path(__file__).resolve().parent.parent
+PLUGIN_PACKAGE = "gemini_image_plugin_bench"
+
+
+# ---------------------------------------------------------------------------
+# 模拟服务（在子进程中运行，避免服务端的编码开销计入被测进程）
+# ---------------------------------------------------------------------------
+
+def _sample_latency(spec, rng):
+    """
+    按延迟分布描述采样一个延迟（秒）
+
+    支持: fixed:<秒>、uniform:<最小>,<最大>、lognormal:<中位数>,<sigma>、
+    bimodal:<快>,<慢>,<慢请求比例>
+    """
+    kind, _, params = spec.partition(":")
+    values = [float(v) for v in params.split(",") if v]
+    if kind == "fixed":
+        return values[0]
+    if kind == "uniform":
+        return rng.uniform(values[0], values[1])
+    if kind == "lognormal":
+        return rng.lognormvariate(0, values[1]) * values[0]
+    if kind == "bimodal":
+        return values[1] if rng.random() < values[2] else values[0]
+    raise ValueError(f"无法识别的延迟分布: {spec}")
+
+
+def _make_png(size, rng):
+    """生成大约 size 字节的 PNG；安装了 Pillow 时生成可解码的真实图像，以便测试输出转码"""
+    try:
+        from PIL import Image
+    except ImportError:
+        return b"\x89PNG\r\n\x1a\n" + rng.randbytes(max(0, size - 8))
+    import io
+    side = max(16, int((size / 3) ** 0.5))
+    image = Image.frombytes("RGB", (side, side), rng.randbytes(side * side * 3))
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", compress_level=1)
+    return buffer.getvalue()
+
+
+def _make_input_images(count, size_mb):
+    """生成 count 张约 size_mb MB 的 base64 参考图片（PNG 文件头加随机数据）"""
+    rng = random.Random(0)
+    size = int(size_mb * 1024 * 1024 * 3 / 4)
+    return [
+        base64.b64encode(b"\x89PNG\r\n\x1a\n" + rng.randbytes(max(0, size - 8))).decode("ascii")
+        for _ in range(count)
+    ]
+
+
+def _run_mock_server(port, options, ready):
+    asyncio.run(_serve_mock(port, options, ready))
+
+
+async def _serve_mock(port, options, ready):
+    from aiohttp import web
+
+    rng = random.Random(options["seed"])
+    decoded_size = int(options["image_mb"] * 1024 * 1024 * 3 / 4)
+    image_bytes = _make_png(decoded_size, rng)
+    image_b64 = base64.b64encode(image_bytes)
+    chat_body = (
+        b'{"id":"bench","choices":[{"index":0,"message":{"role":"assistant","content":"here you go",'
+        b'"images":[{"type":"image_url","image_url":{"url":"data:image/png;base64,'
+        + image_b64
+        + b'"}}]},"finish_reason":"stop"}],"usage":{"prompt_tokens":10,"completion_tokens":1290}}'
+    )
+    # 流式响应：保活注释、文本增量、图像增量、结束事件
+    sse_body = (
+        b": OPENROUTER PROCESSING\n\n"
+        b'data: {"id":"bench","choices":[{"index":0,"delta":{"role":"assistant","content":"here you go"}}]}\n\n'
+        b'data: {"id":"bench","choices":[{"index":0,"delta":{"images":[{"type":"image_url","image_url":{"url":"data:image/png;base64,'
+        + image_b64
+        + b'"}}]}}]}\n\n'
+        b'data: {"id":"bench","choices":[{"index":0,"delta":{},"finish_reason":"stop"}],"usage":{"prompt_tokens":10,"completion_tokens":1290}}\n\n'
+        b"data: [DONE]\n\n"
+    )
+    exhausted_keys = {f"bench-key-{i}" for i in range(1, options["exhausted_keys"] + 1)}
+    state = {"requests": 0}
+
+    def error(status, message, headers=None):
+        return web.json_response({"error": {"code": status, "message": message}}, status=status, headers=headers)
+
+    async def admit(request):
+        """按注入规则决定是否直接返回错误，返回 None 表示正常处理"""
+        state["requests"] += 1
+        key = request.headers.get("Authorization", "").removeprefix("Bearer ")
+        if key in exhausted_keys:
+            return error(402, "Insufficient credits")
+        if state["requests"] <= options["rate_limit_burst"] or rng.random() < options["rate_limit_prob"]:
+            return error(429, "Rate limit exceeded", {"Retry-After": str(options["retry_after"])})
+        await asyncio.sleep(_sample_latency(options["latency"], rng))
+        if rng.random() < options["error_prob"]:
+            return error(500, "Internal error")
+        return None
+
+    async def chat(request):
+        stream = bool((await request.json()).get("stream"))
+        rejected = await admit(request)
+        if rejected is not None:
+            return rejected
+        content_type = "text/event-stream" if stream else "application/json"
+        stall = rng.random() < options["stall_prob"]
+        if stall and not stream:
+            # 上游卡住：迟迟不返回响应头
+            await asyncio.sleep(3600)
+        response = web.StreamResponse(headers={"Content-Type": content_type})
+        await response.prepare(request)
+        if stall:
+            # 上游卡住：只发送保活注释，不再有数据
+            try:
+                while True:
+                    await response.write(b": OPENROUTER PROCESSING\n\n")
+                    await asyncio.sleep(1)
+            except ConnectionError:
+                return response
+        body = sse_body if stream else chat_body
+        truncate = rng.random() < options["truncate_prob"]
+        end = len(body) // 2 if truncate else len(body)
+        for offset in range(0, end, 256 * 1024):
+            await response.write(body[offset:min(offset + 256 * 1024, end)])
+        if truncate:
+            # 在图像数据中途断开连接
+            request.transport.close()
+            return response
+        await response.write_eof()
+        return response
+
+    async def images(request):
+        await request.read()
+        rejected = await admit(request)
+        if rejected is not None:
+            return rejected
+        return web.json_response({"created": 0, "data": [{"url": f"http://127.0.0.1:{port}/files/image.png"}]})
+
+    async def image_file(request):
+        return web.Response(body=image_bytes, content_type="image/png")
+
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app.router.add_post("/api/v1/chat/completions", chat)
+    app.router.add_post("/v1/chat/completions", chat)
+    app.router.add_post("/v1/images/generations", images)
+    app.router.add_get("/files/image.png", image_file)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    ready.set()
+    await asyncio.Event().wait()
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# ---------------------------------------------------------------------------
+# 被测客户端
+# ---------------------------------------------------------------------------
+
+def _load_plugin_modules():
+    """以独立包名导入插件目录，使插件内的相对导入可以正常工作"""
+    package = types.ModuleType(PLUGIN_PACKAGE)
+    package.__path__ = [str(PLUGIN_ROOT)]
+    sys.modules[PLUGIN_PACKAGE] = package
+
+    def load(name):
+        return importlib.import_module(f"{PLUGIN_PACKAGE}.utils.{name}")
+
+    return types.SimpleNamespace(
+        ttp=load("ttp"),
+        http_pool=load("http_pool"),
+        workers=load("workers"),
+        metrics=load("metrics"),
+        key_scheduler=load("key_scheduler"),
+        hedging=load("hedging"),
+        result_cache=load("result_cache"),
+        janitor=load("janitor"),
+        image_codec=load("image_codec"),
+        sse_stream=load("sse_stream"),
+        retry_policy=load("retry_policy"),
+    )
+
+
+def _percentile(values, percent):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+
+def _rss_mb():
+    """当前进程的峰值 RSS（MB）"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 以 KB 为单位，macOS 以字节为单位
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def _git_revision():
+    try:
+        revision = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=PLUGIN_ROOT, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"], cwd=PLUGIN_ROOT, capture_output=True, text=True,
+        ).stdout.strip()
+        return f"{revision}-dirty" if dirty else revision
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def _drive(modules, args, api_base, images_dir):
+    ttp = modules.ttp
+    # 生成的图像保存到临时目录，图像清理器也只扫描该目录，不会删除插件 images 目录中的文件
+    modules.janitor.configure_image_janitor(images_dir=images_dir)
+    api_keys = [f"bench-key-{i}" for i in range(1, args.keys + 1)]
+    modules.key_scheduler.configure_key_scheduler(
+        rate_limit_cooldown=args.rate_limit_cooldown, exhausted_cooldown=3600,
+    )
+    modules.hedging.configure_hedging(enabled=args.hedge)
+    modules.sse_stream.configure_streaming(
+        enabled=args.stream, first_token_timeout=args.first_token_timeout, idle_timeout=args.idle_timeout,
+    )
+    modules.retry_policy.configure_retry_policy(
+        base_delay=args.retry_delay, max_delay=max(args.retry_delay, 10.0), budget_ratio=args.retry_budget / 100,
+    )
+    modules.result_cache.configure_result_cache(enabled=False)
+    modules.image_codec.configure_output_transcoder(output_format=args.output_format, quality=args.output_quality)
+
+    latencies = []
+    outcomes = {"success": 0, "failed": 0, "timeout": 0}
+    saved_paths = []
+    next_index = iter(range(args.requests))
+    run_id = f"{time.time_ns()}"
+    input_images = _make_input_images(args.input_images, args.input_mb)
+
+    async def one_request(i):
+        # 每个请求使用不同的提示词，避免被合并或命中缓存
+        prompt = f"benchmark {run_id} #{i}"
+        start = time.perf_counter()
+        try:
+            if args.in_memory:
+                image = await ttp.generate_openrouter_image(
+                    prompt, api_keys, model=args.model, api_base=api_base, max_retry_attempts=args.retries,
+                    input_images=input_images, timeout=args.timeout,
+                )
+                outcome = "success" if image is not None else "failed"
+            else:
+                _, image_path = await ttp.generate_image_openrouter(
+                    prompt, api_keys, model=args.model, api_base=api_base, max_retry_attempts=args.retries,
+                    input_images=input_images, timeout=args.timeout,
+                )
+                outcome = "success" if image_path else "failed"
+                if image_path:
+                    saved_paths.append(image_path)
+        except TimeoutError:
+            outcome = "timeout"
+        latencies.append(time.perf_counter() - start)
+        outcomes[outcome] += 1
+
+    async def worker():
+        for i in next_index:
+            await one_request(i)
+
+    rss_before = _rss_mb()
+    if args.trace_alloc:
+        tracemalloc.start()
+    async with modules.workers.LoopLagProbe() as probe:
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        cpu = time.process_time() - cpu_start
+        wall = time.perf_counter() - wall_start
+    alloc_peak = None
+    if args.trace_alloc:
+        alloc_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    await modules.janitor.stop_image_janitor()
+    await modules.http_pool.close_http_session()
+    modules.workers.shutdown_workers()
+    for path in saved_paths:
+        Path(path).unlink(missing_ok=True)
+
+    metrics = modules.metrics.get_metrics()
+    stages = {
+        stage if group is None else f"{stage}[{group}]": {
+            "count": histogram.count,
+            "p50": round(histogram.percentile(50), 4),
+            "p95": round(histogram.percentile(95), 4),
+        }
+        for stage, group, histogram in metrics.summary()
+    }
+    return {
+        "requests": args.requests,
+        "succeeded": outcomes["success"],
+        "failed": outcomes["failed"],
+        "timed_out": outcomes["timeout"],
+        "wall_seconds": round(wall, 3),
+        "cpu_seconds": round(cpu, 3),
+        "throughput_rps": round(args.requests / wall, 3) if wall else 0.0,
+        "latency_p50": round(_percentile(latencies, 50), 4),
+        "latency_p95": round(_percentile(latencies, 95), 4),
+        "latency_p99": round(_percentile(latencies, 99), 4),
+        "latency_max": round(max(latencies, default=0.0), 4),
+        "loop_lag_max_ms": round(probe.max_lag * 1000, 2),
+        "loop_lag_p99_ms": round(probe.percentile(99) * 1000, 2),
+        "rss_before_mb": round(rss_before, 1),
+        "peak_rss_mb": round(_rss_mb(), 1),
+        "alloc_peak_mb": round(alloc_peak / 1024 / 1024, 1) if alloc_peak is not None else None,
+        "transcode_saved_mb": round(metrics.counter_total("transcode_saved_bytes") / 1024 / 1024, 2),
+        "stages": stages,
+    }
+
+
+# ---------------------------------------------------------------------------
+# 报告
+# ---------------------------------------------------------------------------
+
+# 对比时数值越小越好的指标
+_LOWER_IS_BETTER = (
+    "latency_p50", "latency_p95", "latency_p99", "latency_max",
+    "loop_lag_max_ms", "loop_lag_p99_ms", "peak_rss_mb", "alloc_peak_mb", "failed", "wall_seconds", "cpu_seconds",
+)
+_HIGHER_IS_BETTER = ("throughput_rps", "succeeded")
+
+
+def _print_report(report):
+    results = report["results"]
+    print(f"提交: {report['revision']}  Python {report['python']}")
+    print(f"场景: {json.dumps(report['scenario'], ensure_ascii=False)}")
+    print(f"请求: {results['requests']}（成功 {results['succeeded']}，失败 {results['failed']}，超时 {results.get('timed_out', 0)}），"
+          f"耗时 {results['wall_seconds']} 秒，吞吐量 {results['throughput_rps']} 请求/秒")
+    print(f"延迟: p50={results['latency_p50']}s p95={results['latency_p95']}s "
+          f"p99={results['latency_p99']}s max={results['latency_max']}s")
+    print(f"事件循环延迟: max={results['loop_lag_max_ms']}ms p99={results['loop_lag_p99_ms']}ms")
+    print(f"CPU 时间: {results.get('cpu_seconds')} 秒")
+    print(f"峰值 RSS: {results['peak_rss_mb']} MB（开始前 {results['rss_before_mb']} MB）")
+    if results.get("alloc_peak_mb") is not None:
+        print(f"Python 内存分配峰值: {results['alloc_peak_mb']} MB")
+    if results.get("transcode_saved_mb"):
+        print(f"输出转码节省: {results['transcode_saved_mb']} MB")
+    print("各阶段耗时:")
+    for stage, values in results["stages"].items():
+        print(f"  {stage}: n={values['count']} p50={values['p50']}s p95={values['p95']}s")
+
+
+def _print_comparison(baseline, report):
+    if baseline.get("scenario") != report["scenario"]:
+        print("警告: 基准结果的测试场景与本次不同，对比结果可能没有意义")
+    print(f"与 {baseline.get('revision')} 对比:")
+    for key in _HIGHER_IS_BETTER + _LOWER_IS_BETTER:
+        old = baseline["results"].get(key)
+        new = report["results"].get(key)
+        if old is None or new is None:
+            continue
+        delta = (new - old) / old * 100 if old else 0.0
+        better = (delta > 0) if key in _HIGHER_IS_BETTER else (delta < 0)
+        mark = "" if abs(delta) < 1 else (" ✓" if better else " ✗")
+        print(f"  {key}: {old} -> {new} ({delta:+.1f}%){mark}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="图像生成离线基准测试")
+    parser.add_argument("--requests", type=int, default=100, help="总请求数")
+    parser.add_argument("--concurrency", type=int, default=8, help="并发请求数")
+    parser.add_argument("--keys", type=int, default=3, help="API 密钥数量")
+    parser.add_argument("--retries", type=int, default=3, help="每个密钥的最大重试次数")
+    parser.add_argument("--model", default="google/gemini-2.5-flash-image-preview:free",
+                        help="模型名称，包含 nano-banana 时走 /v1/images/generations")
+    parser.add_argument("--image-mb", type=float, default=5.0, help="内联 base64 图像的大小（MB）")
+    parser.add_argument("--latency", default="lognormal:0.5,0.3",
+                        help="上游延迟分布: fixed:s / uniform:a,b / lognormal:median,sigma / bimodal:fast,slow,ratio")
+    parser.add_argument("--rate-limit-burst", type=int, default=0, help="最开始的 N 个请求返回 429")
+    parser.add_argument("--rate-limit-prob", type=float, default=0.0, help="随机返回 429 的概率")
+    parser.add_argument("--retry-after", type=float, default=1, help="429 响应的 Retry-After（秒）")
+    parser.add_argument("--rate-limit-cooldown", type=float, default=1, help="密钥被限流后的默认冷却时间（秒）")
+    parser.add_argument("--exhausted-keys", type=int, default=0, help="前 N 个密钥返回 402 额度耗尽")
+    parser.add_argument("--error-prob", type=float, default=0.0, help="随机返回 500 的概率")
+    parser.add_argument("--truncate-prob", type=float, default=0.0, help="响应体在图像数据中途断开的概率")
+    parser.add_argument("--stall-prob", type=float, default=0.0, help="上游卡住不返回数据的概率")
+    parser.add_argument("--stream", action="store_true", help="使用 SSE 流式生成模式")
+    parser.add_argument("--first-token-timeout", type=float, default=30, help="流式模式首个数据块超时（秒）")
+    parser.add_argument("--idle-timeout", type=float, default=20, help="流式模式数据间隔超时（秒）")
+    parser.add_argument("--input-images", type=int, default=0, help="每个请求携带的参考图片数量")
+    parser.add_argument("--input-mb", type=float, default=1.0, help="每张参考图片 base64 的大小（MB）")
+    parser.add_argument("--retry-delay", type=float, default=1.0, help="重试最小间隔（秒）")
+    parser.add_argument("--retry-budget", type=float, default=20, help="重试预算比例（%%）")
+    parser.add_argument("--trace-alloc", action="store_true", help="使用 tracemalloc 统计 Python 内存分配峰值（会明显变慢）")
+    parser.add_argument("--timeout", type=float, default=0, help="单次请求的时间预算（秒），0表示不限制")
+    parser.add_argument("--hedge", action="store_true", help="启用对冲请求")
+    parser.add_argument("--in-memory", action="store_true", help="使用内存发送模式，不写入 images 文件夹")
+    parser.add_argument("--output-format", default="off", choices=["off", "jpeg", "webp"], help="生成图像的输出转码格式")
+    parser.add_argument("--output-quality", type=int, default=90, help="输出转码质量")
+    parser.add_argument("--seed", type=int, default=1, help="随机种子")
+    parser.add_argument("--json", help="将结果保存为 JSON 文件")
+    parser.add_argument("--compare", help="与之前保存的 JSON 结果对比")
+    args = parser.parse_args()
+
+    scenario = {
+        key: getattr(args, key)
+        for key in (
+            "requests", "concurrency", "keys", "retries", "model", "image_mb", "latency", "rate_limit_burst",
+            "rate_limit_prob", "retry_after", "rate_limit_cooldown", "exhausted_keys", "error_prob",
+            "truncate_prob", "input_images", "input_mb", "retry_delay", "retry_budget", "stall_prob", "stream", "first_token_timeout", "idle_timeout", "timeout", "hedge", "in_memory", "output_format", "output_quality", "seed",
+        )
+    }
+
+    port = _free_port()
+    ready = multiprocessing.get_context("spawn").Event()
+    server = multiprocessing.get_context("spawn").Process(
+        target=_run_mock_server, args=(port, scenario, ready), daemon=True,
+    )
+    server.start()
+    try:
+        if not ready.wait(60):
+            raise RuntimeError("模拟服务启动超时")
+        modules = _load_plugin_modules()
+        with tempfile.TemporaryDirectory(prefix="bench_images_") as images_dir:
+            results = asyncio.run(_drive(modules, args, f"http://127.0.0.1:{port}", Path(images_dir)))
+    finally:
+        server.terminate()
+        server.join()
+
+    report = {
+        "revision": _git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "scenario": scenario,
+        "results": results,
+    }
+    _print_report(report)
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            _print_comparison(json.load(f), report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"结果已保存到 {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+事件循环延迟检查
+
+并发解码多张大尺寸 base64 图像（整段解码保存，以及按块增量解码的流式响应），同时用 LoopLagProbe 测量事件循环延迟，
+最大延迟超过阈值时以非0状态码退出，可用于验证解码和写盘没有在事件循环线程中执行。
+
+需要在安装了 AstrBot 的环境中运行（插件模块依赖 astrbot.api），不需要 API 密钥和网络。
+
+用法:
+    python bench/check_loop_lag.py
+    python bench/check_loop_lag.py --image-mb 8 --concurrency 8 --max-lag-ms 30
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import random
+import sys
+import tempfile
+from pathlib import Path
+
+from bench_generate import _load_plugin_modules, _make_png
+
+
+class _FakeContent:
+    """模拟 aiohttp 响应体，按块返回预先生成的字节"""
+
+    def __init__(self, body):
+        self._body = body
+
+    async def iter_chunked(self, size):
+        for start in range(0, len(self._body), size):
+            yield self._body[start:start + size]
+            # 让出事件循环，模拟等待网络数据
+            await asyncio.sleep(0)
+
+
+class _FakeResponse:
+    def __init__(self, body):
+        self.content = _FakeContent(body)
+
+
+async def _check(modules, args):
+    ttp = modules.ttp
+    rng = random.Random(args.seed)
+    image = _make_png(int(args.image_mb * 1024 * 1024), rng)
+    image_base64 = base64.b64encode(image).decode()
+    body = json.dumps({
+        "choices": [{"message": {"content": "", "images": [
+            {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image_base64}"}}
+        ]}}]
+    }).encode()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        data_dir = Path(data_dir)
+        # 图像清理器只扫描临时目录，不会删除插件 images 目录中的文件
+        modules.janitor.configure_image_janitor(images_dir=data_dir / "images")
+        try:
+            async with modules.workers.LoopLagProbe() as probe:
+                results = await asyncio.gather(
+                    *(ttp.save_base64_image(image_base64, data_dir=data_dir) for _ in range(args.concurrency)),
+                    *(ttp._stream_image_response(_FakeResponse(body), data_dir=data_dir) for _ in range(args.concurrency)),
+                )
+        finally:
+            # 临时目录删除前先停止清理器
+            await modules.janitor.stop_image_janitor()
+        saved = sum(1 for result in results[:args.concurrency] if result)
+        streamed = sum(1 for result in results[args.concurrency:] if result[0] is not None)
+    return probe, saved, streamed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="检查解码大图时的事件循环延迟")
+    parser.add_argument("--image-mb", type=float, default=4.5, help="图像大小（MB），base64 后约为 1.33 倍")
+    parser.add_argument("--concurrency", type=int, default=4, help="两种解码方式各自的并发数")
+    parser.add_argument("--max-lag-ms", type=float, default=50, help="允许的最大事件循环延迟（毫秒）")
+    parser.add_argument("--seed", type=int, default=1, help="随机种子")
+    args = parser.parse_args()
+
+    modules = _load_plugin_modules()
+    probe, saved, streamed = asyncio.run(_check(modules, args))
+    max_lag_ms = probe.max_lag * 1000
+    print(f"解码完成: 整段解码 {saved}/{args.concurrency}，流式解码 {streamed}/{args.concurrency}")
+    print(f"事件循环延迟: p50={probe.percentile(50) * 1000:.1f}ms p99={probe.percentile(99) * 1000:.1f}ms "
+          f"max={max_lag_ms:.1f}ms（阈值 {args.max_lag_ms:.0f}ms）")
+
+    failures = []
+    if saved != args.concurrency or streamed != args.concurrency:
+        failures.append("部分图像解码失败")
+    if max_lag_ms > args.max_lag_ms:
+        failures.append(f"事件循环最大延迟 {max_lag_ms:.1f}ms 超过阈值 {args.max_lag_ms:.0f}ms，解码或写盘可能阻塞了事件循环")
+    for failure in failures:
+        print(f"失败: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,28 @@
-from astrbot.api.event import filter, AstrMessageEvent, MessageEventResult
-from astrbot.api.star import Context, Star, register
+import asyncio
+import re
+import time
+from astrbot.api.event import filter, AstrMessageEvent, MessageEventResult, MessageChain
+from astrbot.api.star import Context, Star, register, StarTools
 from astrbot.api import logger, sp
 from astrbot.api.all import *
-from astrbot.core.message.components import Reply
-from .utils.ttp import generate_image_openrouter
-from .utils.file_send_server import send_file
+from astrbot.api.message_components import Node, Nodes
+from .utils.ttp import generate_openrouter_image, cancel_inflight_requests, GeneratedImage
+from .utils.deadline import DeadlineExceededError
+from .utils.file_send_server import send_file, configure_file_channels, close_file_channels
+from .utils.http_pool import configure_http_pool, close_http_session
+from .utils.key_scheduler import configure_key_scheduler, get_key_scheduler
+from .utils.key_ledger import configure_key_ledger, get_key_ledger
+from .utils.hedging import configure_hedging
+from .utils.sse_stream import configure_streaming
+from .utils.retry_policy import configure_retry_policy
+from .utils.endpoint_router import configure_endpoint_router, get_endpoint_router
+from .utils.result_cache import configure_result_cache, get_result_cache
+from .utils.image_codec import prepare_reference_images, configure_output_transcoder
+from .utils.reference_images import collect_reference_images
+from .utils.workers import configure_workers, shutdown_workers
+from .utils.janitor import configure_image_janitor, stop_image_janitor
+from .utils.generation_queue import configure_generation_queue, get_generation_queue, QueueFullError
+from .utils.metrics import get_metrics, start_metrics_server, stop_metrics_server, STAGE_NAMES
 
 
 @register("gemini-25-image-openrouter", "喵喵", "使用openrouter的免费api生成图片", "1.8.1")
@@ -26,18 +44,224 @@ class MyPlugin(Star):
 
         # 重试配置
         self.max_retry_attempts = config.get("max_retry_attempts", 3)
+        # 单次绘图请求在所有密钥和重试之间共享的时间预算（秒），0表示不限制
+        self.request_timeout = config.get("request_timeout", 180)
+
+        # 参考图片预处理配置
+        self.ref_image_max_edge = config.get("ref_image_max_edge", 1536)
+        self.ref_image_quality = config.get("ref_image_quality", 85)
+        self.ref_image_format = config.get("ref_image_format", "jpeg")
+        self.ref_image_fetch_concurrency = config.get("ref_image_fetch_concurrency", 4)
+        self.ref_image_fetch_timeout = config.get("ref_image_fetch_timeout", 20)
+
+        # 生成的图像直接从内存发送，只在需要文件时才写入images文件夹
+        self.in_memory_delivery = config.get("in_memory_delivery", True)
+
+        # 批量生成配置
+        self.batch_max_count = max(1, config.get("batch_max_count", 4))
+        self.batch_forward = config.get("batch_forward", True)
+
+        # LLM 工具异步模式：立即返回确认，生成完成后主动推送结果
+        self.async_tool_mode = config.get("async_tool_mode", False)
+        # 后台运行中的生成任务
+        self._jobs = set()
 
         self.nap_server_address = config.get("nap_server_address")
         self.nap_server_port = config.get("nap_server_port")
 
+        # 密钥调度器冷却配置
+        configure_key_scheduler(
+            rate_limit_cooldown=config.get("key_rate_limit_cooldown", 60),
+            exhausted_cooldown=config.get("key_exhausted_cooldown", 3600),
+            invalid_cooldown=config.get("key_invalid_cooldown", 600),
+        )
+
+        # 跨进程、跨重启共享的密钥账本
+        configure_key_ledger(
+            enabled=config.get("key_ledger_enabled", True),
+            path=config.get("key_ledger_path", "").strip()
+            or StarTools.get_data_dir("gemini-25-image-openrouter") / "key_ledger.db",
+        )
+
+        # 额外的API端点，与 custom_api_base 一起按延迟和错误率路由
+        configure_endpoint_router(endpoints=config.get("api_endpoints", []))
+
+        # 重试间隔、重试预算和熔断配置
+        configure_retry_policy(
+            base_delay=config.get("retry_base_delay", 1.0),
+            max_delay=config.get("retry_max_delay", 10.0),
+            budget_ratio=config.get("retry_budget_ratio", 20) / 100,
+            failure_threshold=config.get("circuit_failure_threshold", 10),
+            open_seconds=config.get("circuit_open_seconds", 30),
+        )
+
+        # 流式生成模式及其分阶段超时
+        configure_streaming(
+            enabled=config.get("stream_mode", False),
+            connect_timeout=config.get("stream_connect_timeout", 10.0),
+            first_token_timeout=config.get("stream_first_token_timeout", 30.0),
+            idle_timeout=config.get("stream_idle_timeout", 20.0),
+        )
+
+        # 对冲请求配置
+        configure_hedging(
+            enabled=config.get("hedge_enabled", False),
+            percentile=config.get("hedge_percentile", 90),
+            max_ratio=config.get("hedge_max_ratio", 10) / 100,
+            min_delay=config.get("hedge_min_delay", 3),
+        )
+
+        # 生成结果缓存配置
+        configure_result_cache(
+            enabled=config.get("cache_enabled", True),
+            max_bytes=config.get("cache_max_mb", 200) * 1024 * 1024,
+            ttl=config.get("cache_ttl_hours", 6) * 3600,
+            cache_dir=StarTools.get_data_dir("gemini-25-image-openrouter") / "result_cache",
+        )
+
+        # 图像文件后台清理配置
+        configure_image_janitor(
+            ttl=config.get("image_ttl_minutes", 15) * 60,
+            max_bytes=config.get("image_dir_max_mb", 500) * 1024 * 1024,
+        )
+
+        # 绘图请求排队配置
+        configure_generation_queue(
+            max_concurrency=config.get("queue_max_concurrency", 2),
+            max_queue=config.get("queue_max_size", 20),
+            max_per_user=config.get("queue_max_per_user", 3),
+            weights=self._parse_session_weights(config.get("queue_session_weights", [])),
+        )
+
+        # 后台线程池配置（base64解码、图片编解码等）
+        configure_workers(
+            max_workers=config.get("worker_threads", 4),
+            process_workers=config.get("process_workers", 2),
+        )
+
+        # 生成图片的输出转码配置
+        configure_output_transcoder(
+            output_format=config.get("output_format", "off"),
+            quality=config.get("output_quality", 90),
+            max_edge=config.get("output_max_edge", 0),
+        )
+
+        # 共享HTTP连接池配置
+        configure_http_pool(
+            limit_per_host=config.get("http_pool_limit_per_host", 8),
+            keepalive_timeout=config.get("http_keepalive_timeout", 60),
+            dns_cache_ttl=config.get("http_dns_cache_ttl", 300),
+        )
+
+        # 远程文件传输连接池配置
+        configure_file_channels(
+            max_connections=config.get("nap_max_connections", 2),
+            protocol=config.get("nap_protocol", "v1"),
+        )
+
+        # Prometheus 指标端点配置，端口为0时不启动；在 _load_global_config 中启动（需要运行中的事件循环）
+        self.metrics_host = config.get("metrics_host", "127.0.0.1")
+        self.metrics_port = config.get("metrics_port", 0)
+
         # 标记是否已经加载过全局配置
         self._global_config_loaded = False
 
+    @staticmethod
+    def _parse_session_weights(items):
+        """解析“会话ID:权重”格式的会话权重配置"""
+        weights = {}
+        for item in items or []:
+            session, sep, weight = str(item).rpartition(":")
+            try:
+                if sep and session:
+                    weights[session.strip()] = float(weight)
+                    continue
+            except ValueError:
+                pass
+            logger.warning(f"忽略格式错误的会话权重配置: {item}")
+        return weights
+
+    def _enter_queue(self, event: AstrMessageEvent):
+        """
+        将绘图请求加入排队队列
+
+        Returns:
+            tuple: (ticket, notice)，notice 为需要排队时提示用户的文字，可立即执行时为 None
+
+        Raises:
+            QueueFullError: 队列已满
+        """
+        queue = get_generation_queue()
+        ticket = queue.enter(event.unified_msg_origin, event.get_sender_id())
+        notice = None
+        if ticket.position:
+            notice = f"🕒 当前绘图请求较多，您排在第 {ticket.position} 位，轮到后将自动开始生成"
+        return ticket, notice
+
+    def _enter_batch_queue(self, event: AstrMessageEvent, count: int):
+        """
+        将批量绘图请求加入排队队列，每张图片占一个执行名额，整批计为一个用户请求
+
+        Returns:
+            tuple: (tickets, notice)，notice 为需要排队时提示用户的文字，可立即执行时为 None
+
+        Raises:
+            QueueFullError: 队列已满
+        """
+        queue = get_generation_queue()
+        tickets = queue.enter_batch(event.unified_msg_origin, event.get_sender_id(), count)
+        waiting = sum(1 for ticket in tickets if ticket.position)
+        notice = None
+        if waiting:
+            notice = f"🕒 当前绘图请求较多，{count} 张图片中有 {waiting} 张需要排队，轮到后将自动开始生成"
+        return tickets, notice
+
+    def _batch_count(self, count) -> int:
+        """将请求的图片数量限制在 1 到 batch_max_count 之间"""
+        try:
+            count = int(count)
+        except (TypeError, ValueError):
+            return 1
+        if count > self.batch_max_count:
+            logger.info(f"请求生成 {count} 张图片，超过上限，按 {self.batch_max_count} 张处理")
+        return min(max(count, 1), self.batch_max_count)
+
+    async def _wait_turn(self, ticket):
+        """等待排队轮到该请求，并记录排队耗时"""
+        with get_metrics().timer("queue_wait"):
+            await ticket.wait()
+
+    @staticmethod
+    def _observe_request(command: str, start: float, succeeded: bool):
+        """记录一次绘图请求从收到到结果就绪的整体耗时"""
+        get_metrics().observe(
+            "request_total", time.perf_counter() - start,
+            command=command, outcome="success" if succeeded else "failed",
+        )
+
+    async def terminate(self):
+        """插件卸载时释放共享资源"""
+        jobs = list(self._jobs)
+        for job in jobs:
+            job.cancel()
+        await asyncio.gather(*jobs, return_exceptions=True)
+        await cancel_inflight_requests()
+        await stop_metrics_server()
+        await stop_image_janitor()
+        await get_result_cache().close()
+        await get_key_ledger().close()
+        await close_http_session()
+        await close_file_channels()
+        shutdown_workers()
+
     async def _load_global_config(self):
         """异步加载全局配置"""
         if self._global_config_loaded:
             return
 
+        if self.metrics_port:
+            await start_metrics_server(self.metrics_host, self.metrics_port)
+
         try:
             plugin_config = await sp.global_get("gemini-25-image-openrouter", {})
 
@@ -55,36 +279,87 @@ class MyPlugin(Star):
             logger.error(f"加载全局配置失败: {e}")
             self._global_config_loaded = True  # 即使失败也标记为已加载，避免重复尝试
 
-    async def send_image_with_callback_api(self, image_path: str) -> Image:
+    async def _collect_reference_images(self, event: AstrMessageEvent) -> list:
+        """并发获取消息及引用消息中的图片，去重后缩放并重新编码，减小请求体积"""
+        metrics = get_metrics()
+        with metrics.timer("reference_fetch"):
+            input_images = await collect_reference_images(
+                event,
+                concurrency=self.ref_image_fetch_concurrency,
+                timeout=self.ref_image_fetch_timeout,
+            )
+        if not input_images:
+            return []
+        with metrics.timer("reference_prepare"):
+            return await prepare_reference_images(
+                input_images,
+                max_edge=self.ref_image_max_edge,
+                quality=self.ref_image_quality,
+                output_format=self.ref_image_format,
+            )
+
+    async def _deliver_image(self, image: GeneratedImage) -> Image:
+        """
+        将生成的图像转换为图片组件
+
+        只有远程文件传输或关闭了内存发送时才写入images文件夹，其余情况直接从内存构建图片组件。
+
+        Args:
+            image (GeneratedImage): 生成的图像
+
+        Returns:
+            Image: 图片组件
+        """
+        metrics = get_metrics()
+        with metrics.timer("deliver"):
+            if self.nap_server_address and self.nap_server_address != "localhost":
+                image_path = await image.ensure_file()
+                with metrics.timer("send_file") as timer:
+                    remote_path = await send_file(image_path, self.nap_server_address, self.nap_server_port)
+                    timer.labels["outcome"] = "success" if remote_path else "failed"
+                return await self.send_image_with_callback_api(remote_path or image_path)
+            if not self.in_memory_delivery or image.data is None:
+                return await self.send_image_with_callback_api(await image.ensure_file())
+            return await self.send_image_with_callback_api(image)
+
+    async def send_image_with_callback_api(self, image) -> Image:
         """
-        优先使用callback_api_base发送图片，失败则退回到本地文件发送
+        优先使用callback_api_base发送图片，失败则退回到本地文件或内存数据发送
 
         Args:
-            image_path (str): 图片文件路径
+            image (str or GeneratedImage): 图片文件路径，或只保存在内存中的图像
 
         Returns:
             Image: 图片组件
         """
+        if isinstance(image, GeneratedImage):
+            def local_component():
+                return Image.fromBytes(image.data)
+        else:
+            def local_component():
+                return Image.fromFileSystem(image)
+
         callback_api_base = self.context.get_config().get("callback_api_base")
         if not callback_api_base:
             logger.info("未配置callback_api_base，使用本地文件发送")
-            return Image.fromFileSystem(image_path)
+            return local_component()
 
         logger.info(f"检测到配置了callback_api_base: {callback_api_base}")
         try:
-            image_component = Image.fromFileSystem(image_path)
-            download_url = await image_component.convert_to_web_link()
+            image_component = local_component()
+            with get_metrics().timer("web_link"):
+                download_url = await image_component.convert_to_web_link()
             logger.info(f"成功生成下载链接: {download_url}")
             return Image.fromURL(download_url)
         except (IOError, OSError) as e:
             logger.warning(f"文件操作失败: {e}，将退回到本地文件发送")
-            return Image.fromFileSystem(image_path)
+            return local_component()
         except (ConnectionError, TimeoutError) as e:
             logger.warning(f"网络连接失败: {e}，将退回到本地文件发送")
-            return Image.fromFileSystem(image_path)
+            return local_component()
         except Exception as e:
             logger.error(f"发送图片时出现未预期的错误: {e}，将退回到本地文件发送")
-            return Image.fromFileSystem(image_path)
+            return local_component()
 
     @filter.llm_tool(name="gemini-pic-gen")
     async def gemini_pic_gen(
@@ -92,6 +367,7 @@ class MyPlugin(Star):
         event: AstrMessageEvent,
         image_description: str = "",
         use_reference_images: str = "true",
+        count: int = 1,
         **kwargs,
     ):
         """Generate or modify images using the Gemini model via the OpenRouter API.
@@ -124,16 +400,14 @@ class MyPlugin(Star):
         Args:
             image_description (string): Image description text; if the tool fails to provide it, it will be taken from kwargs or the message as a fallback.
             use_reference_images (string): Whether to use contextual reference images; pass true/false (default true).
+            count (number): Number of image variants to generate in parallel for the same description (default 1). Use it when the user asks for several images or variants.
         """
+        request_start = time.perf_counter()
         use_reference = str(use_reference_images).lower() in {"true", "1", "yes", "y"}
 
         # 加载全局配置，确保使用最新的配置
         await self._load_global_config()
 
-        openrouter_api_keys = self.openrouter_api_keys
-        nap_server_address = self.nap_server_address
-        nap_server_port = self.nap_server_port
-
         if not image_description:
             image_description = (
                 kwargs.get("prompt")
@@ -141,85 +415,219 @@ class MyPlugin(Star):
                 or ""
             )
 
-        # 根据参数决定是否使用参考图片
-        input_images = []
-        if use_reference:
-            # 从当前对话上下文中获取图片信息
-            if hasattr(event, "message_obj") and event.message_obj and hasattr(event.message_obj, "message"):
-                for comp in event.message_obj.message:
-                    if isinstance(comp, Image):
-                        try:
-                            base64_data = await comp.convert_to_base64()
-                            input_images.append(base64_data)
-                        except (IOError, ValueError, OSError) as e:
-                            logger.warning(f"转换当前消息中的参考图片到base64失败: {e}")
-                        except Exception as e:
-                            logger.error(f"处理当前消息中的图片时出现未预期的错误: {e}")
-                    elif isinstance(comp, Reply):
-                        # 修复引用消息中的图片获取逻辑
-                        # Reply组件的chain字段包含被引用的消息内容
-                        if comp.chain:
-                            for reply_comp in comp.chain:
-                                if isinstance(reply_comp, Image):
-                                    try:
-                                        base64_data = await reply_comp.convert_to_base64()
-                                        input_images.append(base64_data)
-                                        logger.info("从引用消息中获取到图片")
-                                    except (IOError, ValueError, OSError) as e:
-                                        logger.warning(f"转换引用消息中的参考图片到base64失败: {e}")
-                                    except Exception as e:
-                                        logger.error(f"处理引用消息中的图片时出现未预期的错误: {e}")
-                        else:
-                            logger.debug("引用消息的chain为空，无法获取图片内容")
+        count = self._batch_count(count)
 
-            # 记录使用的图片数量
-            if input_images:
-                logger.info(f"使用了 {len(input_images)} 张参考图片进行图像生成")
+        # 排队，队列已满时直接拒绝
+        try:
+            if count > 1:
+                tickets, notice = self._enter_batch_queue(event, count)
             else:
-                logger.info("未找到参考图片，执行纯文本图像生成")
+                ticket, notice = self._enter_queue(event)
+                tickets = [ticket]
+        except QueueFullError as e:
+            yield event.plain_result(str(e))
+            return
+
+        if self.async_tool_mode:
+            # 异步模式：立即返回确认，不占用本轮对话，生成完成后主动推送到原会话
+            self._start_job(self._run_generation_job(event, tickets, image_description, use_reference, request_start))
+            what = f" {count} 张图片的绘图请求" if count > 1 else "绘图请求"
+            if tickets[0].position:
+                ack = f"🎨 已收到{what}，当前排在第 {tickets[0].position} 位，生成完成后会自动发送到本会话"
+            else:
+                ack = f"🎨 已收到{what}，正在生成，完成后会自动发送到本会话"
+            yield event.plain_result(ack)
+            return
+
+        try:
+            if notice:
+                yield event.plain_result(notice)
+            chain = await self._generate_for_tickets(event, image_description, use_reference, tickets)
+        finally:
+            for ticket in tickets:
+                ticket.release()
+        self._observe_request("gemini_pic_gen", request_start, self._has_image(chain))
+        yield event.chain_result(chain)
+
+    async def _generate_for_tickets(self, event: AstrMessageEvent, image_description: str, use_reference: bool, tickets: list) -> list:
+        """等待排队后生成图像；有多个排队凭证时并发生成多个变体"""
+        if len(tickets) == 1:
+            await self._wait_turn(tickets[0])
+            return await self._generate_image_chain(event, image_description, use_reference)
+        return await self._generate_batch_chain(event, image_description, use_reference, tickets)
+
+    async def _generate_image_chain(self, event: AstrMessageEvent, image_description: str, use_reference: bool) -> list:
+        """
+        生成图像并构建回复消息链
+
+        Args:
+            event (AstrMessageEvent): 消息事件，用于获取参考图片
+            image_description (str): 图像描述
+            use_reference (bool): 是否使用参考图片
+
+        Returns:
+            list: 消息链，失败时为错误提示
+        """
+        input_images = await self._prepare_input_images(event, use_reference)
 
         # 调用生成图像的函数
         try:
-            image_url, image_path = await generate_image_openrouter(
+            image = await generate_openrouter_image(
                 image_description,
-                openrouter_api_keys,
+                self.openrouter_api_keys,
                 model=self.model_name,
                 input_images=input_images,
                 api_base=self.custom_api_base if self.custom_api_base else None,
                 max_retry_attempts=self.max_retry_attempts,
+                in_memory=self.in_memory_delivery,
+                timeout=self.request_timeout,
             )
 
-            if not image_url or not image_path:
+            if image is None:
                 # 生成失败，发送错误消息
-                error_chain = [Plain("图像生成失败，请检查API配置和网络连接。")]
-                yield event.chain_result(error_chain)
-                return
+                return [Plain("图像生成失败，请检查API配置和网络连接。")]
 
-            # 处理文件传输和图片发送
-            if self.nap_server_address and self.nap_server_address != "localhost":
-                image_path = await send_file(image_path, HOST=nap_server_address, PORT=nap_server_port)
-
-            # 使用新的发送方法，优先使用callback_api_base
-            image_component = await self.send_image_with_callback_api(image_path)
-            chain = [image_component]
-            yield event.chain_result(chain)
-            return
+            # 处理文件传输和图片发送，优先使用callback_api_base
+            image_component = await self._deliver_image(image)
+            return [image_component]
 
+        except DeadlineExceededError as e:
+            logger.error(str(e))
+            return [Plain(f"{e}，请稍后重试。")]
         except (ConnectionError, TimeoutError) as e:
             logger.error(f"网络连接错误导致图像生成失败: {e}")
-            error_chain = [Plain(f"网络连接错误，图像生成失败: {str(e)}")]
-            yield event.chain_result(error_chain)
-            return
+            return [Plain(f"网络连接错误，图像生成失败: {str(e)}")]
         except ValueError as e:
             logger.error(f"参数错误导致图像生成失败: {e}")
-            error_chain = [Plain(f"参数错误，图像生成失败: {str(e)}")]
-            yield event.chain_result(error_chain)
-            return
+            return [Plain(f"参数错误，图像生成失败: {str(e)}")]
         except Exception as e:
             logger.error(f"图像生成过程出现未预期的错误: {e}")
-            error_chain = [Plain(f"图像生成失败: {str(e)}")]
-            yield event.chain_result(error_chain)
-            return
+            return [Plain(f"图像生成失败: {str(e)}")]
+
+    async def _prepare_input_images(self, event: AstrMessageEvent, use_reference: bool) -> list:
+        """根据参数决定是否使用参考图片，返回预处理后的 base64 参考图片列表"""
+        input_images = []
+        if use_reference:
+            # 从当前对话上下文（包括引用消息）中获取图片
+            input_images = await self._collect_reference_images(event)
+
+            # 记录使用的图片数量
+            if input_images:
+                logger.info(f"使用了 {len(input_images)} 张参考图片进行图像生成")
+            else:
+                logger.info("未找到参考图片，执行纯文本图像生成")
+        return input_images
+
+    async def _generate_batch_chain(self, event: AstrMessageEvent, image_description: str, use_reference: bool, tickets: list) -> list:
+        """
+        并发生成同一描述的多个变体，合并为一条消息
+
+        参考图片只获取一次；每个变体各自排队，在全局并发上限内同时向上游请求，
+        密钥调度器会把并发请求分摊到不同的密钥上。图片按完成顺序排列。
+
+        Args:
+            event (AstrMessageEvent): 消息事件
+            image_description (str): 图像描述
+            use_reference (bool): 是否使用参考图片
+            tickets (list): 每个变体的排队凭证，函数返回前全部释放
+
+        Returns:
+            list: 消息链，全部失败时为错误提示
+        """
+        async def generate_variant(index, ticket):
+            try:
+                await self._wait_turn(ticket)
+                image = await generate_openrouter_image(
+                    image_description,
+                    self.openrouter_api_keys,
+                    model=self.model_name,
+                    input_images=input_images,
+                    api_base=self.custom_api_base if self.custom_api_base else None,
+                    max_retry_attempts=self.max_retry_attempts,
+                    in_memory=self.in_memory_delivery,
+                    variant=index,
+                    timeout=self.request_timeout,
+                )
+                return await self._deliver_image(image) if image is not None else None
+            finally:
+                ticket.release()
+
+        try:
+            input_images = await self._prepare_input_images(event, use_reference)
+        except BaseException:
+            for ticket in tickets:
+                ticket.release()
+            raise
+
+        tasks = [asyncio.create_task(generate_variant(i, ticket)) for i, ticket in enumerate(tickets)]
+        components = []
+        timed_out = None
+        try:
+            for future in asyncio.as_completed(tasks):
+                try:
+                    component = await future
+                except DeadlineExceededError as e:
+                    logger.error(f"批量生成中的一张图片超时: {e}")
+                    timed_out = e
+                    continue
+                except Exception as e:
+                    logger.error(f"批量生成中的一张图片失败: {e}")
+                    continue
+                if component is not None:
+                    components.append(component)
+                    logger.info(f"批量生成进度: {len(components)}/{len(tasks)}")
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        if not components:
+            if timed_out is not None:
+                return [Plain(f"{timed_out}，请稍后重试。")]
+            return [Plain("图像生成失败，请检查API配置和网络连接。")]
+        return self._merge_images(event, components, len(tasks))
+
+    def _merge_images(self, event: AstrMessageEvent, components: list, requested: int) -> list:
+        """将多张图片合并为一条消息，QQ（aiocqhttp）平台上使用合并转发"""
+        header = f"🎨 已生成 {len(components)}/{requested} 张图片"
+        if len(components) < requested:
+            header += f"，{requested - len(components)} 张生成失败"
+        if self.batch_forward and event.get_platform_name() == "aiocqhttp":
+            uin = event.get_self_id()
+            nodes = [Node(uin=uin, name="Gemini 绘图", content=[Plain(header)])]
+            nodes += [Node(uin=uin, name="Gemini 绘图", content=[component]) for component in components]
+            return [Nodes(nodes)]
+        return [Plain(header)] + components
+
+    @staticmethod
+    def _has_image(chain: list) -> bool:
+        return any(isinstance(item, (Image, Nodes)) for item in chain)
+
+    def _start_job(self, coro):
+        """在后台运行任务，持有任务引用直到完成，事件处理函数返回后任务仍会继续执行"""
+        task = asyncio.create_task(coro)
+        self._jobs.add(task)
+        task.add_done_callback(self._jobs.discard)
+        return task
+
+    async def _run_generation_job(self, event: AstrMessageEvent, tickets: list, image_description: str, use_reference: bool, request_start: float):
+        """异步模式下的后台生成任务，完成后将结果推送到发起请求的会话"""
+        unified_msg_origin = event.unified_msg_origin
+        try:
+            chain = await self._generate_for_tickets(event, image_description, use_reference, tickets)
+        except Exception as e:
+            # 后台任务没有调用方处理异常，出错时同样要告知用户
+            logger.error(f"后台图像生成任务出现未预期的错误: {e}")
+            chain = [Plain(f"图像生成失败: {str(e)}")]
+        finally:
+            for ticket in tickets:
+                ticket.release()
+        self._observe_request("gemini_pic_gen", request_start, self._has_image(chain))
+
+        try:
+            await self.context.send_message(unified_msg_origin, MessageChain(chain))
+        except Exception as e:
+            logger.error(f"向会话 {unified_msg_origin} 推送生成结果失败: {e}")
 
     @filter.command_group("banana")
     def banan(self):
@@ -299,40 +707,180 @@ class MyPlugin(Star):
         else:
             yield event.plain_result(f"已临时切换模型到: {new_model}（会话级别，重启后恢复）")
 
+    @banan.command("batch")
+    async def batch_generate(self, event: AstrMessageEvent, count: str = None):
+        """并发生成同一提示词的多张图片
+
+        使用方法:
+        /banana batch <数量> <提示词> - 并发生成多张图片，全部完成后合并为一条消息发送
+        消息中或引用的图片会作为参考图片使用
+
+        例如: /banana batch 4 一只戴着宇航员头盔的橘猫
+        """
+        request_start = time.perf_counter()
+        await self._load_global_config()
+
+        # 提示词可能包含空格，从完整消息中解析
+        match = re.search(r"batch\s+(\d+)\s+(.+)$", event.message_str.strip(), re.S)
+        if not match:
+            yield event.plain_result(
+                f"使用方法: /banana batch <数量> <提示词>\n单次最多 {self.batch_max_count} 张，例如: /banana batch 4 一只戴着宇航员头盔的橘猫"
+            )
+            return
+        count = self._batch_count(match.group(1))
+        prompt = match.group(2).strip()
+
+        try:
+            tickets, notice = self._enter_batch_queue(event, count)
+        except QueueFullError as e:
+            yield event.plain_result(str(e))
+            return
+
+        try:
+            if notice:
+                yield event.plain_result(notice)
+            chain = await self._generate_for_tickets(event, prompt, True, tickets)
+        finally:
+            for ticket in tickets:
+                ticket.release()
+        self._observe_request("banana_batch", request_start, self._has_image(chain))
+        yield event.chain_result(chain)
+
+    @banan.command("cache")
+    async def cache_stats(self, event: AstrMessageEvent, action: str = None):
+        """查看或清空生成结果缓存
+
+        使用方法:
+        /banana cache - 查看缓存命中率和占用空间
+        /banana cache clear - 清空缓存
+        """
+        cache = get_result_cache()
+        if action and action.lower() == "clear":
+            await cache.clear()
+            yield event.plain_result("已清空生成结果缓存")
+            return
+
+        stats = await cache.stats()
+        if not stats["enabled"]:
+            yield event.plain_result("生成结果缓存未启用")
+            return
+
+        yield event.plain_result(
+            f"生成结果缓存\n"
+            f"条目数: {stats['entries']}\n"
+            f"占用空间: {stats['bytes'] / 1024 / 1024:.1f} MB / {stats['max_bytes'] / 1024 / 1024:.0f} MB\n"
+            f"命中率: {stats['hit_rate']:.1%}（命中 {stats['hits']} 次，未命中 {stats['misses']} 次）\n"
+            f"过期时间: {stats['ttl'] / 3600:.1f} 小时\n"
+            f"使用 /banana cache clear 清空缓存"
+        )
+
+    @banan.command("endpoints")
+    async def endpoint_stats(self, event: AstrMessageEvent):
+        """查看各API端点的延迟和健康状态
+
+        使用方法:
+        /banana endpoints - 查看各端点的平均延迟、成功率和熔断状态
+        """
+        await self._load_global_config()
+
+        lines = ["API端点状态（按延迟和错误率自动选择）"]
+        for item in get_endpoint_router().snapshot(self.custom_api_base or None):
+            latency = f"{item['latency']:.1f}s" if item["latency"] is not None else "暂无"
+            line = (
+                f"{item['name']} ({item['base']}): 平均延迟 {latency}，成功率 {item['success_rate']:.0%}，"
+                f"进行中 {item['in_flight']}，请求 {item['total_requests']} 次，失败 {item['total_failures']} 次"
+            )
+            if item["open_remaining"] > 0:
+                line += f"，熔断中（剩余 {item['open_remaining']:.0f} 秒）"
+            lines.append(line)
+        yield event.plain_result("\n".join(lines))
+
+    @banan.command("keys")
+    async def key_stats(self, event: AstrMessageEvent):
+        """查看各API密钥的状态和今日用量
+
+        使用方法:
+        /banana keys - 查看各密钥的冷却状态、成功率，以及今天（UTC）所有实例合计的请求、429 和 402 次数
+        """
+        await self._load_global_config()
+
+        api_keys = self.openrouter_api_keys
+        if not api_keys:
+            yield event.plain_result("未配置API密钥")
+            return
+
+        ledger = get_key_ledger()
+        usage = await ledger.usage(api_keys)
+        lines = ["API密钥状态" + ("（今日用量为所有实例合计）" if ledger.active else "")]
+        for item, api_key in zip(await get_key_scheduler().snapshot(api_keys), api_keys):
+            latency = f"{item['latency']:.1f}s" if item["latency"] is not None else "暂无"
+            line = f"密钥 #{item['index']}: 成功率 {item['success_rate']:.0%}，平均延迟 {latency}，进行中 {item['in_flight']}"
+            today = usage.get(ledger.key_id(api_key))
+            if today:
+                line += (
+                    f"，今日请求 {today['requests']} 次（成功 {today['successes']}，"
+                    f"429 {today['rate_limited']} 次，402 {today['exhausted']} 次）"
+                )
+            if item["cooldown_remaining"] > 0:
+                reason = {"exhausted": "额度耗尽", "key_invalid": "密钥无效或无权限"}.get(item["cooldown_reason"], "速率限制")
+                line += f"，冷却中（{reason}，剩余 {item['cooldown_remaining'] / 60:.0f} 分钟）"
+            lines.append(line)
+        yield event.plain_result("\n".join(lines))
+
+    @banan.command("stats")
+    async def stage_stats(self, event: AstrMessageEvent, group_by: str = None):
+        """查看各阶段耗时统计
+
+        使用方法:
+        /banana stats - 查看各阶段耗时的 p50/p95/p99
+        /banana stats <key|model|endpoint|outcome|command> - 按API密钥序号、模型、端点、结果或命令分组查看
+        /banana stats reset - 清空统计
+        """
+        metrics = get_metrics()
+        if group_by and group_by.lower() == "reset":
+            metrics.clear()
+            yield event.plain_result("已清空耗时统计")
+            return
+
+        summary = metrics.summary(group_by=group_by.lower() if group_by else None)
+        if not summary:
+            yield event.plain_result("暂无耗时统计数据")
+            return
+
+        def fmt(seconds):
+            return f"{seconds * 1000:.0f}ms" if seconds < 1 else f"{seconds:.2f}s"
+
+        lines = [f"各阶段耗时统计（自 {time.strftime('%m-%d %H:%M', time.localtime(metrics.started))} 起）"]
+        for stage, group, histogram in summary:
+            name = STAGE_NAMES.get(stage, stage)
+            if group is not None:
+                name = f"{name} [{group_by}={group}]"
+            lines.append(
+                f"{name}: n={histogram.count} p50={fmt(histogram.percentile(50))} "
+                f"p95={fmt(histogram.percentile(95))} p99={fmt(histogram.percentile(99))}"
+            )
+        transcode_input = metrics.counter_total("transcode_input_bytes")
+        if transcode_input:
+            saved = metrics.counter_total("transcode_saved_bytes")
+            lines.append(f"输出转码: 节省 {saved / 1024 / 1024:.1f} MB（原图共 {transcode_input / 1024 / 1024:.1f} MB，减少 {saved / transcode_input:.0%}）")
+        queue_stats = get_generation_queue().stats()
+        lines.append(f"队列: 执行中 {queue_stats['running']}/{queue_stats['max_concurrency']}，排队 {queue_stats['waiting']}")
+        yield event.plain_result("\n".join(lines))
+
     @filter.command("手办化")
     async def figure_transform(self, event: AstrMessageEvent):
         """将用户提供的图片转换为手办效果
 
         使用方法：发送图片并使用 /手办化 指令
         """
+        request_start = time.perf_counter()
+        succeeded = False
+
         # 加载全局配置，确保使用最新的配置
         await self._load_global_config()
 
-        # 检查消息中是否包含图片
-        input_images = []
-        if hasattr(event, "message_obj") and event.message_obj and hasattr(event.message_obj, "message"):
-            for comp in event.message_obj.message:
-                if isinstance(comp, Image):
-                    try:
-                        base64_data = await comp.convert_to_base64()
-                        input_images.append(base64_data)
-                    except (IOError, ValueError, OSError) as e:
-                        logger.warning(f"转换图片到base64失败: {e}")
-                    except Exception as e:
-                        logger.error(f"处理图片时出现未预期的错误: {e}")
-                elif isinstance(comp, Reply):
-                    # 处理引用消息中的图片
-                    if comp.chain:
-                        for reply_comp in comp.chain:
-                            if isinstance(reply_comp, Image):
-                                try:
-                                    base64_data = await reply_comp.convert_to_base64()
-                                    input_images.append(base64_data)
-                                    logger.info("从引用消息中获取到图片")
-                                except (IOError, ValueError, OSError) as e:
-                                    logger.warning(f"转换引用消息中的图片到base64失败: {e}")
-                                except Exception as e:
-                                    logger.error(f"处理引用消息中的图片时出现未预期的错误: {e}")
+        # 获取消息和引用消息中的图片
+        input_images = await self._collect_reference_images(event)
 
         # 检查是否找到图片
         if not input_images:
@@ -366,39 +914,51 @@ Technical Requirements:
 
 Please ensure the final result looks like a real commercial figure product that could exist in the market."""
 
+        # 排队，队列已满时直接拒绝
         try:
-            image_url, image_path = await generate_image_openrouter(
+            ticket, notice = self._enter_queue(event)
+        except QueueFullError as e:
+            yield event.plain_result(str(e))
+            return
+
+        try:
+            if notice:
+                yield event.plain_result(notice)
+            await self._wait_turn(ticket)
+
+            image = await generate_openrouter_image(
                 figure_prompt,
                 self.openrouter_api_keys,
                 model=self.model_name,
                 input_images=input_images,
                 api_base=self.custom_api_base if self.custom_api_base else None,
                 max_retry_attempts=self.max_retry_attempts,
+                in_memory=self.in_memory_delivery,
+                timeout=self.request_timeout,
             )
 
-            if not image_url or not image_path:
-                error_chain = [Plain("手办化处理失败，请检查API配置和网络连接。")]
-                yield event.chain_result(error_chain)
-                return
-
-            # 处理文件传输和图片发送
-            if self.nap_server_address and self.nap_server_address != "localhost":
-                image_path = await send_file(image_path, HOST=self.nap_server_address, PORT=self.nap_server_port)
-
-            # 发送处理结果
-            image_component = await self.send_image_with_callback_api(image_path)
-            result_chain = [Plain("✨ 手办化处理完成！"), image_component]
-            yield event.chain_result(result_chain)
-
+            if image is None:
+                chain = [Plain("手办化处理失败，请检查API配置和网络连接。")]
+            else:
+                # 处理文件传输和发送处理结果
+                image_component = await self._deliver_image(image)
+                chain = [Plain("✨ 手办化处理完成！"), image_component]
+                succeeded = True
+
+        except DeadlineExceededError as e:
+            logger.error(str(e))
+            chain = [Plain(f"手办化处理失败，{e}，请稍后重试。")]
         except (ConnectionError, TimeoutError) as e:
             logger.error(f"网络连接错误导致手办化处理失败: {e}")
-            error_chain = [Plain(f"网络连接错误，手办化处理失败: {str(e)}")]
-            yield event.chain_result(error_chain)
+            chain = [Plain(f"网络连接错误，手办化处理失败: {str(e)}")]
         except ValueError as e:
             logger.error(f"参数错误导致手办化处理失败: {e}")
-            error_chain = [Plain(f"参数错误，手办化处理失败: {str(e)}")]
-            yield event.chain_result(error_chain)
+            chain = [Plain(f"参数错误，手办化处理失败: {str(e)}")]
         except Exception as e:
             logger.error(f"手办化处理过程出现未预期的错误: {e}")
-            error_chain = [Plain(f"手办化处理失败: {str(e)}")]
-            yield event.chain_result(error_chain)
\ No newline at end of file
+            chain = [Plain(f"手办化处理失败: {str(e)}")]
+        finally:
+            # 结果发送前就释放排队名额，发送耗时不占用并发
+            ticket.release()
+            self._observe_request("figure_transform", request_start, succeeded)
+        yield event.chain_result(chain)
\ No newline at end of file
@@ -0,0 +1,67 @@
+import time
+
+
+class DeadlineExceededError(TimeoutError):
+    """单次绘图请求的整体时间预算已用尽"""
+
+
+class Deadline:
+    """
+    单次绘图请求的整体时间预算
+
+    在所有密钥、端点和重试之间共享：每次上游请求的超时不超过剩余时间，
+    剩余时间不足以完成一次请求时不再重试或切换密钥，预算用尽后以 DeadlineExceededError 结束。
+
+    Args:
+        seconds (float): 时间预算（秒）
+    """
+
+    # 剩余时间少于该值时不再发起新的上游请求
+    MIN_ATTEMPT_SECONDS = 5.0
+
+    def __init__(self, seconds):
+        self.seconds = float(seconds)
+        self.expires_at = time.monotonic() + self.seconds
+
+    @classmethod
+    def after(cls, seconds):
+        """
+        Args:
+            seconds (float or None): 时间预算（秒），为 None 或不大于0时不限制
+
+        Returns:
+            Deadline or None: 时间预算，不限制时返回 None
+        """
+        if not seconds or seconds <= 0:
+            return None
+        return cls(seconds)
+
+    def remaining(self):
+        """剩余时间（秒），不小于0"""
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        """剩余时间是否已不足以发起一次上游请求"""
+        return self.remaining() < self.MIN_ATTEMPT_SECONDS
+
+    def can_fit(self, wait_seconds):
+        """等待 wait_seconds 秒后是否还来得及发起一次上游请求"""
+        return self.remaining() - wait_seconds >= self.MIN_ATTEMPT_SECONDS
+
+    def cap(self, seconds):
+        """
+        Args:
+            seconds (float or None): 原本的超时时间，None 表示不限制
+
+        Returns:
+            float: 不超过剩余时间的超时时间
+        """
+        remaining = self.remaining()
+        return remaining if seconds is None else min(seconds, remaining)
+
+    def error(self):
+        """
+        Returns:
+            DeadlineExceededError: 带有预算说明的超时错误
+        """
+        return DeadlineExceededError(f"图像生成超时：已用尽 {self.seconds:.0f} 秒的时间预算")
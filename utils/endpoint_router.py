@@ -0,0 +1,288 @@
+import fnmatch
+import random
+from urllib.parse import urlsplit
+from astrbot.api import logger
+from .retry_policy import get_retry_policy
+
+# 未配置 API base 时使用的 OpenRouter 端点
+DEFAULT_API_BASE = "https://openrouter.ai/api"
+DEFAULT_CHAT_PATH = "/v1/chat/completions"
+DEFAULT_IMAGES_PATH = "/v1/images/generations"
+# 默认使用 OpenAI 图像生成接口（/v1/images/generations）的模型
+DEFAULT_IMAGE_MODELS = ("*nano-banana*",)
+
+
+class EndpointRoute:
+    """一次请求在某个端点上的实际地址、上游模型名和接口格式"""
+    def __init__(self, endpoint, url, model, api_format):
+        self.endpoint = endpoint
+        self.url = url
+        self.model = model
+        # chat: /v1/chat/completions 格式；images: OpenAI 图像生成格式
+        self.api_format = api_format
+
+
+class Endpoint:
+    """
+    一个兼容 OpenRouter 的 API 端点（OpenRouter 本身或自建中转）
+
+    Args:
+        base (str): API base，例如 https://openrouter.ai/api
+        models (list): 该端点提供的模型（支持 * 通配符），默认全部
+        aliases (dict): 模型名映射，请求该端点时将模型名替换为端点上的名称
+        image_models (list): 使用图像生成接口的模型（支持 * 通配符）
+        chat_path (str): chat completions 接口路径
+        images_path (str): 图像生成接口路径
+        api_keys (list): 该端点专用的API密钥，为空时使用全局密钥
+        name (str): 显示名称，默认为主机名
+    """
+
+    def __init__(self, base, models=None, aliases=None, image_models=None, chat_path=DEFAULT_CHAT_PATH,
+                 images_path=DEFAULT_IMAGES_PATH, api_keys=None, name=None):
+        self.base = base.rstrip("/")
+        self.models = [pattern.lower() for pattern in (models or ["*"])]
+        self.aliases = {source.lower(): target for source, target in (aliases or {}).items()}
+        self.image_models = [pattern.lower() for pattern in (image_models or DEFAULT_IMAGE_MODELS)]
+        self.chat_path = "/" + chat_path.lstrip("/")
+        self.images_path = "/" + images_path.lstrip("/")
+        self.api_keys = list(api_keys or [])
+        self.name = name or urlsplit(self.base).netloc or self.base
+        # 健康统计
+        self.latency = None
+        self.success_rate = 1.0
+        self.in_flight = 0
+        self.total_requests = 0
+        self.total_failures = 0
+
+    def serves(self, model):
+        return any(fnmatch.fnmatchcase(model.lower(), pattern) for pattern in self.models)
+
+    def resolve(self, model):
+        """
+        Returns:
+            EndpointRoute: 该模型在本端点上的请求方式
+        """
+        upstream_model = self.aliases.get(model.lower(), model)
+        if any(fnmatch.fnmatchcase(model.lower(), pattern) for pattern in self.image_models):
+            return EndpointRoute(self, f"{self.base}{self.images_path}", upstream_model, "images")
+        return EndpointRoute(self, f"{self.base}{self.chat_path}", upstream_model, "chat")
+
+    def begin(self):
+        self.in_flight += 1
+        self.total_requests += 1
+
+    def record(self, success, latency=None):
+        """
+        记录一次请求结果
+
+        Args:
+            success (bool or None): 端点是否正常响应，None 表示请求被取消、不计入统计
+            latency (float): 请求耗时（秒），仅在成功时计入平均延迟
+        """
+        self.in_flight = max(0, self.in_flight - 1)
+        if success is None:
+            self.total_requests = max(0, self.total_requests - 1)
+            return
+        alpha = EndpointRouter.EWMA_ALPHA
+        self.success_rate += alpha * ((1.0 if success else 0.0) - self.success_rate)
+        if not success:
+            self.total_failures += 1
+        elif latency is not None:
+            self.latency = latency if self.latency is None else self.latency + alpha * (latency - self.latency)
+
+    def score(self, default_latency):
+        latency = self.latency if self.latency is not None else default_latency
+        return self.success_rate / ((1 + self.in_flight) * max(latency, 0.1))
+
+
+def parse_endpoint(spec):
+    """
+    解析端点配置
+
+    格式为 “API base | 选项=值 | ...”，多个值用逗号分隔，可用选项:
+        models=google/*,openai/*         该端点提供的模型
+        alias=原模型名=>端点上的模型名      模型名映射
+        images=*nano-banana*             使用图像生成接口的模型
+        chat_path=/v1/chat/completions   chat 接口路径
+        images_path=/v1/images/generations  图像生成接口路径
+        keys=sk-xxx,sk-yyy               该端点专用的API密钥
+        name=中转1                        显示名称
+
+    Args:
+        spec (str): 端点配置
+
+    Returns:
+        Endpoint: 端点
+
+    Raises:
+        ValueError: 配置格式错误
+    """
+    parts = [part.strip() for part in spec.split("|")]
+    base = parts[0]
+    if not base.startswith(("http://", "https://")):
+        raise ValueError(f"API base 必须以 http:// 或 https:// 开头: {base}")
+
+    options = {}
+    for part in parts[1:]:
+        if not part:
+            continue
+        name, sep, value = part.partition("=")
+        if not sep:
+            raise ValueError(f"无法识别的端点选项: {part}")
+        options[name.strip().lower()] = value.strip()
+
+    def values(name):
+        return [item.strip() for item in options.pop(name, "").split(",") if item.strip()]
+
+    aliases = {}
+    for item in values("alias"):
+        source, sep, target = item.partition("=>")
+        if not sep:
+            raise ValueError(f"模型名映射格式应为 原模型名=>端点上的模型名: {item}")
+        aliases[source.strip()] = target.strip()
+
+    endpoint = Endpoint(
+        base,
+        models=values("models"),
+        aliases=aliases,
+        image_models=values("images"),
+        chat_path=options.pop("chat_path", DEFAULT_CHAT_PATH),
+        images_path=options.pop("images_path", DEFAULT_IMAGES_PATH),
+        api_keys=values("keys"),
+        name=options.pop("name", None),
+    )
+    if options:
+        raise ValueError(f"无法识别的端点选项: {', '.join(options)}")
+    return endpoint
+
+
+class EndpointRouter:
+    """
+    按延迟和错误率在多个 API 端点之间路由
+
+    主端点为 custom_api_base（未配置时为 OpenRouter），另可配置多个兼容端点。
+    每个端点记录成功率和平均延迟的指数滑动平均以及进行中请求数，每次请求按得分从高到低排列候选端点，
+    处于熔断中的端点被跳过，某个端点变慢或出错时流量会自动转移到其他端点。
+    """
+
+    # 成功率和延迟的指数滑动平均系数
+    EWMA_ALPHA = 0.3
+    # 所有端点都没有延迟数据时假定的延迟（秒）
+    DEFAULT_LATENCY = 10.0
+    # 以该概率把一个非最优端点放到最前面，使变慢后已恢复的端点有机会重新被选中
+    EXPLORE_RATIO = 0.05
+
+    def __init__(self):
+        self.endpoints = []
+        self._primary = {}
+
+    def configure(self, endpoints=None):
+        """
+        设置额外的 API 端点
+
+        Args:
+            endpoints (list): 端点配置字符串列表，格式见 parse_endpoint
+        """
+        if endpoints is None:
+            return
+        parsed = []
+        for spec in endpoints:
+            if not spec or not spec.strip():
+                continue
+            try:
+                parsed.append(parse_endpoint(spec))
+            except ValueError as e:
+                logger.error(f"忽略无效的API端点配置 {spec!r}: {e}")
+        self.endpoints = parsed
+
+    def primary(self, api_base=None):
+        """
+        获取主端点，不同的 api_base 各自记录健康统计
+
+        Args:
+            api_base (str): 自定义 API base，为空时使用 OpenRouter
+        """
+        base = (api_base or DEFAULT_API_BASE).rstrip("/")
+        endpoint = self._primary.get(base)
+        if endpoint is None:
+            endpoint = self._primary[base] = Endpoint(base)
+        return endpoint
+
+    def candidates(self, model, api_base=None):
+        """
+        按得分排列可用于该模型的端点
+
+        Args:
+            model (str): 模型名称
+            api_base (str): 主端点的 API base
+
+        Returns:
+            list: [EndpointRoute]，第一个为首选端点；处于熔断中的端点不包含在内
+        """
+        retry_policy = get_retry_policy()
+        routes = []
+        for endpoint in [self.primary(api_base)] + self.endpoints:
+            if not endpoint.serves(model):
+                continue
+            route = endpoint.resolve(model)
+            if retry_policy.open_remaining(route.url) > 0:
+                continue
+            routes.append(route)
+
+        # 尚无延迟数据的端点按当前最快端点的延迟估计，新加入的端点会先被尝试
+        known = [route.endpoint.latency for route in routes if route.endpoint.latency is not None]
+        default_latency = min(known) if known else self.DEFAULT_LATENCY
+        # 得分相同时优先选择请求较少的端点
+        routes.sort(key=lambda route: (route.endpoint.score(default_latency), -route.endpoint.total_requests), reverse=True)
+        if len(routes) > 1 and random.random() < self.EXPLORE_RATIO:
+            routes.insert(0, routes.pop(random.randrange(1, len(routes))))
+        return routes
+
+    def snapshot(self, api_base=None):
+        """
+        获取各端点的健康状态摘要
+
+        Returns:
+            list: 每个端点一项的状态字典
+        """
+        retry_policy = get_retry_policy()
+        result = []
+        for endpoint in [self.primary(api_base)] + self.endpoints:
+            result.append({
+                "name": endpoint.name,
+                "base": endpoint.base,
+                "latency": endpoint.latency,
+                "success_rate": endpoint.success_rate,
+                "in_flight": endpoint.in_flight,
+                "total_requests": endpoint.total_requests,
+                "total_failures": endpoint.total_failures,
+                "open_remaining": max(
+                    retry_policy.open_remaining(f"{endpoint.base}{endpoint.chat_path}"),
+                    retry_policy.open_remaining(f"{endpoint.base}{endpoint.images_path}"),
+                ),
+            })
+        return result
+
+
+# 全局端点路由实例
+_router = EndpointRouter()
+
+
+def configure_endpoint_router(**kwargs):
+    """
+    配置 API 端点路由
+
+    Args:
+        **kwargs: endpoints
+    """
+    _router.configure(**kwargs)
+
+
+def get_endpoint_router():
+    """
+    获取全局端点路由
+
+    Returns:
+        EndpointRouter: 端点路由
+    """
+    return _router
@@ -0,0 +1,230 @@
+"""
+文件接收端参考实现
+
+在 NapCat 所在的服务器上运行，接收插件通过 file_send_server.py 发送的图片，并返回保存后的绝对路径。
+本脚本不依赖 AstrBot，可以单独复制到 NapCat 服务器上运行：
+
+    python file_receive_server.py --host 0.0.0.0 --port 3658 --dir ./received_files
+
+同一端口同时支持两种协议，按连接的前4个字节区分：
+
+协议 v1（每个文件一帧，可在同一连接上连续发送多个文件）:
+    客户端 -> 接收端: 文件名长度(>I) + 文件名 + 文件大小(>Q) + 文件内容
+    接收端 -> 客户端: 路径长度(>I) + 路径
+
+协议 v2（连接建立后先握手）:
+    客户端 -> 接收端: b"BNFT" + 版本号(1字节, 2)
+    接收端 -> 客户端: b"BNFT" + 版本号(1字节, 2)
+    之后每个文件:
+    客户端 -> 接收端: b"O" + SHA-256(32字节) + 文件大小(>Q) + 文件名长度(>H) + 文件名
+    接收端 -> 客户端: b"H" + 路径长度(>I) + 路径            已有相同内容的文件，无需上传
+                   或 b"R" + 已收到的字节数(>Q)             客户端从该位置开始发送剩余内容
+    客户端 -> 接收端: 剩余的文件内容
+    接收端 -> 客户端: b"D" + 路径长度(>I) + 路径            校验通过
+                   或 b"E" + 错误信息长度(>I) + 错误信息     校验失败，已丢弃收到的数据
+
+v2 文件按内容哈希命名保存，未传完的数据保存在 .partial 目录中，连接中断后可以续传。
+"""
+
+import argparse
+import asyncio
+import hashlib
+import logging
+import os
+import struct
+from pathlib import Path
+
+logger = logging.getLogger("file_receive_server")
+
+PROTOCOL_MAGIC = b"BNFT"
+PROTOCOL_VERSION = 2
+CHUNK_SIZE = 1024 * 1024
+# 单个文件大小上限，防止异常数据耗尽磁盘
+MAX_FILE_SIZE = 512 * 1024 * 1024
+
+
+class FileReceiveServer:
+    """
+    文件接收端
+
+    Args:
+        storage_dir (str or Path): 文件保存目录
+    """
+
+    def __init__(self, storage_dir):
+        self.storage_dir = Path(storage_dir).resolve()
+        self.partial_dir = self.storage_dir / ".partial"
+        self.storage_dir.mkdir(parents=True, exist_ok=True)
+        self.partial_dir.mkdir(parents=True, exist_ok=True)
+        # 同一内容的文件同时只允许一个连接写入: 哈希 -> [锁, 使用者数量]
+        self._locks = {}
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        addresses = ", ".join(str(sock.getsockname()) for sock in server.sockets)
+        logger.info(f"文件接收端已启动: {addresses}，保存目录: {self.storage_dir}")
+        async with server:
+            await server.serve_forever()
+
+    async def handle_connection(self, reader, writer):
+        peer = writer.get_extra_info("peername")
+        try:
+            head = await reader.readexactly(4)
+            if head == PROTOCOL_MAGIC:
+                version = (await reader.readexactly(1))[0]
+                if version != PROTOCOL_VERSION:
+                    logger.warning(f"{peer} 请求了不支持的协议版本 {version}")
+                    return
+                writer.write(PROTOCOL_MAGIC + bytes([PROTOCOL_VERSION]))
+                await writer.drain()
+                await self._serve_v2(reader, writer)
+            else:
+                await self._serve_v1(reader, writer, head)
+        except asyncio.IncompleteReadError:
+            # 客户端关闭连接
+            pass
+        except (ConnectionError, OSError, ValueError) as e:
+            logger.warning(f"处理 {peer} 的连接时出错: {e}")
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    async def _serve_v1(self, reader, writer, head):
+        loop = asyncio.get_running_loop()
+        while True:
+            name_len = struct.unpack(">I", head)[0]
+            name = _safe_name((await reader.readexactly(name_len)).decode("utf-8"))
+            size = struct.unpack(">Q", await reader.readexactly(8))[0]
+            if size > MAX_FILE_SIZE:
+                raise ValueError(f"文件过大: {size} 字节")
+            path = self.storage_dir / name
+            with open(path, "wb") as f:
+                await _receive_into(loop, reader, f, size)
+            logger.info(f"已接收文件 {path}（{size} 字节）")
+            writer.write(_encode_string(str(path)))
+            await writer.drain()
+            head = await reader.readexactly(4)
+
+    async def _serve_v2(self, reader, writer):
+        while True:
+            kind = await reader.readexactly(1)
+            if kind != b"O":
+                raise ValueError(f"无法识别的消息类型: {kind!r}")
+            digest = await reader.readexactly(32)
+            size, name_len = struct.unpack(">QH", await reader.readexactly(10))
+            name = _safe_name((await reader.readexactly(name_len)).decode("utf-8"))
+            if size > MAX_FILE_SIZE:
+                raise ValueError(f"文件过大: {size} 字节")
+            hex_digest = digest.hex()
+            entry = self._locks.setdefault(hex_digest, [asyncio.Lock(), 0])
+            entry[1] += 1
+            try:
+                async with entry[0]:
+                    await self._receive_v2(reader, writer, digest, size, name)
+            finally:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    self._locks.pop(hex_digest, None)
+
+    async def _receive_v2(self, reader, writer, digest, size, name):
+        loop = asyncio.get_running_loop()
+        hex_digest = digest.hex()
+        final_path = self.storage_dir / f"{hex_digest}{os.path.splitext(name)[1][:16]}"
+
+        if final_path.is_file() and final_path.stat().st_size == size:
+            logger.info(f"已有相同文件 {final_path}，跳过上传")
+            writer.write(b"H" + _encode_string(str(final_path)))
+            await writer.drain()
+            return
+
+        partial_path = self.partial_dir / hex_digest
+        offset = partial_path.stat().st_size if partial_path.is_file() else 0
+        if offset > size:
+            offset = 0
+        # 续传前先计算已收到部分的哈希
+        hasher = await loop.run_in_executor(None, _hash_prefix, partial_path, offset)
+        writer.write(b"R" + struct.pack(">Q", offset))
+        await writer.drain()
+        if offset:
+            logger.info(f"{name} 从 {offset}/{size} 字节处续传")
+
+        with open(partial_path, "r+b" if offset else "wb") as f:
+            f.seek(offset)
+            f.truncate()
+            await _receive_into(loop, reader, f, size - offset, hasher)
+
+        if hasher.digest() != digest:
+            partial_path.unlink(missing_ok=True)
+            logger.warning(f"{name} 校验失败，已丢弃")
+            writer.write(b"E" + _encode_string("SHA-256 校验失败"))
+        else:
+            os.replace(partial_path, final_path)
+            logger.info(f"已接收文件 {final_path}（{size} 字节）")
+            writer.write(b"D" + _encode_string(str(final_path)))
+        await writer.drain()
+
+
+async def _receive_into(loop, reader, f, count, hasher=None):
+    """从连接读取 count 个字节写入文件，每块写入后立即落盘，连接中断时已收到的数据可用于续传"""
+    remaining = count
+    while remaining > 0:
+        data = await reader.read(min(CHUNK_SIZE, remaining))
+        if not data:
+            raise asyncio.IncompleteReadError(b"", remaining)
+        if hasher is not None:
+            hasher.update(data)
+        await loop.run_in_executor(None, _write_chunk, f, data)
+        remaining -= len(data)
+
+
+def _write_chunk(f, data):
+    f.write(data)
+    f.flush()
+
+
+def _hash_prefix(path, length):
+    hasher = hashlib.sha256()
+    if length:
+        with open(path, "rb") as f:
+            remaining = length
+            while remaining > 0:
+                data = f.read(min(CHUNK_SIZE, remaining))
+                if not data:
+                    break
+                hasher.update(data)
+                remaining -= len(data)
+    return hasher
+
+
+def _safe_name(name):
+    # 只保留文件名部分，防止路径穿越
+    name = os.path.basename(name.replace("\\", "/"))
+    if name in ("", ".", ".."):
+        raise ValueError("无效的文件名")
+    return name
+
+
+def _encode_string(value):
+    data = value.encode("utf-8")
+    return struct.pack(">I", len(data)) + data
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AstrBot 图像插件文件接收端")
+    parser.add_argument("--host", default="0.0.0.0", help="监听地址")
+    parser.add_argument("--port", type=int, default=3658, help="监听端口")
+    parser.add_argument("--dir", default="received_files", help="文件保存目录")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    try:
+        asyncio.run(FileReceiveServer(args.dir).serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,59 +1,445 @@
 import asyncio
+import hashlib
 import os
 import struct
+from collections import deque
 from astrbot.api import logger
+from .workers import run_cpu_bound
 
-async def send_file(filename, host, port):
-    reader = None
-    writer = None
-    try:
-        reader, writer = await asyncio.open_connection(host, port)
-        file_name = os.path.basename(filename)
-        file_name_bytes = file_name.encode("utf-8")
+# 无法使用 sendfile 时每次读取的块大小
+READ_CHUNK_SIZE = 1024 * 1024
+# 等待接收端返回文件路径的超时时间（秒）
+REPLY_TIMEOUT = 60
 
-        # 发送文件名长度和文件名
-        writer.write(struct.pack(">I", len(file_name_bytes)))
-        writer.write(file_name_bytes)
+# 协议 v2 握手：客户端发送 MAGIC + 版本号，支持 v2 的接收端原样回复。协议细节见 file_receive_server.py
+PROTOCOL_MAGIC = b"BNFT"
+PROTOCOL_VERSION = 2
+# 等待握手回复的超时时间（秒）
+HELLO_TIMEOUT = 3
+# v2 上传中断后最多续传的次数
+RESUME_ATTEMPTS = 3
 
-        # 发送文件大小
-        file_size = os.path.getsize(filename)
-        writer.write(struct.pack(">Q", file_size))
 
-        # 发送文件内容
+class FileRejectedError(IOError):
+    """接收端校验文件失败（协议 v2 的 E 回复），已丢弃收到的数据"""
+
+
+def _file_sha256(filename):
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        while True:
+            data = f.read(READ_CHUNK_SIZE)
+            if not data:
+                break
+            digest.update(data)
+    return digest.digest()
+
+
+async def _write_file(writer, filename, offset, size):
+    """将文件从 offset 开始的内容写入连接，优先使用 sendfile 零拷贝发送"""
+    loop = asyncio.get_running_loop()
+    with open(filename, "rb") as f:
         await writer.drain()
-        with open(filename, "rb") as f:
+        count = size - offset
+        if count <= 0:
+            return
+        try:
+            # 零拷贝发送：由内核直接从文件写入套接字；不支持时 asyncio 会退回到线程池分块读取
+            sent = await loop.sendfile(writer.transport, f, offset, count)
+            if sent == count:
+                return
+            f.seek(offset + sent)
+        except NotImplementedError:
+            sent = 0
+            f.seek(offset)
+        # 事件循环没有实现 sendfile（例如部分第三方事件循环）时，以大块异步读取的方式发送
+        remaining = count - sent
+        while remaining > 0:
+            data = await loop.run_in_executor(None, f.read, min(READ_CHUNK_SIZE, remaining))
+            if not data:
+                raise IOError("文件在发送过程中被截断")
+            writer.write(data)
+            await writer.drain()
+            remaining -= len(data)
+
+
+class _FileConnection:
+    """
+    与文件接收端之间的一条持久连接（协议 v1）
+
+    每个文件一帧：文件名长度(>I) + 文件名 + 文件大小(>Q) + 文件内容，接收端按顺序返回：路径长度(>I) + 路径。
+    帧可以连续写出而无需等待上一个文件的回复（流水线），回复按发送顺序与等待中的请求一一对应。
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.pending = deque()
+        self.replies = 0
+        self.closed = False
+        self._write_lock = asyncio.Lock()
+        self._reader_task = asyncio.get_running_loop().create_task(self._read_replies())
+
+    @property
+    def load(self):
+        return len(self.pending) + (1 if self._write_lock.locked() else 0)
+
+    async def send(self, filename, file_name_bytes, file_size):
+        """写出一个文件帧，返回等待接收端回复的 Future"""
+        loop = asyncio.get_running_loop()
+        async with self._write_lock:
+            if self.closed:
+                raise ConnectionResetError("连接已关闭")
+            future = loop.create_future()
+            # 在写出之前登记，保证回复顺序与帧顺序一致
+            self.pending.append(future)
+            try:
+                self.writer.write(
+                    struct.pack(">I", len(file_name_bytes)) + file_name_bytes + struct.pack(">Q", file_size)
+                )
+                await _write_file(self.writer, filename, 0, file_size)
+            except BaseException as e:
+                # 帧只写出了一部分，后续数据无法再对齐，这条连接必须废弃
+                future.cancel()
+                self._abort(e if isinstance(e, Exception) else ConnectionResetError("发送被取消"))
+                raise
+        return future
+
+    async def _read_replies(self):
+        error = None
+        try:
             while True:
-                data = f.read(4096)
-                if not data:
-                    break
-                writer.write(data)
-                await writer.drain()
-        logger.info(f"文件 {file_name} 发送成功")
+                header = await self.reader.readexactly(4)
+                path_len = struct.unpack(">I", header)[0]
+                path = (await self.reader.readexactly(path_len)).decode("utf-8")
+                self.replies += 1
+                if self.pending:
+                    future = self.pending.popleft()
+                    if not future.done():
+                        future.set_result(path)
+                else:
+                    logger.warning(f"收到多余的接收端回复: {path}")
+        except asyncio.IncompleteReadError:
+            error = ConnectionResetError("接收端关闭了连接")
+        except asyncio.CancelledError:
+            self._abort(ConnectionResetError("连接已关闭"))
+            raise
+        except (ConnectionError, OSError, UnicodeDecodeError) as e:
+            error = e
+        self._abort(error)
+
+    def _abort(self, error):
+        if not self.closed:
+            self.closed = True
+            self.writer.close()
+        while self.pending:
+            future = self.pending.popleft()
+            if not future.done():
+                future.set_exception(error)
 
-        # 接收接收端发送的文件绝对路径
-        # 接收文件绝对路径
+    async def close(self):
+        self._abort(ConnectionResetError("连接已关闭"))
+        self._reader_task.cancel()
+        await asyncio.gather(self._reader_task, return_exceptions=True)
         try:
-            file_abs_path_len_data = await recv_all(reader, 4)
-            if not file_abs_path_len_data:
-                logger.error("无法接收文件绝对路径长度")
-                return None
-            file_abs_path_len = struct.unpack(">I", file_abs_path_len_data)[0]
+            await self.writer.wait_closed()
+        except Exception:
+            pass
 
-            file_abs_path_data = await recv_all(reader, file_abs_path_len)
-            if not file_abs_path_data:
-                logger.error("无法接收文件绝对路径")
-                return None
-            file_abs_path = file_abs_path_data.decode("utf-8")
-            logger.info(f"接收端文件绝对路径: {file_abs_path}")
-            return file_abs_path
-        except (struct.error, UnicodeDecodeError) as e:
-            logger.error(f"解析服务器响应失败: {e}")
-            return None
-        except (ConnectionError, TimeoutError) as e:
-            logger.error(f"网络连接错误: {e}")
+
+class _FileConnectionV2:
+    """
+    与文件接收端之间的一条持久连接（协议 v2）
+
+    每个文件先发送内容哈希，接收端已有相同文件时直接返回路径；否则返回已收到的字节数，客户端从该位置继续上传。
+    一次交换包含多个往返，因此同一条连接上的文件依次发送，并发由连接池中的多条连接提供。
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.closed = False
+        self._lock = asyncio.Lock()
+
+    @property
+    def load(self):
+        return 1 if self._lock.locked() else 0
+
+    async def hello(self):
+        """
+        握手，确认接收端支持协议 v2
+
+        Returns:
+            bool: 接收端是否支持
+        """
+        self.writer.write(PROTOCOL_MAGIC + bytes([PROTOCOL_VERSION]))
+        await self.writer.drain()
+        try:
+            reply = await asyncio.wait_for(self.reader.readexactly(len(PROTOCOL_MAGIC) + 1), HELLO_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            return False
+        return reply == PROTOCOL_MAGIC + bytes([PROTOCOL_VERSION])
+
+    async def send(self, filename, file_name_bytes, file_size, digest):
+        """
+        发送一个文件
+
+        Returns:
+            tuple: (接收端文件绝对路径, 实际上传的字节数)
+        """
+        async with self._lock:
+            if self.closed:
+                raise ConnectionResetError("连接已关闭")
+            try:
+                self.writer.write(
+                    b"O" + digest + struct.pack(">QH", file_size, len(file_name_bytes)) + file_name_bytes
+                )
+                await self.writer.drain()
+                kind = await self._read_exactly(1)
+                if kind == b"H":
+                    return await self._read_string(), 0
+                if kind != b"R":
+                    raise ConnectionError(f"无法识别的接收端回复: {kind!r}")
+                offset = struct.unpack(">Q", await self._read_exactly(8))[0]
+                if offset > file_size:
+                    raise ConnectionError(f"接收端返回的续传位置无效: {offset}")
+                if offset:
+                    logger.info(f"从接收端已确认的 {offset}/{file_size} 字节处继续上传")
+                await _write_file(self.writer, filename, offset, file_size)
+                kind = await self._read_exactly(1)
+                if kind == b"D":
+                    return await self._read_string(), file_size - offset
+                if kind == b"E":
+                    raise FileRejectedError(f"接收端拒绝了文件: {await self._read_string()}")
+                raise ConnectionError(f"无法识别的接收端回复: {kind!r}")
+            except BaseException:
+                # 交换中途出错时无法确定连接状态，直接废弃
+                self._abort()
+                raise
+
+    async def _read_exactly(self, n):
+        try:
+            return await asyncio.wait_for(self.reader.readexactly(n), REPLY_TIMEOUT)
+        except asyncio.IncompleteReadError:
+            raise ConnectionResetError("接收端关闭了连接")
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"等待接收端回复超时（{REPLY_TIMEOUT} 秒）")
+
+    async def _read_string(self):
+        length = struct.unpack(">I", await self._read_exactly(4))[0]
+        return (await self._read_exactly(length)).decode("utf-8")
+
+    def _abort(self):
+        if not self.closed:
+            self.closed = True
+            self.writer.close()
+
+    async def close(self):
+        self._abort()
+        try:
+            await self.writer.wait_closed()
+        except Exception:
+            pass
+
+
+class FileSendChannel:
+    """
+    到某个文件接收端的连接池
+
+    协议版本由配置决定，不向接收端试探：v1 接收端会把 v2 握手当作文件名长度读取（约 1.1 GB）。
+    - v2：先发送内容哈希，接收端已有相同文件时跳过上传，上传中断后从接收端已确认的位置续传
+    - v1：多个文件可以复用同一条持久连接并以流水线方式连续发送。
+      旧版接收端每个连接只处理一个文件，检测到这种情况后自动退回到每个文件一条连接的方式
+    """
+
+    def __init__(self, host, port, max_connections=2, protocol="v1"):
+        self.host = host
+        self.port = port
+        self.max_connections = max(1, int(max_connections))
+        # 旧配置中的 auto 按 v1 处理
+        self.protocol = protocol if protocol in ("v1", "v2") else "v1"
+        self.version = 2 if self.protocol == "v2" else 1
+        # 接收端是否支持在一条连接上处理多个文件（仅 v1），首次确认之前按不支持处理
+        self.pipelining = None
+        # 连接复用检测只进行一次，并发的首批发送共同等待同一个检测任务
+        self._probe = None
+        self.bytes_skipped = 0
+        self._connections = []
+        self._lock = asyncio.Lock()
+
+    async def _open(self):
+        return await asyncio.wait_for(asyncio.open_connection(self.host, self.port), REPLY_TIMEOUT)
+
+    async def _open_v2(self):
+        conn = _FileConnectionV2(*await self._open())
+        if not await conn.hello():
+            await conn.close()
             return None
-            
-    except (ConnectionError, TimeoutError) as e:
+        return conn
+
+    async def _acquire(self):
+        async with self._lock:
+            self._connections = [conn for conn in self._connections if not conn.closed]
+            if self.version == 2 or self.pipelining:
+                idle = [conn for conn in self._connections if conn.load == 0]
+                if idle:
+                    return idle[0], True
+                if len(self._connections) >= self.max_connections:
+                    return min(self._connections, key=lambda conn: conn.load), True
+            if self.version == 2:
+                conn = await self._open_v2()
+                if conn is None:
+                    raise ConnectionError("接收端不支持协议 v2，请将 nap_protocol 设置为 v1 或更新接收端")
+            else:
+                conn = _FileConnection(*await self._open())
+            if self.version == 2 or self.pipelining:
+                self._connections.append(conn)
+            return conn, False
+
+    async def send(self, filename):
+        """
+        发送文件并返回接收端保存的绝对路径
+
+        Args:
+            filename (str): 本地文件路径
+
+        Returns:
+            str: 接收端文件绝对路径
+        """
+        file_name_bytes = os.path.basename(filename).encode("utf-8")
+        file_size = os.path.getsize(filename)
+        conn, reused = await self._acquire()
+        if self.version == 2:
+            return await self._send_v2(conn, filename, file_name_bytes, file_size)
+
+        # 复用的连接可能已被接收端关闭，此时在新连接上重发一次
+        for attempt in range(2):
+            if attempt:
+                conn, reused = await self._acquire()
+            try:
+                future = await conn.send(filename, file_name_bytes, file_size)
+                path = await asyncio.wait_for(future, REPLY_TIMEOUT)
+            except (ConnectionError, asyncio.IncompleteReadError) as e:
+                if attempt == 0 and reused:
+                    logger.debug(f"复用的连接已断开，重新连接: {e}")
+                    continue
+                raise
+            except asyncio.TimeoutError:
+                await conn.close()
+                raise TimeoutError(f"等待接收端回复超时（{REPLY_TIMEOUT} 秒）")
+            await self._release(conn)
+            return path
+
+    async def _send_v2(self, conn, filename, file_name_bytes, file_size):
+        digest = await run_cpu_bound(_file_sha256, filename)
+        rejected = False
+        for attempt in range(RESUME_ATTEMPTS + 1):
+            if attempt:
+                conn, _ = await self._acquire()
+            try:
+                path, uploaded = await conn.send(filename, file_name_bytes, file_size, digest)
+            except FileRejectedError as e:
+                # 接收端已丢弃损坏的部分数据，再从头上传一次
+                if rejected or attempt == RESUME_ATTEMPTS:
+                    raise
+                rejected = True
+                logger.warning(f"{e}，从头重新上传")
+                continue
+            except (ConnectionError, TimeoutError) as e:
+                if attempt == RESUME_ATTEMPTS:
+                    raise
+                logger.warning(f"文件传输中断，重新连接后续传: {e}")
+                continue
+            skipped = file_size - uploaded
+            self.bytes_skipped += skipped
+            if uploaded == 0:
+                logger.info("接收端已有相同文件，跳过上传")
+            elif skipped:
+                logger.info(f"续传完成，节省了 {skipped} 字节")
+            return path
+
+    async def _probe_pipelining(self, conn):
+        """收到第一个回复后观察连接是否被接收端关闭，以判断接收端是否支持一条连接处理多个文件"""
+        await asyncio.wait({conn._reader_task}, timeout=0.2)
+        self.pipelining = not conn.closed
+        if self.pipelining:
+            logger.info(f"文件接收端 {self.host}:{self.port} 支持连接复用，后续文件将以流水线方式发送")
+        return self.pipelining
+
+    async def _release(self, conn):
+        """v1 文件发送完成后将连接放回连接池；接收端不支持连接复用或连接池已满时关闭连接"""
+        if self.pipelining is None:
+            if self._probe is None:
+                self._probe = asyncio.get_running_loop().create_task(self._probe_pipelining(conn))
+            await asyncio.shield(self._probe)
+        async with self._lock:
+            if conn in self._connections:
+                return
+            self._connections = [c for c in self._connections if not c.closed]
+            if self.pipelining and not conn.closed and len(self._connections) < self.max_connections:
+                self._connections.append(conn)
+                return
+        await conn.close()
+
+    async def close(self):
+        async with self._lock:
+            connections, self._connections = self._connections, []
+        await asyncio.gather(*(conn.close() for conn in connections), return_exceptions=True)
+
+
+# 按 (地址, 端口) 缓存的连接池
+_channels = {}
+_max_connections = 2
+_protocol = "v1"
+
+
+def configure_file_channels(max_connections=None, protocol=None):
+    """
+    配置文件传输连接池
+
+    Args:
+        max_connections (int): 每个接收端的最大并发连接数
+        protocol (str): v1 / v2，其他值按 v1 处理
+    """
+    global _max_connections, _protocol
+    if max_connections is not None:
+        _max_connections = max(1, int(max_connections))
+    if protocol is not None:
+        _protocol = protocol
+
+
+async def close_file_channels():
+    """关闭所有文件传输连接，在插件卸载时调用"""
+    channels = list(_channels.values())
+    _channels.clear()
+    await asyncio.gather(*(channel.close() for channel in channels), return_exceptions=True)
+
+
+async def send_file(filename, host, port):
+    """
+    将文件发送到远程文件接收端
+
+    Args:
+        filename (str): 本地文件路径
+        host (str): 接收端地址
+        port (int): 接收端端口
+
+    Returns:
+        str or None: 接收端文件绝对路径，失败时返回None
+    """
+    file_name = os.path.basename(filename)
+    channel = _channels.get((host, port))
+    if channel is None:
+        channel = _channels[(host, port)] = FileSendChannel(host, port, _max_connections, _protocol)
+    try:
+        file_abs_path = await channel.send(filename)
+        logger.info(f"文件 {file_name} 发送成功")
+        logger.info(f"接收端文件绝对路径: {file_abs_path}")
+        return file_abs_path
+    except (struct.error, UnicodeDecodeError) as e:
+        logger.error(f"解析服务器响应失败: {e}")
+        return None
+    except (ConnectionError, TimeoutError, asyncio.IncompleteReadError) as e:
         logger.error(f"网络连接失败: {e}")
         return None
     except (OSError, IOError) as e:
@@ -62,23 +448,16 @@ async def send_file(filename, host, port):
     except Exception as e:
         logger.error(f"传输失败: {e}")
         return None
-    finally:
-        # 确保资源被正确释放
-        if writer:
-            try:
-                writer.close()
-                await writer.wait_closed()
-            except Exception as e:
-                logger.warning(f"关闭连接时出错: {e}")
+
 
 async def recv_all(reader, n):
     """
     安全地接收指定数量的字节
-    
+
     Args:
         reader: AsyncIO stream reader
         n (int): 要接收的字节数
-        
+
     Returns:
         bytes or None: 接收到的数据，失败时返回None
     """
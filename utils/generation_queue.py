@@ -0,0 +1,241 @@
+import asyncio
+import itertools
+from astrbot.api import logger
+
+
+class QueueFullError(Exception):
+    """排队请求过多，拒绝新的生成请求"""
+
+
+class _BatchToken:
+    """同一批次请求共享的用户名额，批次中的请求全部释放后才归还"""
+    def __init__(self):
+        self.remaining = 0
+
+
+class GenerationTicket:
+    """
+    生成队列中的一个请求
+
+    用法:
+        ticket = queue.enter(session, user)
+        try:
+            await ticket.wait()
+            ...
+        finally:
+            ticket.release()
+    """
+    def __init__(self, queue, session, user, start_tag, finish_tag, seq, batch=None):
+        self._queue = queue
+        self.session = session
+        self.user = user
+        self.batch = batch
+        self.start_tag = start_tag
+        self.finish_tag = finish_tag
+        self.seq = seq
+        self._granted = asyncio.get_running_loop().create_future()
+        self._released = False
+
+    @property
+    def granted(self):
+        return self._granted.done() and not self._granted.cancelled()
+
+    @property
+    def position(self):
+        """排队位置（从1开始），已获得执行名额时为0"""
+        return self._queue._position(self)
+
+    async def wait(self):
+        """等待轮到该请求执行"""
+        await asyncio.shield(self._granted)
+
+    def release(self):
+        """释放执行名额或退出排队，可重复调用"""
+        if not self._released:
+            self._released = True
+            self._queue._release(self)
+
+
+class FairGenerationQueue:
+    """
+    带准入控制的绘图请求队列
+
+    全局最多同时执行 max_concurrency 个生成请求，其余请求排队等待。
+    排队请求按会话（群聊或私聊）做加权公平调度（start-time fair queuing）：
+    每个会话按权重分到执行机会，单个繁忙群的大量请求不会挤占其他会话。
+    队列已满或同一用户排队过多时直接拒绝。
+    """
+
+    def __init__(self):
+        self.max_concurrency = 2
+        self.max_queue = 20
+        self.max_per_user = 3
+        self.weights = {}
+        self._running = 0
+        self._waiting = []
+        self._virtual_time = 0.0
+        # 会话 -> 最近一个请求的虚拟完成时间
+        self._session_finish = {}
+        # 会话 / 用户 -> 排队中和执行中的请求数
+        self._session_count = {}
+        self._user_count = {}
+        self._seq = itertools.count()
+
+    def configure(self, max_concurrency=None, max_queue=None, max_per_user=None, weights=None):
+        """更新队列参数"""
+        if max_concurrency is not None:
+            self.max_concurrency = max(1, int(max_concurrency))
+        if max_queue is not None:
+            self.max_queue = max(0, int(max_queue))
+        if max_per_user is not None:
+            self.max_per_user = max(0, int(max_per_user))
+        if weights is not None:
+            self.weights = {session: max(0.01, float(weight)) for session, weight in weights.items()}
+
+    def enter(self, session, user=None):
+        """
+        提交一个生成请求
+
+        Args:
+            session (str): 会话标识（unified_msg_origin）
+            user (str): 发送者ID，用于限制单个用户的排队数量
+
+        Returns:
+            GenerationTicket: 请求凭证，position 为0表示可以立即执行
+
+        Raises:
+            QueueFullError: 队列已满或该用户排队的请求过多
+        """
+        return self._enter(session, user)
+
+    def _enter(self, session, user, batch=None):
+        # 同一批次只在提交第一个请求时检查并占用用户名额
+        counts_user = user is not None and (batch is None or batch.remaining == 0)
+        if self.max_per_user and counts_user and self._user_count.get(user, 0) >= self.max_per_user:
+            raise QueueFullError(f"您已有 {self._user_count[user]} 个绘图请求在处理中，请等待完成后再试")
+        can_run_now = self._running < self.max_concurrency and not self._waiting
+        if not can_run_now and len(self._waiting) >= self.max_queue:
+            raise QueueFullError(f"当前排队的绘图请求已满（{len(self._waiting)} 个），请稍后再试")
+
+        # 会话的新请求从“当前虚拟时间”与“该会话上一个请求完成时间”中较晚的一个开始，
+        # 权重越高，每个请求占用的虚拟时间越短，分到的执行机会越多
+        start_tag = max(self._virtual_time, self._session_finish.get(session, 0.0))
+        finish_tag = start_tag + 1.0 / self.weights.get(session, 1.0)
+        self._session_finish[session] = finish_tag
+        self._session_count[session] = self._session_count.get(session, 0) + 1
+        if counts_user:
+            self._user_count[user] = self._user_count.get(user, 0) + 1
+        if batch is not None:
+            batch.remaining += 1
+
+        ticket = GenerationTicket(self, session, user, start_tag, finish_tag, next(self._seq), batch)
+        if can_run_now:
+            self._grant(ticket)
+        else:
+            self._waiting.append(ticket)
+            logger.info(f"绘图请求进入排队，当前第 {ticket.position} 位（执行中 {self._running} 个）")
+        return ticket
+
+    def enter_batch(self, session, user=None, count=1):
+        """
+        一次提交同一批次的多个生成请求（例如同一提示词的多个变体）
+
+        每个请求各占一个执行名额并参与公平调度，但整批只计为该用户的一个请求，
+        该名额在整批请求全部释放后才归还；排队空间不足以容纳整批时整批拒绝。
+
+        Args:
+            session (str): 会话标识（unified_msg_origin）
+            user (str): 发送者ID
+            count (int): 请求数量
+
+        Returns:
+            list: [GenerationTicket]
+
+        Raises:
+            QueueFullError: 队列已满或该用户排队的请求过多
+        """
+        count = max(1, int(count))
+        free_slots = 0 if self._waiting else max(0, self.max_concurrency - self._running)
+        must_wait = count - free_slots
+        if must_wait > 0 and len(self._waiting) + must_wait > self.max_queue:
+            raise QueueFullError(f"当前排队的绘图请求过多（{len(self._waiting)} 个），无法容纳 {count} 张图片的批量请求，请稍后再试")
+        batch = _BatchToken()
+        return [self._enter(session, user, batch) for _ in range(count)]
+
+    def stats(self):
+        """
+        Returns:
+            dict: running / waiting / max_concurrency / max_queue / sessions
+        """
+        return {
+            "running": self._running,
+            "waiting": len(self._waiting),
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "sessions": len(self._session_count),
+        }
+
+    def _position(self, ticket):
+        if ticket.granted:
+            return 0
+        key = (ticket.finish_tag, ticket.seq)
+        return 1 + sum(1 for other in self._waiting if (other.finish_tag, other.seq) < key)
+
+    def _grant(self, ticket):
+        self._running += 1
+        self._virtual_time = max(self._virtual_time, ticket.start_tag)
+        ticket._granted.set_result(None)
+
+    def _release(self, ticket):
+        if ticket.granted:
+            self._running -= 1
+        else:
+            self._waiting.remove(ticket)
+            ticket._granted.cancel()
+
+        count = self._session_count[ticket.session] - 1
+        if count:
+            self._session_count[ticket.session] = count
+        else:
+            # 会话不再有请求时清除其记录，之后的新请求从当前虚拟时间开始
+            del self._session_count[ticket.session]
+            self._session_finish.pop(ticket.session, None)
+        if ticket.batch is not None:
+            ticket.batch.remaining -= 1
+        if ticket.user is not None and (ticket.batch is None or ticket.batch.remaining == 0):
+            count = self._user_count[ticket.user] - 1
+            if count:
+                self._user_count[ticket.user] = count
+            else:
+                del self._user_count[ticket.user]
+        self._dispatch()
+
+    def _dispatch(self):
+        while self._running < self.max_concurrency and self._waiting:
+            ticket = min(self._waiting, key=lambda item: (item.finish_tag, item.seq))
+            self._waiting.remove(ticket)
+            self._grant(ticket)
+
+
+# 全局生成队列实例
+_queue = FairGenerationQueue()
+
+
+def configure_generation_queue(**kwargs):
+    """
+    配置生成队列
+
+    Args:
+        **kwargs: max_concurrency / max_queue / max_per_user / weights
+    """
+    _queue.configure(**kwargs)
+
+
+def get_generation_queue():
+    """
+    获取全局生成队列
+
+    Returns:
+        FairGenerationQueue: 生成队列
+    """
+    return _queue
@@ -0,0 +1,103 @@
+from collections import deque
+
+
+class HedgePolicy:
+    """
+    对冲请求策略
+
+    记录近期成功请求的耗时，首个请求超过指定分位数耗时仍未返回时，
+    允许换一个密钥再发起一次请求。对冲次数通过令牌桶限制在总请求量的一定比例以内。
+    """
+
+    # 计算分位数时使用的最近样本数
+    HISTORY_SIZE = 200
+    # 样本不足时不使用分位数，而使用默认延迟
+    MIN_SAMPLES = 20
+
+    def __init__(self):
+        self.enabled = False
+        self.percentile = 90
+        self.max_ratio = 0.1
+        self.min_delay = 3.0
+        self.default_delay = 20.0
+        self._latencies = deque(maxlen=self.HISTORY_SIZE)
+        self._tokens = 1.0
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def configure(self, enabled=None, percentile=None, max_ratio=None, min_delay=None, default_delay=None):
+        """更新对冲策略参数"""
+        if enabled is not None:
+            self.enabled = bool(enabled)
+        if percentile is not None:
+            self.percentile = min(max(float(percentile), 1.0), 99.9)
+        if max_ratio is not None:
+            self.max_ratio = min(max(float(max_ratio), 0.0), 1.0)
+        if min_delay is not None:
+            self.min_delay = max(float(min_delay), 0.0)
+        if default_delay is not None:
+            self.default_delay = max(float(default_delay), 0.0)
+
+    def record_latency(self, latency):
+        """记录一次成功请求的耗时（秒）"""
+        self._latencies.append(latency)
+
+    def hedge_delay(self):
+        """
+        计算发起对冲请求前需要等待的时间
+
+        Returns:
+            float: 等待秒数
+        """
+        if len(self._latencies) < self.MIN_SAMPLES:
+            return max(self.default_delay, self.min_delay)
+        samples = sorted(self._latencies)
+        index = min(len(samples) - 1, int(len(samples) * self.percentile / 100))
+        return max(samples[index], self.min_delay)
+
+    def on_request(self):
+        """每个主请求调用一次，为对冲预算补充令牌"""
+        self.requests += 1
+        self._tokens = min(self._tokens + self.max_ratio, max(1.0, self.max_ratio * 10))
+
+    def try_acquire(self):
+        """
+        尝试消耗一次对冲预算
+
+        Returns:
+            bool: 预算充足返回 True
+        """
+        if not self.enabled or self._tokens < 1.0:
+            return False
+        self._tokens -= 1.0
+        self.hedges += 1
+        return True
+
+    def record_win(self):
+        """记录一次对冲请求先于主请求完成"""
+        self.hedge_wins += 1
+
+
+# 全局对冲策略实例
+_policy = HedgePolicy()
+
+
+def configure_hedging(**kwargs):
+    """
+    配置对冲请求策略
+
+    Args:
+        **kwargs: enabled / percentile / max_ratio / min_delay / default_delay
+    """
+    _policy.configure(**kwargs)
+
+
+def get_hedge_policy():
+    """
+    获取全局对冲策略
+
+    Returns:
+        HedgePolicy: 对冲策略
+    """
+    return _policy
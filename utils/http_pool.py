@@ -0,0 +1,87 @@
+import asyncio
+import aiohttp
+from astrbot.api import logger
+
+
+class HttpSessionPool:
+    """插件共享的 aiohttp 连接池，避免每次请求重复进行 DNS/TCP/TLS 握手"""
+    def __init__(self):
+        self.limit = 100
+        self.limit_per_host = 8
+        self.keepalive_timeout = 60
+        self.dns_cache_ttl = 300
+        self._session = None
+        self._lock = asyncio.Lock()
+
+    def configure(self, limit=None, limit_per_host=None, keepalive_timeout=None, dns_cache_ttl=None):
+        """更新连接器参数，已创建的会话不受影响，关闭后重新创建时生效"""
+        if limit is not None:
+            self.limit = int(limit)
+        if limit_per_host is not None:
+            self.limit_per_host = int(limit_per_host)
+        if keepalive_timeout is not None:
+            self.keepalive_timeout = float(keepalive_timeout)
+        if dns_cache_ttl is not None:
+            self.dns_cache_ttl = int(dns_cache_ttl)
+
+    async def get_session(self):
+        """获取共享会话，首次调用或会话被关闭后会重新创建"""
+        if self._session is not None and not self._session.closed:
+            return self._session
+        async with self._lock:
+            if self._session is None or self._session.closed:
+                connector = aiohttp.TCPConnector(
+                    limit=self.limit,
+                    limit_per_host=self.limit_per_host,
+                    keepalive_timeout=self.keepalive_timeout,
+                    ttl_dns_cache=self.dns_cache_ttl,
+                    use_dns_cache=self.dns_cache_ttl > 0,
+                )
+                # 会话本身不设置总超时，由每个请求单独指定
+                self._session = aiohttp.ClientSession(
+                    connector=connector,
+                    timeout=aiohttp.ClientTimeout(total=None),
+                )
+                logger.debug(
+                    f"已创建共享HTTP会话 (limit={self.limit}, limit_per_host={self.limit_per_host}, "
+                    f"keepalive={self.keepalive_timeout}s, dns_ttl={self.dns_cache_ttl}s)"
+                )
+            return self._session
+
+    async def close(self):
+        """关闭共享会话并释放所有连接"""
+        async with self._lock:
+            session = self._session
+            self._session = None
+        if session is not None and not session.closed:
+            await session.close()
+            logger.info("共享HTTP会话已关闭")
+
+
+# 全局连接池实例
+_pool = HttpSessionPool()
+
+
+def configure_http_pool(**kwargs):
+    """
+    配置共享连接池参数
+
+    Args:
+        **kwargs: limit / limit_per_host / keepalive_timeout / dns_cache_ttl
+    """
+    _pool.configure(**kwargs)
+
+
+async def get_http_session():
+    """
+    获取插件共享的 aiohttp 会话
+
+    Returns:
+        aiohttp.ClientSession: 共享会话
+    """
+    return await _pool.get_session()
+
+
+async def close_http_session():
+    """关闭插件共享的 aiohttp 会话，在插件卸载时调用"""
+    await _pool.close()
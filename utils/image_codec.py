@@ -0,0 +1,329 @@
+import asyncio
+import base64
+import binascii
+import io
+import time
+from astrbot.api import logger
+from .workers import run_cpu_bound, run_in_process
+from .metrics import get_metrics
+
+try:
+    from PIL import Image as PILImage, ImageOps
+except ImportError:  # Pillow 为可选依赖，缺失时只做格式识别
+    PILImage = None
+    ImageOps = None
+
+
+_MIME_TYPES = {
+    "png": "image/png",
+    "jpeg": "image/jpeg",
+    "webp": "image/webp",
+    "gif": "image/gif",
+    "bmp": "image/bmp",
+}
+
+_PIL_FORMATS = {"jpeg": "JPEG", "webp": "WEBP"}
+
+
+def sniff_image_format(data):
+    """
+    根据文件头识别图片格式
+
+    Args:
+        data (bytes): 图片数据（至少前12个字节）
+
+    Returns:
+        str or None: png / jpeg / webp / gif / bmp，无法识别时返回 None
+    """
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if data.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    if data.startswith(b"BM"):
+        return "bmp"
+    return None
+
+
+def sniff_base64_image_format(base64_string):
+    """
+    只解码 base64 开头的少量字符来识别图片格式
+
+    Args:
+        base64_string (str): 不含 data URI 前缀的 base64 图片数据
+
+    Returns:
+        str or None: 图片格式，无法识别时返回 None
+    """
+    try:
+        return sniff_image_format(base64.b64decode(base64_string[:16]))
+    except (binascii.Error, ValueError):
+        return None
+
+
+def image_data_complete(head, tail, size):
+    """
+    根据文件头、文件尾和总长度判断图片数据是否完整（未在传输中被截断）
+
+    Args:
+        head (bytes): 图片数据的前若干字节（至少12个）
+        tail (bytes): 图片数据的最后若干字节（至少12个）
+        size (int): 图片数据总长度
+
+    Returns:
+        bool: 格式可识别且结尾完整时返回 True，无法识别的格式同样返回 True
+    """
+    image_format = sniff_image_format(head)
+    if image_format == "png":
+        return tail.endswith(b"IEND\xaeB`\x82")
+    if image_format == "jpeg":
+        # 部分编码器会在 EOI 之后填充0
+        return tail.rstrip(b"\x00").endswith(b"\xff\xd9")
+    if image_format == "webp":
+        return int.from_bytes(head[4:8], "little") + 8 <= size
+    if image_format == "gif":
+        return tail.endswith(b";")
+    if image_format == "bmp":
+        return int.from_bytes(head[2:6], "little") <= size
+    return True
+
+
+def verify_image(source):
+    """
+    用 Pillow 检查图片能否正常打开（PNG 会校验所有数据块的 CRC），未安装 Pillow 时跳过
+
+    Args:
+        source (bytes or Path): 图片数据或文件路径
+
+    Returns:
+        bool: 图片可以打开，或未安装 Pillow 时返回 True
+    """
+    if PILImage is None:
+        return True
+    try:
+        with PILImage.open(io.BytesIO(source) if isinstance(source, (bytes, bytearray)) else source) as image:
+            image.verify()
+    except Exception:
+        return False
+    return True
+
+
+def to_data_uri(base64_string):
+    """
+    为 base64 图片数据加上与实际格式相符的 data URI 前缀
+
+    Args:
+        base64_string (str): base64 图片数据，已有 data URI 前缀时原样返回
+
+    Returns:
+        str: data URI
+    """
+    if base64_string.startswith("data:image/"):
+        return base64_string
+    return f"{data_uri_prefix(base64_string)}{base64_string}"
+
+
+def data_uri_prefix(base64_string):
+    """
+    Args:
+        base64_string (str): 不含 data URI 前缀的 base64 图片数据
+
+    Returns:
+        str: 与实际格式相符的 data URI 前缀，例如 data:image/png;base64,
+    """
+    image_format = sniff_base64_image_format(base64_string) or "png"
+    return f"data:{_MIME_TYPES[image_format]};base64,"
+
+
+def _encode(image, output_format, quality):
+    """将 Pillow 图像转换为目标格式支持的色彩模式并编码"""
+    has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+    if output_format == "jpeg":
+        if has_alpha:
+            # JPEG 不支持透明通道，合成到白色背景上
+            rgba = image.convert("RGBA")
+            background = PILImage.new("RGB", rgba.size, (255, 255, 255))
+            background.paste(rgba, mask=rgba.getchannel("A"))
+            image = background
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
+    elif image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if has_alpha else "RGB")
+
+    buffer = io.BytesIO()
+    image.save(buffer, format=_PIL_FORMATS[output_format], quality=quality, optimize=True)
+    return buffer.getvalue()
+
+
+def _prepare_reference_image(base64_string, max_edge, quality, output_format):
+    """在工作线程中执行：解码、按最长边缩放并重新编码一张参考图片"""
+    if base64_string.startswith("data:image/"):
+        base64_string = base64_string.split(",", 1)[1]
+    raw = base64.b64decode(base64_string)
+    source_format = sniff_image_format(raw)
+
+    if PILImage is None or not max_edge:
+        return to_data_uri(base64_string), len(raw), len(raw)
+
+    with PILImage.open(io.BytesIO(raw)) as image:
+        image.seek(0)
+        oversized = max(image.size) > max_edge
+        # 尺寸合适且已是目标格式的小图片不再重新编码，避免无谓的画质损失
+        if not oversized and source_format == output_format:
+            return to_data_uri(base64_string), len(raw), len(raw)
+
+        # 手机照片的方向信息保存在 EXIF 中，缩放前先校正
+        image = ImageOps.exif_transpose(image)
+        if oversized:
+            image.thumbnail((max_edge, max_edge), PILImage.LANCZOS)
+
+        encoded = _encode(image, output_format, quality)
+
+    # 重新编码反而更大且无需缩放时保留原图
+    if not oversized and len(encoded) >= len(raw):
+        return to_data_uri(base64_string), len(raw), len(raw)
+    data_uri = f"data:{_MIME_TYPES[output_format]};base64,{base64.b64encode(encoded).decode()}"
+    return data_uri, len(raw), len(encoded)
+
+
+async def prepare_reference_images(images, max_edge=1536, quality=85, output_format="jpeg"):
+    """
+    在上传前预处理参考图片：识别真实格式、限制最长边并重新编码为 JPEG/WebP
+
+    编解码在共享线程池中并发执行，不阻塞事件循环。单张图片处理失败时保留原图。
+
+    Args:
+        images (list): base64 图片数据列表
+        max_edge (int): 最长边像素上限，为0时只修正 data URI 的格式标签
+        quality (int): 编码质量（1-100）
+        output_format (str): jpeg 或 webp
+
+    Returns:
+        list: 带正确 data URI 前缀的图片列表，顺序与输入一致
+    """
+    if output_format not in _PIL_FORMATS:
+        output_format = "jpeg"
+    quality = min(max(int(quality), 1), 100)
+
+    async def prepare(index, image):
+        try:
+            data_uri, original_size, encoded_size = await run_cpu_bound(
+                _prepare_reference_image, image, max_edge, quality, output_format
+            )
+            if encoded_size != original_size:
+                logger.info(f"参考图片 {index + 1} 已压缩: {original_size} -> {encoded_size} bytes")
+            return data_uri
+        except Exception as e:
+            logger.warning(f"预处理参考图片 {index + 1} 失败，使用原图: {e}")
+            return to_data_uri(image)
+
+    if PILImage is None and max_edge:
+        logger.debug("未安装 Pillow，跳过参考图片缩放与重新编码")
+    return list(await asyncio.gather(*(prepare(i, image) for i, image in enumerate(images))))
+
+
+def _transcode_output_image(data, output_format, quality, max_edge):
+    """在工作进程中执行：按最长边缩放并将生成的图像编码为 JPEG/WebP，动图返回 None"""
+    with PILImage.open(io.BytesIO(data)) as image:
+        if getattr(image, "is_animated", False):
+            return None
+        image.load()
+        if max_edge and max(image.size) > max_edge:
+            image.thumbnail((max_edge, max_edge), PILImage.LANCZOS)
+        return _encode(image, output_format, quality)
+
+
+class OutputTranscoder:
+    """
+    生成图像的输出转码
+
+    上游返回的 PNG 往往有数 MB，发送到聊天平台是最慢的一环。转码在进程池中将图像
+    缩放并重新编码为 JPEG/WebP，只有结果比原图小时才替换原图，节省的字节数记录在指标中。
+    """
+
+    def __init__(self):
+        self.output_format = "off"
+        self.quality = 90
+        self.max_edge = 0
+
+    def configure(self, output_format=None, quality=None, max_edge=None):
+        """更新转码参数，output_format 为 off 时关闭转码"""
+        if output_format is not None:
+            output_format = str(output_format).lower()
+            self.output_format = output_format if output_format in _PIL_FORMATS else "off"
+        if quality is not None:
+            self.quality = min(max(int(quality), 1), 100)
+        if max_edge is not None:
+            self.max_edge = max(int(max_edge), 0)
+
+    @property
+    def enabled(self):
+        return self.output_format != "off" and PILImage is not None
+
+    async def transcode(self, data, source_format=None):
+        """
+        转码一张生成的图像
+
+        Args:
+            data (bytes): 原图数据
+            source_format (str): 原图格式，未提供时根据文件头识别
+
+        Returns:
+            tuple or None: (转码后的数据, 格式)；未启用、转码失败或结果不比原图小时返回 None
+        """
+        if not self.enabled or not data:
+            return None
+        source_format = source_format or sniff_image_format(data)
+        if source_format == "gif":
+            # 动图不转码
+            return None
+
+        metrics = get_metrics()
+        start = time.perf_counter()
+        try:
+            encoded = await run_in_process(_transcode_output_image, data, self.output_format, self.quality, self.max_edge)
+        except Exception as e:
+            logger.warning(f"生成图像转码失败，发送原图: {e}")
+            metrics.observe("transcode", time.perf_counter() - start, format=self.output_format, outcome="error")
+            return None
+
+        smaller = encoded is not None and len(encoded) < len(data)
+        metrics.observe(
+            "transcode", time.perf_counter() - start,
+            format=self.output_format, outcome="smaller" if smaller else "kept_original",
+        )
+        metrics.increment("transcode_input_bytes", len(data), format=self.output_format)
+        if not smaller:
+            metrics.increment("transcode_output_bytes", len(data), format=self.output_format)
+            return None
+        metrics.increment("transcode_output_bytes", len(encoded), format=self.output_format)
+        metrics.increment("transcode_saved_bytes", len(data) - len(encoded), format=self.output_format)
+        logger.info(f"生成图像已转码为 {self.output_format}: {len(data)} -> {len(encoded)} bytes")
+        return encoded, self.output_format
+
+
+# 全局输出转码实例
+_transcoder = OutputTranscoder()
+
+
+def configure_output_transcoder(**kwargs):
+    """
+    配置生成图像的输出转码
+
+    Args:
+        **kwargs: output_format / quality / max_edge
+    """
+    _transcoder.configure(**kwargs)
+
+
+def get_output_transcoder():
+    """
+    获取全局输出转码器
+
+    Returns:
+        OutputTranscoder: 输出转码器
+    """
+    return _transcoder
@@ -0,0 +1,188 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from pathlib import Path
+from astrbot.api import logger
+
+
+class ImageJanitor:
+    """
+    后台清理images文件夹
+
+    在内存中按创建顺序维护已保存图片的索引，同时按过期时间和总字节数上限淘汰最旧的文件。
+    保存图片时只需登记一次（O(1)），目录扫描和删除文件都在后台任务的工作线程中完成，不阻塞事件循环。
+    """
+
+    # 由插件生成、允许被清理的文件名前缀
+    PREFIXES = ("gemini_image_", "openai_image_", "siliconflow_image_")
+
+    def __init__(self):
+        self.ttl = 15 * 60
+        self.max_bytes = 500 * 1024 * 1024
+        self.interval = 60
+        self.images_dir = Path(__file__).parent.parent / "images"
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self._task = None
+        self._wakeup = asyncio.Event()
+
+    def configure(self, ttl=None, max_bytes=None, interval=None, images_dir=None):
+        """更新清理参数"""
+        if ttl is not None:
+            self.ttl = max(0.0, float(ttl))
+        if max_bytes is not None:
+            self.max_bytes = max(0, int(max_bytes))
+        if interval is not None:
+            self.interval = max(1.0, float(interval))
+        if images_dir is not None:
+            self.images_dir = Path(images_dir)
+
+    def track(self, path, size):
+        """
+        登记一个新保存的图片文件
+
+        Args:
+            path (Path or str): 文件路径
+            size (int): 文件大小（字节）
+        """
+        path = str(path)
+        previous = self._entries.pop(path, None)
+        if previous is not None:
+            self._total_bytes -= previous[1]
+        self._entries[path] = (time.time(), size)
+        self._total_bytes += size
+        self._ensure_started()
+        if self.max_bytes and self._total_bytes > self.max_bytes:
+            self._wakeup.set()
+
+    def stats(self):
+        """
+        Returns:
+            dict: files / bytes
+        """
+        return {"files": len(self._entries), "bytes": self._total_bytes}
+
+    async def stop(self):
+        """停止后台任务"""
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    def _ensure_started(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        try:
+            await self._initial_scan()
+            while True:
+                await self.sweep()
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"图像清理任务出错: {e}")
+
+    async def _initial_scan(self):
+        """登记插件启动前遗留在images文件夹中的文件"""
+        found = await asyncio.to_thread(_scan_images, self.images_dir, self.PREFIXES)
+        existing = self._entries
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        for path, mtime, size in sorted(found, key=lambda item: item[1]):
+            if path not in existing:
+                self._entries[path] = (mtime, size)
+                self._total_bytes += size
+        # 扫描期间新登记的文件排在最后
+        for path, entry in existing.items():
+            self._entries[path] = entry
+            self._total_bytes += entry[1]
+
+    async def sweep(self):
+        """删除过期文件，并在超过容量上限时删除最旧的文件"""
+        now = time.time()
+        victims = []
+        while self._entries:
+            path, (created, size) = next(iter(self._entries.items()))
+            expired = self.ttl > 0 and now - created > self.ttl
+            over_quota = self.max_bytes > 0 and self._total_bytes > self.max_bytes
+            if not (expired or over_quota):
+                break
+            self._entries.popitem(last=False)
+            self._total_bytes -= size
+            victims.append(path)
+        if victims:
+            removed = await asyncio.to_thread(_remove_files, victims)
+            logger.info(f"已清理 {removed} 个过期或超出容量的图像文件")
+
+
+def _scan_images(images_dir, prefixes):
+    found = []
+    try:
+        with os.scandir(images_dir) as entries:
+            for entry in entries:
+                if entry.name.startswith(prefixes) and entry.is_file():
+                    stat = entry.stat()
+                    found.append((entry.path, stat.st_mtime, stat.st_size))
+    except FileNotFoundError:
+        pass
+    return found
+
+
+def _remove_files(paths):
+    removed = 0
+    for path in paths:
+        try:
+            os.unlink(path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"清理文件 {path} 时出错: {e}")
+    return removed
+
+
+# 全局清理器实例
+_janitor = ImageJanitor()
+
+
+def configure_image_janitor(**kwargs):
+    """
+    配置图像清理器
+
+    Args:
+        **kwargs: ttl / max_bytes / interval / images_dir
+    """
+    _janitor.configure(**kwargs)
+
+
+def track_image(path, size):
+    """
+    登记新保存的图像文件，由后台任务按过期时间和容量上限清理
+
+    Args:
+        path (Path or str): 文件路径
+        size (int): 文件大小（字节）
+    """
+    _janitor.track(path, size)
+
+
+def get_images_dir():
+    """
+    获取生成图像的保存目录，即清理器管理的目录
+
+    Returns:
+        Path: images 目录，默认为插件目录下的 images
+    """
+    return _janitor.images_dir
+
+
+async def stop_image_janitor():
+    """停止后台清理任务，在插件卸载时调用"""
+    await _janitor.stop()
@@ -0,0 +1,349 @@
+import asyncio
+import hashlib
+import sqlite3
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from astrbot.api import logger
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS key_state (
+    key_id TEXT PRIMARY KEY,
+    cooldown_until REAL NOT NULL DEFAULT 0,
+    cooldown_reason TEXT,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS key_usage (
+    key_id TEXT NOT NULL,
+    day TEXT NOT NULL,
+    requests INTEGER NOT NULL DEFAULT 0,
+    successes INTEGER NOT NULL DEFAULT 0,
+    rate_limited INTEGER NOT NULL DEFAULT 0,
+    exhausted INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (key_id, day)
+);
+"""
+
+# 使用记录中各计数在列表中的位置
+_REQUESTS, _SUCCESSES, _RATE_LIMITED, _EXHAUSTED = range(4)
+
+
+def key_id(api_key):
+    """账本中只保存密钥 SHA-256 的前16位，不保存密钥本身"""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+
+def _today():
+    """OpenRouter 免费额度按 UTC 日期重置"""
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+
+class KeyLedger:
+    """
+    跨进程、跨重启共享的API密钥账本（SQLite）
+
+    记录每个密钥每天（UTC）的请求、成功、429 和 402 次数，以及密钥的冷却截止时间（即额度或限流的重置时间）。
+    多个 AstrBot 实例使用同一个数据库文件时，某个实例发现的限流或额度耗尽会在 SYNC_INTERVAL 秒内被其他实例看到，
+    重启后也不会再在已耗尽的密钥上浪费请求。
+
+    数据库使用 WAL 模式，写操作使用 BEGIN IMMEDIATE 获取写锁并设置 busy_timeout，多个进程可以同时读写。
+    冷却状态变化立即写入；使用次数先在内存中累计，与读取冷却状态一起每 SYNC_INTERVAL 秒批量写入一次。
+    数据库出错时只记录日志，不影响图像生成。
+    """
+
+    # 两次与数据库同步之间的最短间隔（秒）
+    SYNC_INTERVAL = 5.0
+    # 等待其他进程释放写锁的最长时间（毫秒）
+    BUSY_TIMEOUT_MS = 5000
+    # 使用记录保留天数
+    RETENTION_DAYS = 30
+
+    def __init__(self):
+        self.enabled = False
+        self.path = None
+        self._conn = None
+        self._lock = asyncio.Lock()
+        self._ids = {}
+        # (key_id, day) -> [requests, successes, rate_limited, exhausted]，尚未写入数据库的使用次数
+        self._pending = {}
+        # key_id -> (cooldown_until, reason, updated_at)，均为 Unix 时间戳，updated_at 为最近一次记录冷却的时间
+        self._cooldowns = {}
+        self._last_sync = 0.0
+        self._failed = False
+
+    def configure(self, enabled=None, path=None):
+        """
+        更新账本设置
+
+        Args:
+            enabled (bool): 是否启用
+            path (str or Path): 数据库文件路径，多个实例指向同一文件即可共享
+        """
+        if enabled is not None:
+            self.enabled = bool(enabled)
+        if path is not None and (self.path is None or Path(path) != self.path):
+            self._close_connection()
+            self.path = Path(path)
+            self._failed = False
+            self._last_sync = 0.0
+
+    @property
+    def active(self):
+        return self.enabled and self.path is not None and not self._failed
+
+    def key_id(self, api_key):
+        ident = self._ids.get(api_key)
+        if ident is None:
+            ident = self._ids[api_key] = key_id(api_key)
+        return ident
+
+    def record(self, api_key, outcome):
+        """
+        累计一次请求结果，在下次同步时写入数据库
+
+        Args:
+            api_key (str): API密钥
+            outcome (str): success / rate_limited / exhausted / key_invalid / rejected / error
+        """
+        if not self.active:
+            return
+        counts = self._pending.setdefault((self.key_id(api_key), _today()), [0, 0, 0, 0])
+        counts[_REQUESTS] += 1
+        if outcome == "success":
+            counts[_SUCCESSES] += 1
+        elif outcome == "rate_limited":
+            counts[_RATE_LIMITED] += 1
+        elif outcome == "exhausted":
+            counts[_EXHAUSTED] += 1
+
+    async def cooldowns(self, force=False):
+        """
+        获取所有进程记录的密钥冷却状态
+
+        距上次同步不足 SYNC_INTERVAL 秒时直接返回缓存的结果，否则先写入累计的使用次数再重新读取。
+
+        Args:
+            force (bool): 忽略同步间隔，立即同步
+
+        Returns:
+            dict: key_id -> (cooldown_until, reason, updated_at)，只包含仍在冷却中的密钥
+        """
+        if not self.active:
+            return {}
+        if force or time.monotonic() - self._last_sync >= self.SYNC_INTERVAL:
+            async with self._lock:
+                if force or time.monotonic() - self._last_sync >= self.SYNC_INTERVAL:
+                    pending, self._pending = self._pending, {}
+                    cooldowns = await self._run(self._sync, pending)
+                    self._last_sync = time.monotonic()
+                    if cooldowns is None:
+                        # 写入失败，使用次数留到下次同步
+                        self._merge_pending(pending)
+                    else:
+                        self._cooldowns = cooldowns
+        now = time.time()
+        return {ident: entry for ident, entry in self._cooldowns.items() if entry[0] > now}
+
+    async def set_cooldown(self, api_key, seconds, reason):
+        """
+        记录密钥进入冷却，立即写入数据库
+
+        Args:
+            api_key (str): API密钥
+            seconds (float): 冷却时间（秒）
+            reason (str): rate_limited / exhausted / key_invalid
+        """
+        if not self.active:
+            return
+        ident = self.key_id(api_key)
+        now = time.time()
+        until = now + seconds
+        current = self._cooldowns.get(ident)
+        # 与数据库一致：保留较晚的冷却，记录时间总是更新
+        if current is None or current[0] < until:
+            self._cooldowns[ident] = (until, reason, now)
+        else:
+            self._cooldowns[ident] = (current[0], current[1], now)
+        async with self._lock:
+            await self._run(self._write_cooldown, ident, until, reason)
+
+    async def clear_cooldown(self, api_key, since):
+        """
+        密钥请求成功后解除冷却
+
+        只解除 since 之前记录的冷却，请求进行期间其他进程新记录的冷却不受影响。
+        本进程缓存中没有该密钥的冷却时（例如冷却由其他进程在上次同步之后写入）也会更新数据库。
+
+        Args:
+            api_key (str): API密钥
+            since (float): 本次请求开始的 Unix 时间戳
+        """
+        if not self.active:
+            return
+        ident = self.key_id(api_key)
+        current = self._cooldowns.get(ident)
+        if current is not None and current[2] <= since:
+            del self._cooldowns[ident]
+        async with self._lock:
+            await self._run(self._clear_cooldown, ident, since)
+
+    async def usage(self, api_keys):
+        """
+        获取各密钥今天（UTC）在所有进程中的使用次数
+
+        Args:
+            api_keys (list): API密钥列表
+
+        Returns:
+            dict: key_id -> {"requests", "successes", "rate_limited", "exhausted"}
+        """
+        if not self.active:
+            return {}
+        await self.cooldowns(force=True)
+        idents = [self.key_id(api_key) for api_key in api_keys or []]
+        async with self._lock:
+            rows = await self._run(self._read_usage, idents, _today())
+        return rows or {}
+
+    async def close(self):
+        """写入尚未同步的使用次数并关闭数据库"""
+        if self.active and self._pending:
+            await self.cooldowns(force=True)
+        async with self._lock:
+            self._close_connection()
+
+    def _merge_pending(self, pending):
+        for key, counts in pending.items():
+            merged = self._pending.setdefault(key, [0, 0, 0, 0])
+            for i, value in enumerate(counts):
+                merged[i] += value
+
+    async def _run(self, func, *args):
+        """在后台线程中执行数据库操作，出错时记录日志并返回 None"""
+        try:
+            return await asyncio.to_thread(func, *args)
+        except sqlite3.Error as e:
+            logger.warning(f"密钥账本读写失败: {e}")
+            return None
+
+    def _connection(self):
+        if self._conn is None:
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                conn = sqlite3.connect(
+                    self.path, timeout=self.BUSY_TIMEOUT_MS / 1000, isolation_level=None, check_same_thread=False,
+                )
+                conn.execute(f"PRAGMA busy_timeout = {self.BUSY_TIMEOUT_MS}")
+                conn.execute("PRAGMA journal_mode = WAL")
+                conn.executescript(_SCHEMA)
+                cutoff = (datetime.now(timezone.utc) - timedelta(days=self.RETENTION_DAYS)).strftime("%Y-%m-%d")
+                conn.execute("DELETE FROM key_usage WHERE day < ?", (cutoff,))
+            except (sqlite3.Error, OSError) as e:
+                # 数据库不可用时停用账本，退回到进程内的密钥调度
+                self._failed = True
+                logger.error(f"无法打开密钥账本 {self.path}，已停用: {e}")
+                raise sqlite3.Error(str(e)) from e
+            self._conn = conn
+            logger.info(f"密钥账本: {self.path}")
+        return self._conn
+
+    def _close_connection(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _sync(self, pending):
+        conn = self._connection()
+        if pending:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany(
+                    """
+                    INSERT INTO key_usage (key_id, day, requests, successes, rate_limited, exhausted)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (key_id, day) DO UPDATE SET
+                        requests = requests + excluded.requests,
+                        successes = successes + excluded.successes,
+                        rate_limited = rate_limited + excluded.rate_limited,
+                        exhausted = exhausted + excluded.exhausted
+                    """,
+                    [(ident, day, *counts) for (ident, day), counts in pending.items()],
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        rows = conn.execute(
+            "SELECT key_id, cooldown_until, cooldown_reason, updated_at FROM key_state WHERE cooldown_until > ?",
+            (time.time(),),
+        ).fetchall()
+        return {ident: (until, reason, updated_at) for ident, until, reason, updated_at in rows}
+
+    def _write_cooldown(self, ident, until, reason):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # 已有更晚的冷却时保留较晚的那一个
+            conn.execute(
+                """
+                INSERT INTO key_state (key_id, cooldown_until, cooldown_reason, updated_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (key_id) DO UPDATE SET
+                    cooldown_reason = CASE WHEN excluded.cooldown_until >= cooldown_until
+                        THEN excluded.cooldown_reason ELSE cooldown_reason END,
+                    cooldown_until = MAX(cooldown_until, excluded.cooldown_until),
+                    updated_at = excluded.updated_at
+                """,
+                (ident, until, reason, time.time()),
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _clear_cooldown(self, ident, since):
+        conn = self._connection()
+        conn.execute(
+            "UPDATE key_state SET cooldown_until = 0, cooldown_reason = NULL, updated_at = ? "
+            "WHERE key_id = ? AND updated_at <= ?",
+            (time.time(), ident, since),
+        )
+
+    def _read_usage(self, idents, day):
+        if not idents:
+            return {}
+        conn = self._connection()
+        placeholders = ",".join("?" * len(idents))
+        rows = conn.execute(
+            f"SELECT key_id, requests, successes, rate_limited, exhausted FROM key_usage "
+            f"WHERE day = ? AND key_id IN ({placeholders})",
+            (day, *idents),
+        ).fetchall()
+        return {
+            ident: {"requests": requests, "successes": successes, "rate_limited": rate_limited, "exhausted": exhausted}
+            for ident, requests, successes, rate_limited, exhausted in rows
+        }
+
+
+# 全局密钥账本实例
+_ledger = KeyLedger()
+
+
+def configure_key_ledger(**kwargs):
+    """
+    配置密钥账本
+
+    Args:
+        **kwargs: enabled / path
+    """
+    _ledger.configure(**kwargs)
+
+
+def get_key_ledger():
+    """
+    获取全局密钥账本
+
+    Returns:
+        KeyLedger: 密钥账本
+    """
+    return _ledger
@@ -0,0 +1,279 @@
+import asyncio
+import time
+from email.utils import parsedate_to_datetime
+from astrbot.api import logger
+from .key_ledger import get_key_ledger
+
+
+class KeyHealth:
+    """单个API密钥的健康状态"""
+    def __init__(self):
+        self.cooldown_until = 0.0
+        self.cooldown_reason = None
+        # 最近一次记录冷却的时间，请求成功时只解除在该请求开始之前记录的冷却
+        self.cooldown_set_at = 0.0
+        self.success_rate = 1.0
+        self.latency = None
+        self.in_flight = 0
+        self.last_used = 0.0
+        self.total_requests = 0
+        self.total_failures = 0
+
+
+class ApiKeyScheduler:
+    """
+    基于健康度的API密钥调度器
+
+    为每个密钥记录冷却截止时间（遵循 Retry-After）、近期成功率、进行中请求数和平均延迟，
+    每次请求选择得分最高的可用密钥，处于冷却中的密钥会被直接跳过。
+    启用密钥账本时，选择密钥前会合并其他进程（以及重启前）记录的冷却状态，冷却和使用次数也会写入账本。
+    """
+
+    # 成功率和延迟的指数滑动平均系数
+    EWMA_ALPHA = 0.3
+    # 尚无延迟数据时假定的延迟（秒）
+    DEFAULT_LATENCY = 10.0
+
+    # 会让密钥进入冷却的请求结果
+    COOLDOWN_OUTCOMES = ("rate_limited", "exhausted", "key_invalid")
+
+    def __init__(self):
+        self.rate_limit_cooldown = 60.0
+        self.exhausted_cooldown = 3600.0
+        self.invalid_cooldown = 600.0
+        self._health = {}
+        self._lock = asyncio.Lock()
+
+    def configure(self, rate_limit_cooldown=None, exhausted_cooldown=None, invalid_cooldown=None):
+        """更新默认冷却时间（秒）"""
+        if rate_limit_cooldown is not None:
+            self.rate_limit_cooldown = float(rate_limit_cooldown)
+        if exhausted_cooldown is not None:
+            self.exhausted_cooldown = float(exhausted_cooldown)
+        if invalid_cooldown is not None:
+            self.invalid_cooldown = float(invalid_cooldown)
+
+    def _get_health(self, api_key):
+        health = self._health.get(api_key)
+        if health is None:
+            health = self._health[api_key] = KeyHealth()
+        return health
+
+    def _score(self, health):
+        latency = health.latency if health.latency is not None else self.DEFAULT_LATENCY
+        return health.success_rate / ((1 + health.in_flight) * max(latency, 0.1))
+
+    async def acquire(self, api_keys, exclude=()):
+        """
+        选择当前最合适的API密钥并标记为使用中
+
+        Args:
+            api_keys (list): API密钥列表
+            exclude (Iterable[str]): 本次请求中已尝试过、需要跳过的密钥
+
+        Returns:
+            tuple: (api_key, key_index)，key_index 从1开始；没有可用密钥时返回 (None, None)
+        """
+        if not api_keys or not isinstance(api_keys, list):
+            raise ValueError("API密钥列表不能为空")
+
+        shared = await get_key_ledger().cooldowns()
+        async with self._lock:
+            now = time.monotonic()
+            self._merge_shared_cooldowns(api_keys, shared, now)
+            best_key = None
+            best_rank = None
+            for api_key in api_keys:
+                if api_key in exclude:
+                    continue
+                health = self._get_health(api_key)
+                if health.cooldown_until > now:
+                    continue
+                # 得分相同时优先选择最久未使用的密钥，使新密钥之间均匀分摊
+                rank = (self._score(health), -health.last_used)
+                if best_rank is None or rank > best_rank:
+                    best_key, best_rank = api_key, rank
+
+            if best_key is None:
+                return None, None
+
+            self._begin(self._health[best_key], now)
+            return best_key, api_keys.index(best_key) + 1
+
+    async def begin(self, api_key):
+        """
+        在同一密钥上发起新一次尝试（例如重试）前调用
+
+        Args:
+            api_key (str): API密钥
+
+        Returns:
+            bool: 密钥可用返回 True；密钥已进入冷却（可能由其他并发请求触发）返回 False
+        """
+        shared = await get_key_ledger().cooldowns()
+        async with self._lock:
+            now = time.monotonic()
+            self._merge_shared_cooldowns([api_key], shared, now)
+            health = self._get_health(api_key)
+            if health.cooldown_until > now:
+                return False
+            self._begin(health, now)
+            return True
+
+    def _merge_shared_cooldowns(self, api_keys, shared, now):
+        """把密钥账本中的冷却状态（Unix 时间戳）合并到本进程的健康状态（单调时钟）"""
+        if not shared:
+            return
+        ledger = get_key_ledger()
+        offset = now - time.time()
+        for api_key in api_keys:
+            entry = shared.get(ledger.key_id(api_key))
+            if entry is None:
+                continue
+            until = entry[0] + offset
+            health = self._get_health(api_key)
+            if until > health.cooldown_until:
+                health.cooldown_until = until
+                health.cooldown_reason = entry[1]
+                health.cooldown_set_at = max(health.cooldown_set_at, entry[2] + offset)
+
+    def _begin(self, health, now):
+        health.in_flight += 1
+        health.last_used = now
+        health.total_requests += 1
+
+    async def release(self, api_key, outcome, latency=None, retry_after=None):
+        """
+        记录一次请求结果
+
+        Args:
+            api_key (str): 使用的API密钥
+            outcome (str): success / rate_limited / exhausted / key_invalid（401/403）/
+                rejected（请求本身被拒绝，与密钥无关）/ error / cancelled
+            latency (float): 请求耗时（秒）
+            retry_after (float): 上游要求的等待时间（秒），仅对 rate_limited / exhausted 生效
+        """
+        ledger = get_key_ledger()
+        async with self._lock:
+            now = time.monotonic()
+            health = self._get_health(api_key)
+            health.in_flight = max(0, health.in_flight - 1)
+            if outcome == "cancelled":
+                # 被主动取消的请求不计入健康统计
+                health.total_requests = max(0, health.total_requests - 1)
+                return
+            ledger.record(api_key, outcome)
+            if outcome == "rejected":
+                # 参数错误等请求本身的问题不影响密钥的健康度
+                return
+
+            success = 1.0 if outcome == "success" else 0.0
+            health.success_rate += self.EWMA_ALPHA * (success - health.success_rate)
+            if outcome != "success":
+                health.total_failures += 1
+
+            if latency is not None and outcome == "success":
+                if health.latency is None:
+                    health.latency = latency
+                else:
+                    health.latency += self.EWMA_ALPHA * (latency - health.latency)
+
+            if outcome in self.COOLDOWN_OUTCOMES:
+                if outcome == "key_invalid":
+                    retry_after = self.invalid_cooldown
+                elif retry_after is None:
+                    retry_after = self.rate_limit_cooldown if outcome == "rate_limited" else self.exhausted_cooldown
+                health.cooldown_until = max(health.cooldown_until, now + retry_after)
+                health.cooldown_reason = outcome
+                health.cooldown_set_at = now
+                logger.info(f"API密钥进入冷却 {retry_after:.0f} 秒 ({outcome})")
+            elif outcome == "success" and health.cooldown_set_at <= now - (latency or 0.0):
+                # 请求进行期间其他并发请求记录的冷却（例如 429）保留
+                health.cooldown_until = 0.0
+                health.cooldown_reason = None
+
+        # 账本写入在锁外进行，不阻塞其他请求选择密钥
+        if outcome in self.COOLDOWN_OUTCOMES:
+            await ledger.set_cooldown(api_key, retry_after, outcome)
+        elif outcome == "success":
+            await ledger.clear_cooldown(api_key, time.time() - (latency or 0.0))
+
+    async def snapshot(self, api_keys):
+        """
+        获取各密钥的健康状态摘要
+
+        Args:
+            api_keys (list): API密钥列表
+
+        Returns:
+            list: 每个密钥一项的状态字典，不包含密钥本身
+        """
+        async with self._lock:
+            now = time.monotonic()
+            result = []
+            for index, api_key in enumerate(api_keys or [], start=1):
+                health = self._get_health(api_key)
+                result.append({
+                    "index": index,
+                    "cooldown_remaining": max(0.0, health.cooldown_until - now),
+                    "cooldown_reason": health.cooldown_reason if health.cooldown_until > now else None,
+                    "success_rate": health.success_rate,
+                    "latency": health.latency,
+                    "in_flight": health.in_flight,
+                    "total_requests": health.total_requests,
+                    "total_failures": health.total_failures,
+                })
+            return result
+
+
+def parse_retry_after(headers, data=None):
+    """
+    从响应头或 OpenRouter 错误元数据中解析需要等待的秒数
+
+    Args:
+        headers (Mapping): 响应头
+        data (dict): 响应JSON（可选）
+
+    Returns:
+        float or None: 等待秒数，无法解析时返回 None
+    """
+    value = headers.get("Retry-After") if headers else None
+    if value:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+
+    # OpenRouter 在错误元数据中透传上游的 X-RateLimit-Reset（毫秒时间戳）
+    try:
+        reset = data["error"]["metadata"]["headers"]["X-RateLimit-Reset"]
+        return max(0.0, float(reset) / 1000 - time.time())
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+# 全局密钥调度器实例
+_scheduler = ApiKeyScheduler()
+
+
+def configure_key_scheduler(**kwargs):
+    """
+    配置密钥调度器参数
+
+    Args:
+        **kwargs: rate_limit_cooldown / exhausted_cooldown / invalid_cooldown
+    """
+    _scheduler.configure(**kwargs)
+
+
+def get_key_scheduler():
+    """
+    获取全局密钥调度器
+
+    Returns:
+        ApiKeyScheduler: 密钥调度器
+    """
+    return _scheduler
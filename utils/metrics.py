@@ -0,0 +1,274 @@
+import asyncio
+import bisect
+import time
+from aiohttp import web
+from astrbot.api import logger
+
+# 直方图桶上限（秒），覆盖从毫秒级的本地处理到分钟级的上游生成
+BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1, 2.5, 5, 10, 15, 20, 30, 45, 60, 90, 120, 180,
+)
+
+# 各阶段在统计输出中的中文名称，未列出的阶段直接显示阶段名
+STAGE_NAMES = {
+    "request_total": "整体耗时",
+    "queue_wait": "排队等待",
+    "reference_fetch": "参考图获取",
+    "reference_prepare": "参考图预处理",
+    "generate": "图像生成",
+    "payload_build": "请求体构建",
+    "upstream_attempt": "单次上游请求",
+    "retry_backoff": "重试等待",
+    "upstream_ttfb": "上游首字节",
+    "upstream_first_token": "上游首个数据块",
+    "body_download": "响应体下载",
+    "decode": "base64解码",
+    "disk_write": "写入磁盘",
+    "send_file": "远程文件传输",
+    "web_link": "生成下载链接",
+    "deliver": "构建图片消息",
+    "transcode": "输出转码",
+}
+
+
+class Histogram:
+    """固定桶的延迟直方图"""
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent):
+        """在所在桶内线性插值估计分位数"""
+        if not self.count:
+            return 0.0
+        rank = self.count * percent / 100
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                lower = BUCKETS[i - 1] if i > 0 else 0.0
+                upper = BUCKETS[i] if i < len(BUCKETS) else self.max
+                return min(lower + (upper - lower) * (rank - cumulative) / count, self.max)
+            cumulative += count
+        return self.max
+
+
+class StageMetrics:
+    """
+    按阶段记录耗时
+
+    每个 (阶段, 标签) 组合对应一个直方图，标签包括 API 密钥序号（key）、模型（model）、结果（outcome）等。
+    另外提供简单的累加计数器，例如输出转码节省的字节数。
+    """
+    def __init__(self):
+        self._series = {}
+        self._counters = {}
+        self.started = time.time()
+
+    def observe(self, stage, seconds, **labels):
+        """
+        记录一次阶段耗时
+
+        Args:
+            stage (str): 阶段名称
+            seconds (float): 耗时（秒）
+            **labels: 标签，值为 None 的标签会被忽略
+        """
+        key = (stage, tuple(sorted((name, str(value)) for name, value in labels.items() if value is not None)))
+        histogram = self._series.get(key)
+        if histogram is None:
+            histogram = self._series[key] = Histogram()
+        histogram.observe(max(0.0, seconds))
+
+    def timer(self, stage, **labels):
+        """
+        计时上下文管理器，退出时记录耗时
+
+        代码块内可以通过 timer.labels 修改标签（例如设置 outcome），
+        未设置 outcome 时正常退出记为 success，抛出异常记为 error。
+
+        用法:
+            with metrics.timer("send_file") as t:
+                ...
+                t.labels["outcome"] = "failed"
+        """
+        return _StageTimer(self, stage, labels)
+
+    def increment(self, name, value=1, **labels):
+        """
+        累加计数器
+
+        Args:
+            name (str): 计数器名称，例如 transcode_saved_bytes
+            value (int or float): 增加的数值
+            **labels: 标签，值为 None 的标签会被忽略
+        """
+        key = (name, tuple(sorted((label, str(v)) for label, v in labels.items() if v is not None)))
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def counter_total(self, name):
+        """计数器在所有标签下的总和"""
+        return sum(value for (counter, _), value in self._counters.items() if counter == name)
+
+    def clear(self):
+        self._series.clear()
+        self._counters.clear()
+        self.started = time.time()
+
+    def summary(self, group_by=None):
+        """
+        汇总各阶段的分位数
+
+        Args:
+            group_by (str): 按该标签分组，为 None 时每个阶段合并所有标签
+
+        Returns:
+            list: [(stage, group, Histogram)]，按阶段出现顺序排列
+        """
+        merged = {}
+        for (stage, labels), histogram in self._series.items():
+            group = dict(labels).get(group_by) if group_by else None
+            if group_by and group is None:
+                continue
+            target = merged.get((stage, group))
+            if target is None:
+                target = merged[(stage, group)] = Histogram()
+            target.merge(histogram)
+        order = {stage: i for i, stage in enumerate(STAGE_NAMES)}
+        return sorted(
+            ((stage, group, histogram) for (stage, group), histogram in merged.items()),
+            key=lambda item: (order.get(item[0], len(order)), item[0], item[1] or ""),
+        )
+
+    def render_prometheus(self):
+        """
+        以 Prometheus 文本格式导出所有直方图
+
+        Returns:
+            str: Prometheus exposition format 文本
+        """
+        name = "gemini_image_stage_duration_seconds"
+        lines = [
+            f"# HELP {name} Duration of each image generation stage in seconds.",
+            f"# TYPE {name} histogram",
+        ]
+        for (stage, labels), histogram in sorted(self._series.items()):
+            label_text = ",".join([f'stage="{_escape(stage)}"'] + [f'{k}="{_escape(v)}"' for k, v in labels])
+            cumulative = 0
+            for bound, count in zip(BUCKETS + (float("inf"),), histogram.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                lines.append(f'{name}_bucket{{{label_text},le="{le}"}} {cumulative}')
+            lines.append(f"{name}_sum{{{label_text}}} {histogram.sum}")
+            lines.append(f"{name}_count{{{label_text}}} {histogram.count}")
+
+        for counter in sorted({counter for counter, _ in self._counters}):
+            metric = f"gemini_image_{counter}_total"
+            lines.append(f"# TYPE {metric} counter")
+            for (other, labels), value in sorted(self._counters.items()):
+                if other == counter:
+                    label_text = ",".join(f'{k}="{_escape(v)}"' for k, v in labels)
+                    lines.append(f"{metric}{{{label_text}}} {value}" if label_text else f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class _StageTimer:
+    def __init__(self, metrics, stage, labels):
+        self._metrics = metrics
+        self.stage = stage
+        self.labels = labels
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if "outcome" not in self.labels or self.labels["outcome"] is None:
+            self.labels["outcome"] = "success" if exc_type is None else "error"
+        self._metrics.observe(self.stage, time.perf_counter() - self._start, **self.labels)
+        return False
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class MetricsServer:
+    """只提供 /metrics 的 Prometheus 抓取端点"""
+    def __init__(self):
+        self._runner = None
+        self._lock = asyncio.Lock()
+
+    async def start(self, host, port):
+        async with self._lock:
+            if self._runner is None and port:
+                await self._start(host, port)
+
+    async def _start(self, host, port):
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, host, port).start()
+        except OSError as e:
+            await runner.cleanup()
+            logger.error(f"启动 Prometheus 指标端点失败: {e}")
+            return
+        self._runner = runner
+        logger.info(f"Prometheus 指标端点已启动: http://{host}:{port}/metrics")
+
+    async def stop(self):
+        runner, self._runner = self._runner, None
+        if runner is not None:
+            await runner.cleanup()
+
+    async def _handle(self, request):
+        return web.Response(text=_metrics.render_prometheus(), content_type="text/plain", charset="utf-8")
+
+
+# 全局指标实例
+_metrics = StageMetrics()
+_server = MetricsServer()
+
+
+def get_metrics():
+    """
+    获取全局阶段耗时指标
+
+    Returns:
+        StageMetrics: 指标实例
+    """
+    return _metrics
+
+
+async def start_metrics_server(host="127.0.0.1", port=0):
+    """
+    启动 Prometheus 指标端点，port 为0时不启动
+
+    Args:
+        host (str): 监听地址
+        port (int): 监听端口
+    """
+    await _server.start(host, port)
+
+
+async def stop_metrics_server():
+    """停止 Prometheus 指标端点，在插件卸载时调用"""
+    await _server.stop()
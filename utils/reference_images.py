@@ -0,0 +1,86 @@
+import asyncio
+import hashlib
+from astrbot.api import logger
+from astrbot.core.message.components import Image, Reply
+from .workers import run_cpu_bound
+
+
+def _digest(base64_data):
+    return hashlib.sha256(base64_data.encode("ascii", "ignore")).digest()
+
+
+def _iter_image_components(event):
+    """按出现顺序遍历当前消息及其引用消息中的图片组件，yield (组件, 是否来自引用消息)"""
+    if not (hasattr(event, "message_obj") and event.message_obj and hasattr(event.message_obj, "message")):
+        return
+    for comp in event.message_obj.message:
+        if isinstance(comp, Image):
+            yield comp, False
+        elif isinstance(comp, Reply):
+            # Reply组件的chain字段包含被引用的消息内容
+            if comp.chain:
+                for reply_comp in comp.chain:
+                    if isinstance(reply_comp, Image):
+                        yield reply_comp, True
+            else:
+                logger.debug("引用消息的chain为空，无法获取图片内容")
+
+
+async def collect_reference_images(event, concurrency=4, timeout=20):
+    """
+    并发获取消息和引用消息中的所有图片，并去除内容完全相同的重复图片
+
+    Args:
+        event (AstrMessageEvent): 消息事件
+        concurrency (int): 同时下载/转换的图片数上限
+        timeout (float): 单张图片的超时时间（秒）
+
+    Returns:
+        list: base64 图片数据列表，顺序与图片在消息中出现的顺序一致
+    """
+    components = []
+    seen_sources = set()
+    for comp, from_reply in _iter_image_components(event):
+        # 同一来源地址的图片只获取一次
+        source = comp.url or comp.file
+        if source and source in seen_sources:
+            continue
+        if source:
+            seen_sources.add(source)
+        components.append((comp, from_reply))
+
+    if not components:
+        return []
+
+    semaphore = asyncio.Semaphore(max(1, int(concurrency)))
+
+    async def fetch(comp, from_reply):
+        where = "引用消息中的" if from_reply else "当前消息中的"
+        async with semaphore:
+            try:
+                base64_data = await asyncio.wait_for(comp.convert_to_base64(), timeout)
+                if from_reply:
+                    logger.info("从引用消息中获取到图片")
+                return base64_data
+            except asyncio.TimeoutError:
+                logger.warning(f"获取{where}参考图片超时（{timeout} 秒）")
+            except (IOError, ValueError, OSError) as e:
+                logger.warning(f"转换{where}参考图片到base64失败: {e}")
+            except Exception as e:
+                logger.error(f"处理{where}图片时出现未预期的错误: {e}")
+            return None
+
+    results = await asyncio.gather(*(fetch(comp, from_reply) for comp, from_reply in components))
+
+    # 去除字节完全相同的图片（例如同一张图既作为附件发送又被引用）
+    results = [base64_data for base64_data in results if base64_data]
+    digests = await asyncio.gather(*(run_cpu_bound(_digest, base64_data) for base64_data in results))
+    images = []
+    seen_digests = set()
+    for base64_data, digest in zip(results, digests):
+        if digest in seen_digests:
+            logger.info("跳过重复的参考图片")
+            continue
+        seen_digests.add(digest)
+        images.append(base64_data)
+    return images
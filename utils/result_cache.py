@@ -0,0 +1,259 @@
+import asyncio
+import json
+import os
+import shutil
+import time
+from collections import OrderedDict
+from pathlib import Path
+from astrbot.api import logger
+
+
+class ResultCache:
+    """
+    按内容寻址的生成结果缓存
+
+    以请求指纹（模型、API地址、提示词、参考图片SHA-256）为键，将生成的图像保存在插件数据目录中。
+    按最近访问顺序淘汰（LRU），同时受总字节数上限和过期时间约束，索引持久化到 index.json。
+    """
+
+    INDEX_FILE = "index.json"
+
+    def __init__(self):
+        self.enabled = False
+        self.max_bytes = 200 * 1024 * 1024
+        self.ttl = 6 * 3600
+        self.cache_dir = None
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self._loaded = False
+        self._lock = asyncio.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, enabled=None, max_bytes=None, ttl=None, cache_dir=None):
+        """更新缓存参数"""
+        if enabled is not None:
+            self.enabled = bool(enabled)
+        if max_bytes is not None:
+            self.max_bytes = max(0, int(max_bytes))
+        if ttl is not None:
+            self.ttl = max(0.0, float(ttl))
+        if cache_dir is not None:
+            self.cache_dir = Path(cache_dir)
+            self._loaded = False
+
+    @property
+    def active(self):
+        return self.enabled and self.cache_dir is not None and self.max_bytes > 0
+
+    async def get(self, fingerprint):
+        """
+        查找缓存的图像
+
+        Args:
+            fingerprint (str): 请求指纹
+
+        Returns:
+            str or None: 命中时返回图像文件路径
+        """
+        if not self.active:
+            return None
+        async with self._lock:
+            await self._ensure_loaded()
+            entry = self._entries.get(fingerprint)
+            if entry is not None and self._is_expired(entry):
+                self._remove_entry(fingerprint)
+                entry = None
+            if entry is not None:
+                path = self.cache_dir / entry["file"]
+                if path.exists():
+                    entry["last_access"] = time.time()
+                    self._entries.move_to_end(fingerprint)
+                    self.hits += 1
+                    return str(path)
+                self._remove_entry(fingerprint)
+            self.misses += 1
+            return None
+
+    async def put(self, fingerprint, image_path):
+        """
+        将生成的图像加入缓存
+
+        Args:
+            fingerprint (str): 请求指纹
+            image_path (str): 生成的图像文件路径
+        """
+        if not self.active:
+            return
+        try:
+            source = Path(image_path)
+            await self._store(fingerprint, source.suffix or ".png", source.stat().st_size, _link_or_copy, source)
+        except Exception as e:
+            logger.warning(f"写入生成结果缓存失败: {e}")
+
+    async def put_data(self, fingerprint, data, suffix=".png"):
+        """
+        将内存中的图像数据直接写入缓存
+
+        Args:
+            fingerprint (str): 请求指纹
+            data (bytes): 图像数据
+            suffix (str): 文件扩展名
+        """
+        if not self.active:
+            return
+        try:
+            await self._store(fingerprint, suffix, len(data), _write_bytes, data)
+        except Exception as e:
+            logger.warning(f"写入生成结果缓存失败: {e}")
+
+    async def _store(self, fingerprint, suffix, size, writer, source):
+        if size > self.max_bytes:
+            return
+        file_name = f"{fingerprint}{suffix}"
+        async with self._lock:
+            await self._ensure_loaded()
+            await asyncio.to_thread(writer, source, self.cache_dir / file_name)
+            if fingerprint in self._entries:
+                self._remove_entry(fingerprint, delete_file=False)
+            now = time.time()
+            self._entries[fingerprint] = {"file": file_name, "size": size, "created": now, "last_access": now}
+            self._total_bytes += size
+            self._evict()
+            await self._save_index()
+
+    async def clear(self):
+        """清空缓存"""
+        async with self._lock:
+            await self._ensure_loaded()
+            for fingerprint in list(self._entries):
+                self._remove_entry(fingerprint)
+            self.hits = 0
+            self.misses = 0
+            await self._save_index()
+
+    async def stats(self):
+        """
+        获取缓存统计
+
+        Returns:
+            dict: entries / bytes / max_bytes / hits / misses / hit_rate
+        """
+        async with self._lock:
+            if self.active:
+                await self._ensure_loaded()
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.active,
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    async def close(self):
+        """保存索引（包括最近访问时间）"""
+        async with self._lock:
+            if self._loaded:
+                await self._save_index()
+
+    def _is_expired(self, entry):
+        return self.ttl > 0 and time.time() - entry["created"] > self.ttl
+
+    def _remove_entry(self, fingerprint, delete_file=True):
+        entry = self._entries.pop(fingerprint)
+        self._total_bytes -= entry["size"]
+        if delete_file:
+            try:
+                (self.cache_dir / entry["file"]).unlink(missing_ok=True)
+            except OSError as e:
+                logger.warning(f"删除缓存文件失败: {e}")
+
+    def _evict(self):
+        for fingerprint in [fp for fp, entry in self._entries.items() if self._is_expired(entry)]:
+            self._remove_entry(fingerprint)
+        while self._total_bytes > self.max_bytes and self._entries:
+            self._remove_entry(next(iter(self._entries)))
+
+    async def _ensure_loaded(self):
+        if self._loaded:
+            return
+        self._entries.clear()
+        self._total_bytes = 0
+        entries = await asyncio.to_thread(_read_index, self.cache_dir / self.INDEX_FILE)
+        for fingerprint, entry in sorted(entries.items(), key=lambda item: item[1].get("last_access", 0)):
+            try:
+                if not (self.cache_dir / entry["file"]).exists():
+                    continue
+                self._entries[fingerprint] = entry
+                self._total_bytes += int(entry["size"])
+            except (KeyError, TypeError, ValueError):
+                continue
+        self._loaded = True
+        self._evict()
+
+    async def _save_index(self):
+        await asyncio.to_thread(_write_index, self.cache_dir / self.INDEX_FILE, dict(self._entries))
+
+
+def _read_index(index_path):
+    index_path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        with open(index_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logger.warning(f"读取生成结果缓存索引失败，将重建缓存: {e}")
+        return {}
+
+
+def _write_index(index_path, entries):
+    tmp_path = index_path.with_suffix(".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(entries, f)
+    os.replace(tmp_path, index_path)
+
+
+def _write_bytes(data, target):
+    tmp_path = target.with_suffix(".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, target)
+
+
+def _link_or_copy(source, target):
+    # 优先使用硬链接，避免复制数据；跨文件系统时退回到复制
+    target.unlink(missing_ok=True)
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+# 全局结果缓存实例
+_cache = ResultCache()
+
+
+def configure_result_cache(**kwargs):
+    """
+    配置生成结果缓存
+
+    Args:
+        **kwargs: enabled / max_bytes / ttl / cache_dir
+    """
+    _cache.configure(**kwargs)
+
+
+def get_result_cache():
+    """
+    获取全局生成结果缓存
+
+    Returns:
+        ResultCache: 结果缓存
+    """
+    return _cache
@@ -0,0 +1,307 @@
+import random
+import time
+from urllib.parse import urlsplit
+from astrbot.api import logger
+
+# 状态码分类结果
+RETRY = "retry"              # 临时性错误，可以在同一密钥上重试
+RATE_LIMITED = "rate_limited"  # 速率限制，密钥进入冷却并换下一个密钥
+EXHAUSTED = "exhausted"      # 额度耗尽，密钥进入冷却并换下一个密钥
+NEXT_KEY = "next_key"        # 密钥本身的问题（无效、无权限），不重试，换下一个密钥
+FATAL = "fatal"              # 请求本身有问题，换密钥或重试都不会成功
+
+# 可以重试的状态码，其余 4xx 均视为请求本身的错误
+_RETRYABLE_STATUS = {408, 409, 425, 500, 502, 503, 504, 520, 522, 524, 529}
+_KEY_STATUS = {401, 402, 403}
+
+
+def classify_status(status, data=None):
+    """
+    对上游返回的非200状态码分类
+
+    Args:
+        status (int): HTTP 状态码
+        data (dict): 错误响应JSON（可选）
+
+    Returns:
+        str: RETRY / RATE_LIMITED / EXHAUSTED / NEXT_KEY / FATAL
+    """
+    if status == 429:
+        return RATE_LIMITED
+    if status == 402 and "insufficient" in str(data).lower():
+        return EXHAUSTED
+    if status in _KEY_STATUS:
+        return NEXT_KEY
+    if status in _RETRYABLE_STATUS or status >= 500:
+        return RETRY
+    return FATAL
+
+
+class CircuitBreaker:
+    """
+    单个上游端点的熔断器
+
+    连续失败的请求数达到阈值后进入熔断（open）状态，期间直接拒绝请求；
+    熔断时间结束后进入半开（half_open）状态，只放行一个探测请求，成功则恢复，失败则再次熔断。
+    只有网络错误、超时和 5xx 计为失败，429、4xx 说明端点仍在正常响应，计为成功。
+    同一个生成请求的多次重试和多个密钥只计一次失败，单个请求的重试不会让端点对所有人熔断。
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name):
+        self.name = name
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_until = 0.0
+        self.open_count = 0
+        # 自上次成功以来已计入失败的请求序号
+        self._failed_requests = set()
+        self._probing = False
+
+    def allow(self, failure_threshold, open_seconds):
+        """
+        判断是否允许发起请求
+
+        Returns:
+            bool: 允许时返回 True，调用方之后必须调用 record 报告结果
+        """
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            if time.monotonic() < self.opened_until:
+                return False
+            self.state = self.HALF_OPEN
+            self._probing = False
+        if self._probing:
+            return False
+        self._probing = True
+        logger.info(f"上游端点 {self.name} 熔断结束，发起探测请求")
+        return True
+
+    def record(self, success, failure_threshold, open_seconds, request_id=None):
+        """
+        报告一次请求结果
+
+        Args:
+            success (bool or None): 端点是否正常，None 表示请求被取消、不影响熔断状态
+            request_id (int): 所属生成请求的序号，同一请求的失败只计一次（可选）
+        """
+        if self.state == self.HALF_OPEN:
+            self._probing = False
+            if success is None:
+                return
+            if success:
+                self.state = self.CLOSED
+                self._reset()
+                logger.info(f"上游端点 {self.name} 已恢复")
+            else:
+                self._open(open_seconds)
+            return
+
+        if success is None:
+            return
+        if success:
+            self._reset()
+            return
+        if request_id is not None:
+            if request_id in self._failed_requests:
+                return
+            self._failed_requests.add(request_id)
+        self.failures += 1
+        if self.state == self.CLOSED and self.failures >= failure_threshold:
+            self._open(open_seconds)
+
+    def would_allow(self):
+        """allow 是否会放行，不改变熔断器状态（不占用半开状态的探测名额）"""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            return time.monotonic() >= self.opened_until
+        return not self._probing
+
+    def remaining(self):
+        """熔断剩余时间（秒）"""
+        return max(0.0, self.opened_until - time.monotonic()) if self.state == self.OPEN else 0.0
+
+    def _reset(self):
+        self.failures = 0
+        self._failed_requests.clear()
+
+    def _open(self, open_seconds):
+        self.state = self.OPEN
+        self.opened_until = time.monotonic() + open_seconds
+        self.open_count += 1
+        logger.warning(f"上游端点 {self.name} 连续 {self.failures} 个请求失败，熔断 {open_seconds:.0f} 秒")
+        self._failed_requests.clear()
+
+
+class RetryPolicy:
+    """
+    上游请求的共享重试策略
+
+    - 重试间隔使用去相关抖动（decorrelated jitter），并发失败的请求不会同步重试
+    - 进程级重试预算：每个请求补充 budget_ratio 个令牌，每次重试消耗一个，
+      上游大面积故障时重试总量被限制在请求量的一定比例以内
+    - 每个上游端点一个熔断器，端点故障期间直接失败，不再排队等待注定失败的重试
+    """
+
+    # 重试预算令牌上限，也是启动时的初始令牌数
+    BUDGET_CAPACITY = 10.0
+
+    def __init__(self):
+        self.base_delay = 1.0
+        self.max_delay = 10.0
+        self.budget_ratio = 0.2
+        self.failure_threshold = 10
+        self.open_seconds = 30.0
+        self._tokens = self.BUDGET_CAPACITY
+        self._breakers = {}
+        self.retries = 0
+        self.budget_rejections = 0
+        self._request_seq = 0
+
+    def configure(self, base_delay=None, max_delay=None, budget_ratio=None, failure_threshold=None, open_seconds=None):
+        """更新重试策略参数"""
+        if base_delay is not None:
+            self.base_delay = max(float(base_delay), 0.0)
+        if max_delay is not None:
+            self.max_delay = max(float(max_delay), self.base_delay)
+        if budget_ratio is not None:
+            self.budget_ratio = min(max(float(budget_ratio), 0.0), 1.0)
+        if failure_threshold is not None:
+            self.failure_threshold = max(int(failure_threshold), 0)
+        if open_seconds is not None:
+            self.open_seconds = max(float(open_seconds), 0.0)
+
+    def next_delay(self, previous_delay=None, retry_after=None):
+        """
+        计算下一次重试前的等待时间
+
+        Args:
+            previous_delay (float): 上一次的等待时间，第一次重试时为 None
+            retry_after (float): 上游要求的等待时间（可选）
+
+        Returns:
+            float: 等待秒数，不超过 max_delay
+        """
+        upper = max(self.base_delay, (previous_delay or self.base_delay) * 3)
+        delay = random.uniform(self.base_delay, upper)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return min(delay, self.max_delay)
+
+    def on_request(self):
+        """
+        每个新的生成请求调用一次，为重试预算补充令牌
+
+        Returns:
+            int: 请求序号，报告结果时传给 record，同一请求的多次失败只计一次
+        """
+        self._tokens = min(self._tokens + self.budget_ratio, self.BUDGET_CAPACITY)
+        self._request_seq += 1
+        return self._request_seq
+
+    def try_acquire_retry(self):
+        """
+        尝试消耗一次重试预算
+
+        Returns:
+            bool: 预算充足返回 True
+        """
+        if self._tokens < 1.0:
+            self.budget_rejections += 1
+            return False
+        self._tokens -= 1.0
+        self.retries += 1
+        return True
+
+    def allow(self, url):
+        """
+        熔断器是否允许向该端点发起请求
+
+        Returns:
+            bool: 允许时返回 True，调用方之后必须调用 record 报告结果
+        """
+        if not self.failure_threshold:
+            return True
+        return self._breaker(url).allow(self.failure_threshold, self.open_seconds)
+
+    def would_allow(self, url):
+        """熔断器是否会放行向该端点的请求，不改变熔断器状态"""
+        if not self.failure_threshold:
+            return True
+        breaker = self._breakers.get(_endpoint(url))
+        return breaker is None or breaker.would_allow()
+
+    def record(self, url, success, request_id=None):
+        """
+        报告一次请求结果
+
+        Args:
+            url (str): 请求地址
+            success (bool or None): 端点是否正常响应，None 表示请求被取消
+            request_id (int): on_request 返回的请求序号，同一请求的失败只计一次（可选）
+        """
+        if self.failure_threshold:
+            self._breaker(url).record(success, self.failure_threshold, self.open_seconds, request_id)
+
+    def open_remaining(self, url):
+        """端点熔断剩余时间（秒），未熔断时为0"""
+        breaker = self._breakers.get(_endpoint(url))
+        return breaker.remaining() if breaker else 0.0
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: 重试预算和各端点熔断状态
+        """
+        return {
+            "budget_tokens": self._tokens,
+            "retries": self.retries,
+            "budget_rejections": self.budget_rejections,
+            "breakers": {
+                name: {"state": breaker.state, "failures": breaker.failures,
+                       "remaining": breaker.remaining(), "open_count": breaker.open_count}
+                for name, breaker in self._breakers.items()
+            },
+        }
+
+    def _breaker(self, url):
+        name = _endpoint(url)
+        breaker = self._breakers.get(name)
+        if breaker is None:
+            breaker = self._breakers[name] = CircuitBreaker(name)
+        return breaker
+
+
+def _endpoint(url):
+    """熔断器按 主机+路径 区分端点"""
+    parts = urlsplit(url)
+    return f"{parts.netloc}{parts.path}"
+
+
+# 全局重试策略实例
+_policy = RetryPolicy()
+
+
+def configure_retry_policy(**kwargs):
+    """
+    配置重试策略
+
+    Args:
+        **kwargs: base_delay / max_delay / budget_ratio / failure_threshold / open_seconds
+    """
+    _policy.configure(**kwargs)
+
+
+def get_retry_policy():
+    """
+    获取全局重试策略
+
+    Returns:
+        RetryPolicy: 重试策略
+    """
+    return _policy
@@ -0,0 +1,59 @@
+import asyncio
+
+
+class SingleFlight:
+    """
+    合并相同的并发请求
+
+    同一键的请求在执行期间，后续调用不会再次执行，而是等待并共享第一次调用的结果。
+    共享任务与调用方解耦，某个调用方被取消不会影响其他仍在等待的调用方；
+    因此所有调用方都离开后共享任务仍会继续执行，需要在卸载时通过 cancel_all 取消。
+    """
+    def __init__(self):
+        self._tasks = {}
+        # 所有尚未结束的共享任务
+        self._running = set()
+        self.shared_hits = 0
+
+    async def do(self, key, factory):
+        """
+        执行或加入一个请求
+
+        Args:
+            key (Hashable): 请求的唯一键
+            factory (Callable[[], Awaitable]): 创建实际请求协程的函数，仅在没有相同请求进行中时调用
+
+        Returns:
+            Any: 请求结果
+        """
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._tasks[key] = task
+            self._running.add(task)
+            task.add_done_callback(lambda t: self._forget(key, t))
+        else:
+            self.shared_hits += 1
+        return await asyncio.shield(task)
+
+    def in_flight(self):
+        """
+        Returns:
+            int: 当前正在执行的不同请求数
+        """
+        return len(self._tasks)
+
+    async def cancel_all(self):
+        """取消所有进行中的共享任务并等待其结束"""
+        tasks = list(self._running)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _forget(self, key, task):
+        self._running.discard(task)
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        # 没有调用方等待时也要取出异常，避免 "exception was never retrieved" 警告
+        if not task.cancelled():
+            task.exception()
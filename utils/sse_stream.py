@@ -0,0 +1,206 @@
+import asyncio
+import json
+import time
+import aiohttp
+
+
+class StreamStalledError(asyncio.TimeoutError):
+    """流式响应在规定时间内没有收到数据"""
+
+
+class StreamSettings:
+    """
+    流式（SSE）生成模式的设置
+
+    开启后 chat completions 请求携带 stream: true，响应按 SSE 数据块增量读取：
+    - connect_timeout: 建立连接的超时时间
+    - first_token_timeout: 从发出请求到收到第一个数据事件的超时时间（上游的保活注释不计入）
+    - idle_timeout: 收到数据后，两个数据事件之间的最长间隔
+    卡住的请求在数秒内即被放弃并换下一个密钥，而不是等满整体超时。
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.connect_timeout = 10.0
+        self.first_token_timeout = 30.0
+        self.idle_timeout = 20.0
+
+    def configure(self, enabled=None, connect_timeout=None, first_token_timeout=None, idle_timeout=None):
+        """更新流式模式设置"""
+        if enabled is not None:
+            self.enabled = bool(enabled)
+        if connect_timeout is not None:
+            self.connect_timeout = max(float(connect_timeout), 1.0)
+        if first_token_timeout is not None:
+            self.first_token_timeout = max(float(first_token_timeout), 1.0)
+        if idle_timeout is not None:
+            self.idle_timeout = max(float(idle_timeout), 1.0)
+
+    def client_timeout(self, total=None):
+        """
+        Args:
+            total (float): 整体超时（秒），默认不设，数据间隔由 SSEChunkReader 控制
+
+        Returns:
+            aiohttp.ClientTimeout: 流式请求使用的超时设置
+        """
+        return aiohttp.ClientTimeout(
+            total=total,
+            connect=self.connect_timeout,
+            sock_connect=self.connect_timeout,
+            sock_read=max(self.first_token_timeout, self.idle_timeout),
+        )
+
+
+class SSEChunkReader:
+    """
+    按块读取 SSE 响应体，并执行首个数据事件超时和数据间隔超时
+
+    逐块原样返回响应字节，图像数据可以在到达时立即交给增量解码器；
+    以冒号开头的注释行（如 OpenRouter 的 ": OPENROUTER PROCESSING"）只说明连接存活，不算作数据。
+
+    Args:
+        response (aiohttp.ClientResponse): 状态码为200的流式响应
+        settings (StreamSettings): 超时设置
+        request_start (float): 发出请求的时间（time.monotonic）
+    """
+
+    def __init__(self, response, settings, request_start):
+        self._response = response
+        self._settings = settings
+        self._deadline = request_start + settings.first_token_timeout
+        self._request_start = request_start
+        self._at_line_start = True
+        self._in_comment = False
+        # 收到第一个数据事件时距发出请求的秒数
+        self.first_token_latency = None
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        content = self._response.content
+        while True:
+            remaining = self._deadline - time.monotonic()
+            if remaining <= 0:
+                raise self._stalled()
+            try:
+                chunk = await asyncio.wait_for(content.readany(), remaining)
+            except asyncio.TimeoutError:
+                raise self._stalled() from None
+            if not chunk:
+                return
+            if self._scan(chunk):
+                now = time.monotonic()
+                if self.first_token_latency is None:
+                    self.first_token_latency = now - self._request_start
+                self._deadline = now + self._settings.idle_timeout
+            yield chunk
+
+    def _scan(self, chunk):
+        """检查本块中是否有非注释的数据内容，只在换行处查找，图像载荷所在的长行不会被逐字节扫描"""
+        has_data = False
+        pos = 0
+        length = len(chunk)
+        while pos < length:
+            if self._at_line_start:
+                self._in_comment = chunk[pos:pos + 1] == b":"
+                self._at_line_start = False
+            newline = chunk.find(b"\n", pos)
+            end = length if newline < 0 else newline
+            if not self._in_comment and chunk[pos:end].strip():
+                has_data = True
+            if newline < 0:
+                break
+            self._at_line_start = True
+            pos = newline + 1
+        return has_data
+
+    def _stalled(self):
+        if self.first_token_latency is None:
+            return StreamStalledError(f"{self._settings.first_token_timeout:.0f} 秒内未收到首个数据块")
+        return StreamStalledError(f"超过 {self._settings.idle_timeout:.0f} 秒未收到新的数据块")
+
+
+def parse_sse_events(body):
+    """
+    解析 SSE 响应体中的 JSON 数据事件
+
+    Args:
+        body (bytes): 响应体（通常是去除图像载荷后的骨架）
+
+    Returns:
+        list: 每个数据事件解析出的字典，[DONE] 和无法解析的事件被忽略
+    """
+    events = []
+    for block in body.replace(b"\r\n", b"\n").split(b"\n\n"):
+        data = b"\n".join(
+            line[5:].lstrip(b" ") for line in block.split(b"\n") if line.startswith(b"data:")
+        )
+        if not data or data.strip() == b"[DONE]":
+            continue
+        try:
+            event = json.loads(data)
+        except (ValueError, UnicodeDecodeError):
+            continue
+        if isinstance(event, dict):
+            events.append(event)
+    return events
+
+
+def merge_sse_events(events):
+    """
+    将流式响应的增量事件合并为与非流式响应相同结构的 JSON
+
+    Args:
+        events (list): parse_sse_events 的结果
+
+    Returns:
+        dict: 包含 choices[0].message.content、finish_reason，以及流中出现的 error 字段
+    """
+    content = []
+    finish_reason = None
+    merged = {}
+    for event in events:
+        if "error" in event:
+            merged["error"] = event["error"]
+        for choice in event.get("choices") or []:
+            delta = choice.get("delta") or choice.get("message") or {}
+            if isinstance(delta.get("content"), str):
+                content.append(delta["content"])
+            if choice.get("finish_reason"):
+                finish_reason = choice["finish_reason"]
+            if "error" in choice:
+                merged["error"] = choice["error"]
+        if "usage" in event:
+            merged["usage"] = event["usage"]
+    merged["choices"] = [{
+        "index": 0,
+        "message": {"role": "assistant", "content": "".join(content)},
+        "finish_reason": finish_reason,
+    }]
+    return merged
+
+
+# 全局流式模式设置
+_settings = StreamSettings()
+
+
+def configure_streaming(**kwargs):
+    """
+    配置流式生成模式
+
+    Args:
+        **kwargs: enabled / connect_timeout / first_token_timeout / idle_timeout
+    """
+    _settings.configure(**kwargs)
+
+
+def get_stream_settings():
+    """
+    获取全局流式模式设置
+
+    Returns:
+        StreamSettings: 流式模式设置
+    """
+    return _settings
@@ -0,0 +1,280 @@
+import base64
+import binascii
+import json
+import re
+
+
+class Base64ImageStreamDecoder:
+    """
+    增量解析响应字节流中的 base64 图像数据
+
+    在字节流中查找 ``data:image/<fmt>;base64,`` 或 ``"b64_json": "`` 之后的载荷，
+    按块解码后交给调用方写入输出目标，整个响应体无需完整驻留内存。
+    载荷以外的内容（"骨架"）会被保留下来，便于解析错误信息或图片URL等字段。
+    只解码遇到的第一张图像，后续图像载荷会被跳过。
+
+    SSE 流式响应中一个 data URI 可能被拆分到多个增量事件里，后续事件的 "url" 字段只包含 base64 续传部分。
+    sse 为 True 时载荷在事件末尾结束后不立即视为完整，后续事件中的续传部分会接着解码，直到 close。
+    complete 只说明载荷在 JSON 字符串中正常结束，图像本身是否完整需要调用方按 head / tail 再做检查。
+    """
+
+    _DATA_URI_MARKER = b"data:image/"
+    _B64_JSON_MARKER = b'"b64_json"'
+    _URL_MARKER = b'"url"'
+    _MARKER_KEEP = max(len(_DATA_URI_MARKER), len(_B64_JSON_MARKER), len(_URL_MARKER)) - 1
+    _MAX_HEADER_LENGTH = 64
+    # base64 字符以及 JSON 转义使用的反斜杠，遇到其他字符即认为载荷结束
+    _PAYLOAD_END = re.compile(rb"[^A-Za-z0-9+/=\\]")
+    _B64_JSON_PREFIX = re.compile(rb'\s*:\s*"')
+    _B64_JSON_PARTIAL = re.compile(rb"\s*(?::\s*)?")
+    _FORMAT_PATTERN = re.compile(r"^[a-z0-9.+-]{1,16}$")
+    # "url" 字段的值开头连续这么多个 base64 字符时视为上一个 data URI 的续传（http 地址和 data URI 在此之前就会出现冒号）
+    _CONTINUATION_PEEK = 8
+    # head / tail 保留的字节数
+    _EDGE_BYTES = 16
+
+    _SCAN = 0
+    _DATA_URI_HEADER = 1
+    _B64_JSON_HEADER = 2
+    _PAYLOAD = 3
+    _URL_HEADER = 4
+    _URL_VALUE = 5
+
+    def __init__(self, max_skeleton_bytes=1024 * 1024, sse=False):
+        self.image_format = None
+        self.found = False
+        self.complete = False
+        self.decoded_bytes = 0
+        # 解码出的图像数据的开头和结尾几个字节，用于检查图像是否完整
+        self.head = b""
+        self.tail = b""
+        self._sse = sse
+        # 图像载荷已在事件末尾结束，后续事件可能还有续传部分
+        self._resumable = False
+        self._state = self._SCAN
+        self._pending = b""
+        self._b64_carry = b""
+        self._capture = False
+        self._skeleton = bytearray()
+        self._max_skeleton_bytes = max_skeleton_bytes
+        self.skeleton_truncated = False
+
+    def feed(self, chunk):
+        """
+        输入一段响应字节
+
+        Args:
+            chunk (bytes): 响应体中的下一段数据
+
+        Returns:
+            bytes: 本段数据中解码出的图像字节（可能为空）
+        """
+        data = self._pending + chunk if self._pending else bytes(chunk)
+        self._pending = b""
+        output = []
+        pos = 0
+        length = len(data)
+
+        while pos < length:
+            if self._state == self._SCAN:
+                uri_index = data.find(self._DATA_URI_MARKER, pos)
+                json_index = data.find(self._B64_JSON_MARKER, pos)
+                url_index = data.find(self._URL_MARKER, pos) if self._resumable else -1
+                candidates = [i for i in (uri_index, json_index, url_index) if i >= 0]
+                if not candidates:
+                    # 末尾保留可能被截断的标记前缀
+                    keep_from = max(pos, length - self._MARKER_KEEP)
+                    self._append_skeleton(data[pos:keep_from])
+                    self._pending = data[keep_from:]
+                    break
+                index = min(candidates)
+                if index == uri_index:
+                    end = index + len(self._DATA_URI_MARKER)
+                    self._state = self._DATA_URI_HEADER
+                elif index == url_index:
+                    end = index + len(self._URL_MARKER)
+                    self._state = self._URL_HEADER
+                else:
+                    end = index + len(self._B64_JSON_MARKER)
+                    self._state = self._B64_JSON_HEADER
+                self._append_skeleton(data[pos:end])
+                pos = end
+
+            elif self._state == self._DATA_URI_HEADER:
+                comma = data.find(b",", pos, pos + self._MAX_HEADER_LENGTH)
+                if comma < 0:
+                    if length - pos < self._MAX_HEADER_LENGTH:
+                        self._pending = data[pos:]
+                        break
+                    self._state = self._SCAN
+                    continue
+                header = data[pos:comma]
+                if not header.endswith(b";base64"):
+                    self._state = self._SCAN
+                    continue
+                self._append_skeleton(data[pos:comma + 1])
+                self._start_payload(header[:-len(b";base64")].decode("ascii", "ignore"))
+                pos = comma + 1
+
+            elif self._state in (self._B64_JSON_HEADER, self._URL_HEADER):
+                match = self._B64_JSON_PREFIX.match(data, pos)
+                if match is None:
+                    if self._B64_JSON_PARTIAL.fullmatch(data, pos):
+                        self._pending = data[pos:]
+                        break
+                    self._state = self._SCAN
+                    continue
+                self._append_skeleton(data[pos:match.end()])
+                if self._state == self._B64_JSON_HEADER:
+                    self._start_payload("png")
+                else:
+                    self._state = self._URL_VALUE
+                pos = match.end()
+
+            elif self._state == self._URL_VALUE:
+                match = self._PAYLOAD_END.search(data, pos, pos + self._CONTINUATION_PEEK)
+                if match is None and length - pos < self._CONTINUATION_PEEK:
+                    self._pending = data[pos:]
+                    break
+                if match is None or data[match.start():match.start() + 1] == b'"':
+                    # 只有 base64 字符：上一个 data URI 的续传部分
+                    self._state = self._PAYLOAD
+                    self._capture = True
+                    self.complete = False
+                else:
+                    # 新的 data URI 或普通地址，交给 _SCAN 处理
+                    self._state = self._SCAN
+
+            else:
+                match = self._PAYLOAD_END.search(data, pos)
+                end = match.start() if match else length
+                if self._capture:
+                    # SSE 模式下不足4个字符的尾部留到续传部分或 close 时处理
+                    decoded = self._decode(data[pos:end], final=match is not None and not self._sse)
+                    if decoded:
+                        output.append(decoded)
+                pos = end
+                if match is not None:
+                    if self._capture:
+                        self.complete = True
+                        self._capture = False
+                        self._resumable = self._sse
+                    self._state = self._SCAN
+
+        return b"".join(output)
+
+    def close(self):
+        """
+        响应体读取完毕，处理剩余数据
+
+        Returns:
+            bytes: 剩余的图像字节（载荷未正常结束时为空，且 complete 为 False）
+        """
+        if self._state != self._PAYLOAD:
+            self._append_skeleton(self._pending)
+        self._pending = b""
+        self._resumable = False
+        if self.complete and self._b64_carry:
+            return self._decode(b"", final=True)
+        return b""
+
+    def skeleton(self):
+        """
+        Returns:
+            bytes or None: 去除图像载荷后的响应骨架，超过长度上限被截断时返回 None
+        """
+        if self.skeleton_truncated:
+            return None
+        return bytes(self._skeleton)
+
+    def skeleton_json(self):
+        """
+        将去除图像载荷后的响应骨架解析为 JSON
+
+        Returns:
+            dict or list or None: 解析结果，骨架被截断或不是合法 JSON 时返回 None
+        """
+        skeleton = self.skeleton()
+        if skeleton is None:
+            return None
+        try:
+            return json.loads(skeleton)
+        except (ValueError, UnicodeDecodeError):
+            return None
+
+    def _start_payload(self, image_format):
+        self._state = self._PAYLOAD
+        if self.found:
+            # 出现新的图像，上一张图像不会再有续传部分
+            self._resumable = False
+            return
+        image_format = image_format.lower()
+        self.image_format = image_format if self._FORMAT_PATTERN.match(image_format) else "png"
+        self.found = True
+        self._capture = True
+
+    def _decode(self, segment, final):
+        segment = self._b64_carry + segment
+        self._b64_carry = b""
+        held = b""
+        if not final and segment.endswith(b"\\"):
+            # 转义序列被分块截断，留到下一块处理
+            held = b"\\"
+            segment = segment[:-1]
+        if b"\\" in segment:
+            segment = segment.replace(b"\\/", b"/").replace(b"\\n", b"").replace(b"\\r", b"")
+        if final:
+            usable = len(segment)
+            remainder = usable % 4
+            if remainder:
+                segment += b"=" * (4 - remainder)
+                usable = len(segment)
+        else:
+            usable = len(segment) - len(segment) % 4
+            self._b64_carry = segment[usable:] + held
+        if not usable:
+            return b""
+        decoded = base64.b64decode(segment[:usable])
+        self.decoded_bytes += len(decoded)
+        if len(self.head) < self._EDGE_BYTES:
+            self.head += decoded[:self._EDGE_BYTES - len(self.head)]
+        if len(decoded) >= self._EDGE_BYTES:
+            self.tail = decoded[-self._EDGE_BYTES:]
+        else:
+            self.tail = (self.tail + decoded)[-self._EDGE_BYTES:]
+        return decoded
+
+    def _append_skeleton(self, data):
+        if not data or self.skeleton_truncated:
+            return
+        if len(self._skeleton) + len(data) > self._max_skeleton_bytes:
+            self.skeleton_truncated = True
+            self._skeleton.clear()
+            return
+        self._skeleton += data
+
+
+def decode_base64_sliced(base64_string, slice_size=256 * 1024):
+    """
+    分片解码一整段 base64 数据
+
+    binascii 解码期间不会释放 GIL，一次解码数 MB 数据会让事件循环线程等待数十毫秒。
+    按片解码可以让 GIL 在片与片之间及时交还，适合在后台线程中调用。
+
+    Args:
+        base64_string (str or bytes): base64 数据
+        slice_size (int): 每片的字符数，必须是4的倍数
+
+    Returns:
+        bytes: 解码后的数据
+    """
+    if isinstance(base64_string, str):
+        base64_string = base64_string.encode("ascii")
+    if b"\n" in base64_string or b"\r" in base64_string:
+        base64_string = base64_string.replace(b"\n", b"").replace(b"\r", b"")
+    if len(base64_string) <= slice_size:
+        return base64.b64decode(base64_string)
+    output = bytearray()
+    for start in range(0, len(base64_string), slice_size):
+        output += binascii.a2b_base64(base64_string[start:start + slice_size])
+    return bytes(output)
@@ -3,38 +3,38 @@ import aiohttp
 import asyncio
 import aiofiles
 import base64
+import hashlib
+import json
 import os
-import re
+import time
 import uuid
-from datetime import datetime, timedelta
+from datetime import datetime
 import glob
 from pathlib import Path
 from astrbot.api import logger
 from astrbot.api.star import StarTools
+from .http_pool import get_http_session
+from .stream_decoder import Base64ImageStreamDecoder, decode_base64_sliced
+from .key_scheduler import get_key_scheduler, parse_retry_after
+from .hedging import get_hedge_policy
+from .singleflight import SingleFlight
+from .result_cache import get_result_cache
+from .image_codec import data_uri_prefix, sniff_image_format, image_data_complete, verify_image, get_output_transcoder
+from .janitor import track_image, get_images_dir
+from .workers import run_cpu_bound
+from .metrics import get_metrics
+from .retry_policy import get_retry_policy, classify_status, RATE_LIMITED, EXHAUSTED, NEXT_KEY, FATAL
+from .endpoint_router import get_endpoint_router
+from .sse_stream import get_stream_settings, SSEChunkReader, parse_sse_events, merge_sse_events
+from .deadline import Deadline, DeadlineExceededError
 
 
 class ImageGeneratorState:
     """图像生成器状态管理类，用于处理并发安全"""
     def __init__(self):
         self.last_saved_image = {"url": None, "path": None}
-        self.api_key_index = 0
         self._lock = asyncio.Lock()
     
-    async def get_next_api_key(self, api_keys):
-        """获取下一个可用的API密钥"""
-        async with self._lock:
-            if not api_keys or not isinstance(api_keys, list):
-                raise ValueError("API密钥列表不能为空")
-            current_key = api_keys[self.api_key_index % len(api_keys)]
-            return current_key
-    
-    async def rotate_to_next_api_key(self, api_keys):
-        """轮换到下一个API密钥"""
-        async with self._lock:
-            if api_keys and isinstance(api_keys, list) and len(api_keys) > 1:
-                self.api_key_index = (self.api_key_index + 1) % len(api_keys)
-                logger.info(f"已轮换到下一个API密钥，当前索引: {self.api_key_index}")
-    
     async def update_saved_image(self, url, path):
         """更新保存的图像信息"""
         async with self._lock:
@@ -50,46 +50,101 @@ class ImageGeneratorState:
 _state = ImageGeneratorState()
 
 
-async def cleanup_old_images(data_dir=None):
+class GeneratedImage:
     """
-    清理超过15分钟的图像文件
-    
+    一张生成的图像
+
+    图像数据可以只保存在内存中（data），也可以已经写入文件（path）。
+    只在远程文件传输、缓存等确实需要文件时才调用 ensure_file 写入images文件夹。
+    """
+    def __init__(self, data=None, image_format="png", path=None, prefix="gemini_image"):
+        self.data = data
+        self.image_format = image_format
+        self.path = str(path) if path else None
+        self.prefix = prefix
+        self._lock = asyncio.Lock()
+
+    @property
+    def size(self):
+        if self.data is not None:
+            return len(self.data)
+        return os.path.getsize(self.path) if self.path else 0
+
+    @property
+    def url(self):
+        """图像的 file:// URL，尚未写入文件时为 None"""
+        return f"file://{Path(self.path).absolute()}" if self.path else None
+
+    async def ensure_file(self, data_dir=None):
+        """
+        确保图像已写入文件
+
+        Args:
+            data_dir (Path): 数据目录路径，如果为None则使用当前脚本目录
+
+        Returns:
+            str: 图像文件路径
+        """
+        async with self._lock:
+            if self.path is None:
+                image_path = await _new_image_path(self.prefix, self.image_format, data_dir)
+                with get_metrics().timer("disk_write"):
+                    async with aiofiles.open(image_path, "wb") as f:
+                        await f.write(self.data)
+                await _register_saved_image(image_path, len(self.data))
+                logger.info(f"图像已保存到: {image_path.absolute()}")
+                self.path = str(image_path)
+            return self.path
+
+# 进行中的图像生成请求，用于合并相同的并发请求
+_inflight = SingleFlight()
+
+# 流式读取响应体时每次读取的字节数
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+async def _new_image_path(prefix, image_format, data_dir=None):
+    """
+    在images文件夹下生成一个新的唯一图像文件路径
+
     Args:
-        data_dir (Path): 数据目录路径，如果为None则使用当前脚本目录
+        prefix (str): 文件名前缀
+        image_format (str): 图像格式（文件扩展名）
+        data_dir (Path): 数据目录路径，如果为None则使用图像清理器管理的images目录（默认为插件目录下的images）
+
+    Returns:
+        Path: 新的图像文件路径
     """
-    try:
-        # 如果没有传入data_dir，使用当前脚本目录
-        if data_dir is None:
-            script_dir = Path(__file__).parent.parent
-            data_dir = script_dir
-        
-        images_dir = data_dir / "images"
+    images_dir = get_images_dir() if data_dir is None else data_dir / "images"
+    # 确保images目录存在
+    images_dir.mkdir(parents=True, exist_ok=True)
 
-        if not images_dir.exists():
-            return
+    # 生成唯一文件名（使用时间戳和UUID避免冲突）
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    unique_id = str(uuid.uuid4())[:8]
+    return images_dir / f"{prefix}_{timestamp}_{unique_id}.{image_format}"
 
-        current_time = datetime.now()
-        cutoff_time = current_time - timedelta(minutes=15)
 
-        # 查找images目录下的所有图像文件
-        image_patterns = ["gemini_image_*.png", "gemini_image_*.jpg", "gemini_image_*.jpeg"]
+async def _register_saved_image(image_path, size):
+    """
+    记录最近保存的图像，并交由后台清理器管理
 
-        for pattern in image_patterns:
-            for file_path in images_dir.glob(pattern):
-                try:
-                    # 获取文件的修改时间
-                    file_mtime = datetime.fromtimestamp(file_path.stat().st_mtime)
+    Args:
+        image_path (Path): 图像文件路径
+        size (int): 文件大小（字节）
 
-                    # 如果文件超过15分钟，删除它
-                    if file_mtime < cutoff_time:
-                        file_path.unlink()
-                        logger.info(f"已清理过期图像: {file_path}")
+    Returns:
+        str: 图像的 file:// URL
+    """
+    track_image(image_path, size)
 
-                except Exception as e:
-                    logger.warning(f"清理文件 {file_path} 时出错: {e}")
+    # 获取绝对路径
+    abs_path = str(image_path.absolute())
+    file_url = f"file://{abs_path}"
 
-    except Exception as e:
-        logger.error(f"图像清理过程出错: {e}")
+    # 更新状态
+    await _state.update_saved_image(file_url, str(image_path))
+    return file_url
 
 
 async def save_base64_image(base64_string, image_format="png", data_dir=None):
@@ -105,38 +160,18 @@ async def save_base64_image(base64_string, image_format="png", data_dir=None):
         bool: 是否保存成功
     """
     try:
-        # 如果没有传入data_dir，使用当前脚本目录
-        if data_dir is None:
-            script_dir = Path(__file__).parent.parent
-            data_dir = script_dir
-        
-        images_dir = data_dir / "images"
-        # 确保images目录存在
-        images_dir.mkdir(exist_ok=True)
-        
-        # 先清理旧图像
-        await cleanup_old_images(data_dir)
+        # 在后台线程中解码 base64 数据，避免大图阻塞事件循环
+        image_data = await run_cpu_bound(decode_base64_sliced, base64_string)
 
-        # 解码 base64 数据
-        image_data = base64.b64decode(base64_string)
-
-        # 生成唯一文件名（使用时间戳和UUID避免冲突）
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        unique_id = str(uuid.uuid4())[:8]
-        image_path = images_dir / f"gemini_image_{timestamp}_{unique_id}.{image_format}"
+        image_path = await _new_image_path("gemini_image", image_format, data_dir)
 
         # 保存图像文件
         async with aiofiles.open(image_path, "wb") as f:
             await f.write(image_data)
 
-        # 获取绝对路径
-        abs_path = str(image_path.absolute())
-        file_url = f"file://{abs_path}"
-
-        # 更新状态
-        await _state.update_saved_image(file_url, str(image_path))
+        await _register_saved_image(image_path, len(image_data))
 
-        logger.info(f"图像已保存到: {abs_path}")
+        logger.info(f"图像已保存到: {image_path.absolute()}")
         logger.debug(f"文件大小: {len(image_data)} bytes")
 
         return True
@@ -149,27 +184,138 @@ async def save_base64_image(base64_string, image_format="png", data_dir=None):
         return False
 
 
-async def get_next_api_key(api_keys):
+async def _stream_image_response(response, data_dir=None, in_memory=False, model=None, sse_reader=None):
     """
-    获取下一个可用的API密钥
-    
+    流式读取响应体，将其中第一张 base64 图像边解码边写入images文件夹（或内存）
+
+    响应体只经过一次增量扫描，峰值内存约为单个读取块加上解码后的图像写入缓冲，
+    不再需要 response.json()、字符串切分和整体 b64decode 带来的多份拷贝。
+    SSE 流式响应中图像增量事件同样是 data URI，原始字节可以直接交给同一个解码器。
+
     Args:
-        api_keys (list): API密钥列表
-        
+        response (aiohttp.ClientResponse): 状态码为200的响应
+        data_dir (Path): 数据目录路径，如果为None则使用当前脚本目录
+        in_memory (bool): 是否只在内存中保存解码后的图像，不写入文件
+        model (str): 模型名称，用于耗时统计
+        sse_reader (SSEChunkReader): 流式响应的读取器，为 None 时按普通 JSON 响应读取
+
+    Returns:
+        tuple: (image, data)，image 为 GeneratedImage，未找到图像时为 None；
+            data 为去除图像载荷后的响应 JSON（流式响应为合并后的事件），解析失败时为 None
+    """
+    # SSE 响应中的 data URI 可能被拆分到多个事件，由解码器拼接
+    decoder = Base64ImageStreamDecoder(sse=sse_reader is not None)
+    image_path = None
+    buffer = bytearray() if in_memory else None
+    f = None
+    # 分别累计解码和写盘耗时，其余时间为等待网络数据
+    decode_time = 0.0
+    write_time = 0.0
+    download_start = time.perf_counter()
+
+    async def write(decoded):
+        nonlocal f, image_path, write_time
+        if buffer is not None:
+            buffer.extend(decoded)
+            return
+        stage_start = time.perf_counter()
+        if f is None:
+            image_path = await _new_image_path("gemini_image", decoder.image_format, data_dir)
+            f = await aiofiles.open(image_path, "wb")
+        await f.write(decoded)
+        write_time += time.perf_counter() - stage_start
+
+    try:
+        chunks = sse_reader if sse_reader is not None else response.content.iter_chunked(STREAM_CHUNK_SIZE)
+        async for chunk in chunks:
+            # 解码在后台线程中进行，事件循环只负责收发数据
+            stage_start = time.perf_counter()
+            decoded = await run_cpu_bound(decoder.feed, chunk)
+            decode_time += time.perf_counter() - stage_start
+            if decoded:
+                await write(decoded)
+        decoded = decoder.close()
+        if decoded:
+            await write(decoded)
+    except BaseException:
+        if f is not None:
+            await f.close()
+            f = None
+        if image_path is not None:
+            image_path.unlink(missing_ok=True)
+        raise
+    finally:
+        if f is not None:
+            await f.close()
+
+    if decoder.found and not decoder.complete:
+        if image_path is not None:
+            image_path.unlink(missing_ok=True)
+        raise ValueError("响应体在图像数据传输过程中中断")
+    if decoder.found and not (
+        image_data_complete(decoder.head, decoder.tail, decoder.decoded_bytes)
+        and await run_cpu_bound(verify_image, buffer if buffer is not None else image_path)
+    ):
+        # 载荷在 JSON 中正常结束但图像本身不完整，例如流在事件边界处结束
+        if image_path is not None:
+            image_path.unlink(missing_ok=True)
+        raise ValueError("响应中的图像数据不完整")
+
+    metrics = get_metrics()
+    metrics.observe("body_download", time.perf_counter() - download_start, model=model)
+    if decoder.found:
+        metrics.observe("decode", decode_time, model=model)
+    if write_time:
+        metrics.observe("disk_write", write_time)
+
+    image = None
+    if buffer:
+        image = GeneratedImage(bytes(buffer), decoder.image_format)
+        logger.debug(f"图像大小: {decoder.decoded_bytes} bytes")
+    elif image_path is not None:
+        await _register_saved_image(image_path, decoder.decoded_bytes)
+        image = GeneratedImage(image_format=decoder.image_format, path=image_path)
+        logger.info(f"图像已保存到: {image_path.absolute()}")
+        logger.debug(f"文件大小: {decoder.decoded_bytes} bytes")
+    if sse_reader is not None:
+        skeleton = decoder.skeleton()
+        return image, merge_sse_events(parse_sse_events(skeleton)) if skeleton is not None else None
+    return image, decoder.skeleton_json()
+
+
+async def _read_error_json(response):
+    """
+    读取非200响应的JSON内容
+
+    Args:
+        response (aiohttp.ClientResponse): 响应对象
+
     Returns:
-        str: 当前可用的API密钥
+        dict: 响应JSON，无法解析时返回空字典
     """
-    return await _state.get_next_api_key(api_keys)
+    try:
+        data = await response.json(content_type=None)
+    except (ValueError, aiohttp.ClientError):
+        return {}
+    return data if isinstance(data, dict) else {}
 
 
-async def rotate_to_next_api_key(api_keys):
+def _stream_error_status(error):
     """
-    轮换到下一个API密钥
-    
+    流式响应事件中错误对应的状态码
+
     Args:
-        api_keys (list): API密钥列表
+        error (dict or str): 事件中的 error 字段，OpenRouter 在 error.code 中给出 HTTP 状态码
+
+    Returns:
+        int: 状态码，无法识别时按上游服务错误（502）处理
     """
-    await _state.rotate_to_next_api_key(api_keys)
+    code = error.get("code") if isinstance(error, dict) else None
+    try:
+        code = int(code)
+    except (TypeError, ValueError):
+        return 502
+    return code if 400 <= code < 600 else 502
 
 
 async def get_saved_image_info():
@@ -182,9 +328,17 @@ async def get_saved_image_info():
     return await _state.get_saved_image_info()
 
 
-async def generate_image_openrouter(prompt, api_keys, model="google/gemini-2.5-flash-image-preview:free", max_tokens=1000, input_images=None, api_base=None, max_retry_attempts=3):
+async def cancel_inflight_requests():
+    """取消所有进行中的共享生成任务（调用方都已离开的任务也会继续执行），在插件卸载时调用"""
+    await _inflight.cancel_all()
+
+
+async def generate_image_openrouter(prompt, api_keys, model="google/gemini-2.5-flash-image-preview:free", max_tokens=1000, input_images=None, api_base=None, max_retry_attempts=3, timeout=None):
     """
-    Generate image using OpenRouter API with Gemini model, supports multiple API keys with automatic rotation and retry mechanism
+    Generate image using OpenRouter API with Gemini model, supports multiple API keys with automatic rotation and retry mechanism.
+    When hedging is enabled, a slow attempt is raced against a second attempt on another key and the first image wins.
+    Concurrent calls with the same model, prompt and reference images share a single upstream request,
+    and completed results are served from a persistent content-addressed cache when it is enabled.
 
     Args:
         prompt (str): The prompt for image generation
@@ -194,249 +348,593 @@ async def generate_image_openrouter(prompt, api_keys, model="google/gemini-2.5-f
         input_images (list): List of base64 encoded input images (optional)
         api_base (str): Custom API base URL (optional, defaults to OpenRouter)
         max_retry_attempts (int): Maximum number of retry attempts per API key (default: 3)
+        timeout (float): Overall time budget in seconds shared by all keys, endpoints and retries (optional)
 
     Returns:
         tuple: (image_url, image_path) or (None, None) if failed
+
+    Raises:
+        DeadlineExceededError: The time budget ran out before an image was generated
+    """
+    image = await generate_openrouter_image(
+        prompt, api_keys, model=model, max_tokens=max_tokens, input_images=input_images,
+        api_base=api_base, max_retry_attempts=max_retry_attempts, in_memory=False, timeout=timeout,
+    )
+    if image is None:
+        return None, None
+    image_path = await image.ensure_file()
+    return image.url, image_path
+
+
+async def generate_openrouter_image(prompt, api_keys, model="google/gemini-2.5-flash-image-preview:free", max_tokens=1000, input_images=None, api_base=None, max_retry_attempts=3, in_memory=True, variant=None, timeout=None):
+    """
+    Same as generate_image_openrouter, but returns the image object so that callers can deliver it straight from memory.
+
+    Args:
+        prompt (str): The prompt for image generation
+        api_keys (list): List of OpenRouter API keys for rotation
+        model (str): Model to use
+        max_tokens (int): Maximum tokens for the response
+        input_images (list): List of base64 encoded input images (optional)
+        api_base (str): Custom API base URL (optional, defaults to OpenRouter)
+        max_retry_attempts (int): Maximum number of retry attempts per API key
+        in_memory (bool): Keep the decoded image in memory instead of writing it to the images folder;
+            call GeneratedImage.ensure_file() when a file is actually needed
+        variant (int): Variant index for batch generation; requests with different variants are
+            neither merged nor served from each other's cache entry (optional)
+        timeout (float): Overall time budget in seconds. Per-attempt timeouts are shrunk to fit it,
+            retries that cannot finish in time are skipped (optional, unlimited by default)
+
+    Returns:
+        GeneratedImage or None: The generated image, or None if failed
+
+    Raises:
+        DeadlineExceededError: The time budget ran out before an image was generated
     """
     # 兼容性处理：如果传入单个API密钥字符串，转换为列表
     if isinstance(api_keys, str):
         api_keys = [api_keys]
-    
+
+    deadline = Deadline.after(timeout)
+    generate_start = time.perf_counter()
+    fingerprint = await run_cpu_bound(request_fingerprint, prompt, model, input_images, api_base, max_tokens, variant)
+
+    # 完全相同的请求直接返回缓存的结果，不消耗额度
+    cache = get_result_cache()
+    cached_path = await cache.get(fingerprint)
+    if cached_path:
+        logger.info(f"命中生成结果缓存: {cached_path}")
+        get_metrics().observe("generate", time.perf_counter() - generate_start, model=model, outcome="cache_hit")
+        return GeneratedImage(image_format=Path(cached_path).suffix.lstrip(".") or "png", path=cached_path)
+
+    async def generate_and_cache():
+        image = await _generate_image_openrouter(
+            prompt, api_keys, model, max_tokens, input_images, api_base, max_retry_attempts, in_memory, deadline
+        )
+        if image is not None:
+            # 转码后再写入缓存，缓存命中时直接得到压缩后的图像
+            image = await _transcode_output(image)
+            if image.data is not None:
+                # 内存中的图像直接写入缓存目录，不经过images文件夹
+                await cache.put_data(fingerprint, image.data, f".{image.image_format}")
+            else:
+                await cache.put(fingerprint, image.path)
+        return image
+
+    # 相同模型、提示词和参考图片的并发请求只向上游发起一次
+    with get_metrics().timer("generate", model=model) as timer:
+        try:
+            if deadline is None:
+                image = await _inflight.do(fingerprint, generate_and_cache)
+            else:
+                # 合并到其他调用方发起的请求时，也只等待自己剩余的时间
+                image = await asyncio.wait_for(_inflight.do(fingerprint, generate_and_cache), deadline.remaining())
+        except asyncio.TimeoutError as e:
+            timer.labels["outcome"] = "timeout"
+            if isinstance(e, DeadlineExceededError) or deadline is None:
+                raise
+            raise deadline.error() from None
+        timer.labels["outcome"] = "success" if image is not None else "failed"
+    return image
+
+
+async def _transcode_output(image):
+    """
+    按输出转码设置压缩生成的图像
+
+    Args:
+        image (GeneratedImage): 生成的图像
+
+    Returns:
+        GeneratedImage: 转码后更小时返回新的图像（原图文件会被删除），否则返回原图像
+    """
+    transcoder = get_output_transcoder()
+    if not transcoder.enabled:
+        return image
+    data = image.data
+    if data is None:
+        async with aiofiles.open(image.path, "rb") as f:
+            data = await f.read()
+    result = await transcoder.transcode(data, image.image_format)
+    if result is None:
+        return image
+
+    transcoded = GeneratedImage(result[0], result[1], prefix=image.prefix)
+    if image.data is None:
+        # 原图已写入images文件夹，替换为转码后的文件
+        await transcoded.ensure_file()
+        Path(image.path).unlink(missing_ok=True)
+    return transcoded
+
+
+def request_fingerprint(prompt, model, input_images=None, api_base=None, max_tokens=None, variant=None):
+    """
+    计算图像生成请求的指纹
+
+    Args:
+        prompt (str): 图像生成提示
+        model (str): 模型名称
+        input_images (list): base64 编码的参考图片
+        api_base (str): API 地址
+        max_tokens (int): 最大 token 数
+        variant (int): 批量生成时的变体序号，不同变体的指纹不同
+
+    Returns:
+        str: 由模型、API地址、提示词、变体序号和每张参考图片的 SHA-256 组成的指纹
+    """
+    digest = hashlib.sha256()
+    for part in (model, api_base or "", str(max_tokens or ""), prompt):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    if variant is not None:
+        digest.update(f"variant:{variant}\0".encode("utf-8"))
+    for image in input_images or []:
+        digest.update(hashlib.sha256(image.encode("ascii", "ignore")).digest())
+    return digest.hexdigest()
+
+
+async def _generate_image_openrouter(prompt, api_keys, model, max_tokens, input_images, api_base, max_retry_attempts, in_memory=False, deadline=None):
+    """generate_openrouter_image 的实际实现，不做并发请求合并；时间预算用尽时抛出 DeadlineExceededError"""
+    # 同一请求在各端点、密钥和重试中的失败只在熔断器中计一次
+    request_id = get_retry_policy().on_request()
+    # 对冲预算同样按请求补充，不随端点和密钥切换重复计数
+    get_hedge_policy().on_request()
+
+    # 按延迟和错误率选择端点（custom_api_base 或 OpenRouter，以及额外配置的端点），首选端点失败时依次切换
+    routes = get_endpoint_router().candidates(model, api_base)
+    if not routes:
+        logger.error(f"没有可用于模型 {model} 的API端点（端点均处于熔断中或不提供该模型）")
+        return None
+
+    for i, route in enumerate(routes):
+        if deadline is not None and deadline.expired():
+            break
+        if i > 0:
+            logger.info(f"切换到API端点 {route.endpoint.name}")
+        image = await _generate_with_route(
+            route, prompt, route.endpoint.api_keys or api_keys, max_tokens, input_images, max_retry_attempts, in_memory,
+            deadline, request_id,
+        )
+        if image is not None:
+            return image
+
+    if deadline is not None and deadline.expired():
+        logger.error(f"图像生成的时间预算（{deadline.seconds:.0f} 秒）已用尽")
+        raise deadline.error()
+    return None
+
+
+async def _generate_with_route(route, prompt, api_keys, max_tokens, input_images, max_retry_attempts, in_memory, deadline=None, request_id=None):
+    """在一个端点上按健康度依次尝试API密钥，返回 GeneratedImage，失败时返回 None"""
     if not api_keys:
-        logger.error("未提供API密钥")
-        return None, None
+        logger.error(f"未提供API密钥（端点 {route.endpoint.name}）")
+        return None
+
+    url = route.url
+    # 请求体只构建和序列化一次，所有密钥、重试和对冲请求共用
+    build_start = time.perf_counter()
+    body = await run_cpu_bound(
+        _build_request_body, route, prompt, max_tokens, input_images, get_stream_settings().enabled
+    )
+    get_metrics().observe("payload_build", time.perf_counter() - build_start, model=route.model)
+    logger.debug(f"模型: {route.model}，接口格式: {route.api_format}，请求体大小: {len(body)} bytes")
+    logger.debug(f"输入图片数量: {len(input_images) if input_images else 0}")
+    if input_images:
+        logger.debug(f"第一张图片base64长度: {len(input_images[0])}")
+
+    # 按健康度依次选择API密钥，对每个密钥进行重试
+    scheduler = get_key_scheduler()
+    hedge_policy = get_hedge_policy()
+    retry_policy = get_retry_policy()
+    tried_keys = set()
+
+    while len(tried_keys) < len(api_keys):
+        if deadline is not None and deadline.expired():
+            logger.warning("剩余时间不足以完成一次请求，不再尝试其他API密钥")
+            break
+        if not retry_policy.would_allow(url):
+            logger.warning(f"上游端点暂时不可用（熔断中，剩余 {retry_policy.open_remaining(url):.0f} 秒），直接放弃本次请求")
+            break
+        current_api_key, current_index = await scheduler.acquire(api_keys, exclude=tried_keys)
+        if current_api_key is None:
+            logger.warning("没有可用的API密钥（其余密钥均处于冷却中）")
+            break
+        tried_keys.add(current_api_key)
+
+        tasks = {
+            asyncio.ensure_future(_try_api_key(
+                route, body, current_api_key, current_index, max_retry_attempts, in_memory, deadline, request_id
+            )): False
+        }
+        try:
+            if hedge_policy.enabled and len(tried_keys) < len(api_keys):
+                hedge_delay = hedge_policy.hedge_delay()
+                done, _ = await asyncio.wait(tasks, timeout=hedge_delay)
+                # 熔断器不会放行的对冲请求没有意义，不再发起
+                if not done and retry_policy.would_allow(url) and hedge_policy.try_acquire():
+                    hedge_key, hedge_index = await scheduler.acquire(api_keys, exclude=tried_keys)
+                    if hedge_key is not None:
+                        tried_keys.add(hedge_key)
+                        logger.info(f"API密钥 #{current_index} 超过 {hedge_delay:.1f} 秒未返回，使用API密钥 #{hedge_index} 发起对冲请求")
+                        tasks[asyncio.ensure_future(_try_api_key(
+                            route, body, hedge_key, hedge_index, max_retry_attempts, in_memory, deadline, request_id
+                        ))] = True
+
+            # 任一请求拿到结果即返回，其余请求被取消
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    try:
+                        finished, result = task.result()
+                    except Exception as e:
+                        logger.error(f"处理API密钥时发生异常: {str(e)}")
+                        continue
+                    if finished:
+                        if tasks[task]:
+                            hedge_policy.record_win()
+                            logger.info("对冲请求先于原请求完成")
+                        return result
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        if len(tried_keys) < len(api_keys):
+            logger.info(f"切换到下一个API密钥")
     
-    # 支持自定义API base，根据模型类型选择不同的端点
-    if api_base:
-        if "nano-banana" in model.lower():
-            url = f"{api_base.rstrip('/')}/v1/images/generations"
+    logger.error("所有API密钥和重试次数已耗尽")
+    return None
+
+
+# 所有请求共用的请求头，每个密钥只替换 Authorization
+_REQUEST_HEADERS = {
+    "Content-Type": "application/json",
+    "HTTP-Referer": "https://github.com/astrbot",
+    "X-Title": "AstrBot LLM Draw Plus"
+}
+
+# JSON 字符串中无需转义的字节（可打印 ASCII 中除双引号和反斜杠以外的字符）
+_JSON_SAFE_BYTES = bytes(c for c in range(0x20, 0x7f) if c not in b'"\\')
+
+
+def _build_request_body(route, prompt, max_tokens, input_images=None, stream=False):
+    """
+    构建并序列化请求体
+
+    参考图片的 base64 数据不经过 JSON 编码器：先用短占位符序列化其余部分，再把 data URI 前缀和
+    base64 字节直接拼接进去（base64 字符无需转义），省去 data URI 字符串拼接以及编码器对数 MB 字符串的扫描和复制。
+
+    Args:
+        route (EndpointRoute): 请求的端点、上游模型名和接口格式
+        prompt (str): 图像生成提示
+        max_tokens (int): 最大 token 数
+        input_images (list): base64 编码的参考图片（可带 data URI 前缀）
+        stream (bool): 是否请求流式响应，只用于 chat completions 接口
+
+    Returns:
+        bytes: JSON 请求体
+    """
+    if route.api_format == "images":
+        # nano-banana使用OpenAI图像生成格式
+        payload = {
+            "model": route.model,
+            "prompt": prompt,
+            "n": 1,
+            "size": "1024x1024"
+        }
+        return json.dumps(payload, ensure_ascii=False).encode("utf-8")
+
+    # 构建消息内容，支持输入图片
+    content = f"Generate an image: {prompt}"
+    spliced = {}
+    if input_images:
+        content = [{"type": "text", "text": content}]
+        marker = uuid.uuid4().hex
+        for i, base64_image in enumerate(input_images):
+            raw = _json_safe_bytes(base64_image)
+            if raw is None:
+                # 含有需要转义的字符，交给编码器处理
+                url = base64_image if base64_image.startswith("data:image/") else data_uri_prefix(base64_image) + base64_image
+            else:
+                url = f"@{marker}:{i}@"
+                spliced[url] = (base64_image, raw)
+            content.append({"type": "image_url", "image_url": {"url": url}})
+
+    # Gemini 图像生成构建payload
+    payload = {
+        "model": route.model,
+        "messages": [{"role": "user", "content": content}],
+        "max_tokens": max_tokens,
+        "temperature": 0.7
+    }
+    if stream:
+        payload["stream"] = True
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    if not spliced:
+        return body
+
+    parts = []
+    rest = body
+    for placeholder, (base64_image, raw) in spliced.items():
+        before, _, rest = rest.partition(placeholder.encode("ascii"))
+        parts.append(before)
+        # 确保base64数据包含与实际格式相符的data URI前缀
+        if not base64_image.startswith("data:image/"):
+            parts.append(data_uri_prefix(base64_image).encode("ascii"))
+        parts.append(raw)
+    parts.append(rest)
+    return b"".join(parts)
+
+
+def _json_safe_bytes(text):
+    """
+    Returns:
+        bytes or None: 可以原样放进 JSON 字符串的 ASCII 字节，含有需要转义的字符时返回 None
+    """
+    try:
+        raw = text.encode("ascii")
+    except UnicodeEncodeError:
+        return None
+    return None if raw.translate(None, _JSON_SAFE_BYTES) else raw
+
+
+async def _try_api_key(route, body, current_api_key, current_index, max_retry_attempts, in_memory=False, deadline=None, request_id=None):
+    """
+    使用单个API密钥发起请求，失败时按配置重试
+
+    调用前需已通过密钥调度器的 acquire 占用该密钥的第一次尝试。
+
+    Args:
+        route (EndpointRoute): 请求的端点、地址、上游模型名和接口格式
+        body (bytes): 已序列化的请求体，所有密钥和重试共用
+        current_api_key (str): 使用的API密钥
+        current_index (int): 密钥序号（从1开始，仅用于日志）
+        max_retry_attempts (int): 最大重试次数
+        in_memory (bool): 是否只在内存中保存图像
+        deadline (Deadline): 整体时间预算，每次请求的超时不超过剩余时间（可选）
+        request_id (int): RetryPolicy.on_request 返回的请求序号，用于熔断计数（可选）
+
+    Returns:
+        tuple: (finished, result)。finished 为 True 表示本次请求已有定论（result 为 GeneratedImage，
+            未找到图像时为 None），为 False 表示该密钥失败，应尝试下一个密钥
+    """
+    scheduler = get_key_scheduler()
+    retry_policy = get_retry_policy()
+    endpoint = route.endpoint
+    url = route.url
+    model = route.model
+    delay = None
+    retry_after = None
+    # 流式模式只用于 chat completions 接口
+    stream_settings = get_stream_settings()
+    streaming = stream_settings.enabled and route.api_format == "chat"
+
+    # 对当前API密钥进行多次重试
+    for retry_attempt in range(max_retry_attempts):
+        if retry_attempt > 0:
+            # 重试间隔带随机抖动，并受进程级重试预算限制
+            delay = await _retry_backoff(delay, retry_after, model=model, deadline=deadline)
+            if delay is None:
+                logger.warning(f"API密钥 #{current_index} 不再重试")
+                break
+            logger.info(f"API密钥 #{current_index} 重试 {retry_attempt + 1}/{max_retry_attempts}（已等待 {delay:.1f} 秒）")
+            if not retry_policy.allow(url):
+                logger.warning("上游端点暂时不可用（熔断中），不再重试")
+                break
+            if not await scheduler.begin(current_api_key):
+                retry_policy.record(url, None)
+                logger.warning(f"API密钥 #{current_index} 已进入冷却，不再重试")
+                break
         else:
-            url = f"{api_base.rstrip('/')}/v1/chat/completions"
-    else:
-        url = "https://openrouter.ai/api/v1/chat/completions"
-    
-    # 尝试每个API密钥，对每个密钥进行重试
-    max_api_attempts = len(api_keys)
-    
-    for api_attempt in range(max_api_attempts):
+            if not retry_policy.allow(url):
+                # 熔断拒绝不是本次请求的结论，对冲竞速中的其他请求可能仍会成功
+                await scheduler.release(current_api_key, "cancelled")
+                logger.warning(f"上游端点暂时不可用（熔断中），放弃使用API密钥 #{current_index}")
+                return False, None
+            logger.info(f"尝试使用API密钥 #{current_index}")
+
+        outcome = "error"
+        retry_after = None
+        # 上游端点是否正常响应，用于熔断判断；None 表示无法判断
+        endpoint_ok = None
+        endpoint.begin()
+        attempt_start = time.monotonic()
+        metrics = get_metrics()
         try:
-            current_api_key = await get_next_api_key(api_keys)
-            current_index = (_state.api_key_index % len(api_keys)) + 1
-            
-            # 对当前API密钥进行多次重试
-            for retry_attempt in range(max_retry_attempts):
-                try:
-                    if retry_attempt > 0:
-                        # 重试时的延迟，指数退避
-                        delay = min(2 ** retry_attempt, 10)
-                        logger.info(f"API密钥 #{current_index} 重试 {retry_attempt + 1}/{max_retry_attempts}，等待 {delay} 秒...")
-                        await asyncio.sleep(delay)
-                    else:
-                        logger.info(f"尝试使用API密钥 #{current_index}")
-                    
-                    # 构建消息内容，支持输入图片
-                    message_content = []
-                    
-                    # 添加文本内容
-                    message_content.append({
-                        "type": "text",
-                        "text": f"Generate an image: {prompt}"
-                    })
-                    
-                    # 如果有输入图片，添加到消息中
-                    if input_images:
-                        for base64_image in input_images:
-                            # 确保base64数据包含正确的data URI格式
-                            if not base64_image.startswith('data:image/'):
-                                # 假设是PNG格式，添加data URI前缀
-                                base64_image = f"data:image/png;base64,{base64_image}"
-                            
-                            message_content.append({
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": base64_image
-                                }
-                            })
-
-                    # 根据模型类型构建不同的payload
-                    if "nano-banana" in model.lower():
-                        # nano-banana使用OpenAI图像生成格式
-                        payload = {
-                            "model": model,
-                            "prompt": prompt,
-                            "n": 1,
-                            "size": "1024x1024"
-                        }
-                    else:
-                        # Gemini 图像生成构建payload
-                        payload = {
-                            "model": model,
-                            "messages": [
-                                {
-                                    "role": "user",
-                                    "content": message_content if len(message_content) > 1 else f"Generate an image: {prompt}"
-                                }
-                            ],
-                            "max_tokens": max_tokens,
-                            "temperature": 0.7
-                        }
-
-                    headers = {
-                        "Authorization": f"Bearer {current_api_key}",
-                        "Content-Type": "application/json",
-                        "HTTP-Referer": "https://github.com/astrbot",
-                        "X-Title": "AstrBot LLM Draw Plus"
-                    }
-
-                    # 调试输出：打印请求结构
-                    if retry_attempt == 0:  # 只在第一次尝试时打印调试信息
-                        logger.debug(f"模型: {model}")
-                        logger.debug(f"输入图片数量: {len(input_images) if input_images else 0}")
-                        if input_images:
-                            logger.debug(f"第一张图片base64长度: {len(input_images[0])}")
-                        logger.debug(f"消息内容结构: {type(payload['messages'][0]['content'])}")
-                        if isinstance(payload['messages'][0]['content'], list):
-                            content_types = [item.get('type', 'unknown') for item in payload['messages'][0]['content']]
-                            logger.debug(f"消息内容类型: {content_types}")
-
-                    timeout = aiohttp.ClientTimeout(total=60)
-                    async with aiohttp.ClientSession(timeout=timeout) as session:
-                        async with session.post(url, json=payload, headers=headers) as response:
-                            data = await response.json()
-                            
-                            if retry_attempt == 0:  # 只在第一次尝试时打印详细调试信息
-                                logger.debug(f"API响应状态: {response.status}")
-                                logger.debug(f"响应数据键: {list(data.keys()) if isinstance(data, dict) else 'Not dict'}")
-
-                            if response.status == 200:
-                                # 处理OpenAI格式的图像生成响应 (nano-banana等)
-                                if "data" in data and data["data"]:
-                                    logger.info(f"收到 {len(data['data'])} 个图像")
-                                    
-                                    for i, image_item in enumerate(data["data"]):
-                                        if "url" in image_item:
-                                            # 直接URL格式
-                                            image_url = image_item["url"]
-                                            
-                                            # 下载图像并保存
-                                            async with session.get(image_url) as img_response:
-                                                if img_response.status == 200:
-                                                    # 生成唯一文件名
-                                                    script_dir = Path(__file__).parent.parent
-                                                    images_dir = script_dir / "images"
-                                                    images_dir.mkdir(exist_ok=True)
-                                                    
-                                                    # 先清理旧图像
-                                                    await cleanup_old_images(script_dir)
-                                                    
-                                                    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                                                    unique_id = str(uuid.uuid4())[:8]
-                                                    image_path = images_dir / f"openai_image_{timestamp}_{unique_id}.png"
-                                                    
-                                                    async with aiofiles.open(image_path, "wb") as f:
-                                                        await f.write(await img_response.read())
-                                                    
-                                                    # 获取绝对路径
-                                                    abs_path = str(image_path.absolute())
-                                                    file_url = f"file://{abs_path}"
-                                                    
-                                                    # 更新状态
-                                                    await _state.update_saved_image(file_url, str(image_path))
-                                                    
-                                                    logger.info(f"API密钥 #{current_index} 成功生成图像: {abs_path}")
-                                                    return file_url, str(image_path)
-                                                else:
-                                                    logger.error(f"下载图像失败: {image_url}")
-                                        
-                                        elif "b64_json" in image_item:
-                                            # Base64格式
-                                            base64_data = image_item["b64_json"]
-                                            if await save_base64_image(base64_data, "png"):
-                                                logger.info(f"API密钥 #{current_index} 成功生成图像 (base64格式)")
-                                                return await get_saved_image_info()
-                                
-                                # 处理Gemini格式的响应
-                                elif "choices" in data:
-                                    choice = data["choices"][0]
-                                    message = choice["message"]
-                                    content = message["content"]
-
-                                    # 检查 Gemini 标准的 message.images 字段
-                                    if "images" in message and message["images"]:
-                                        logger.info(f"Gemini 返回了 {len(message['images'])} 个图像")
-
-                                        for i, image_item in enumerate(message["images"]):
-                                            if "image_url" in image_item and "url" in image_item["image_url"]:
-                                                image_url = image_item["image_url"]["url"]
-
-                                                # 检查是否是 base64 格式
-                                                if image_url.startswith("data:image/"):
-                                                    try:
-                                                        # 解析 data URI: data:image/png;base64,iVBORw0KGg...
-                                                        header, base64_data = image_url.split(",", 1)
-                                                        image_format = header.split("/")[1].split(";")[0]
-
-                                                        if await save_base64_image(base64_data, image_format):
-                                                            logger.info(f"API密钥 #{current_index} 成功生成图像")
-                                                            return await get_saved_image_info()
-
-                                                    except Exception as e:
-                                                        logger.warning(f"解析图像 {i+1} 失败: {e}")
-                                                        continue
-
-                                    # 如果没有找到标准images字段，尝试在content中查找
-                                    elif isinstance(content, str):
-                                        # 查找内联的 base64 图像数据
-                                        base64_pattern = r"data:image/([^;]+);base64,([A-Za-z0-9+/=]+)"
-                                        matches = re.findall(base64_pattern, content)
-
-                                        if matches:
-                                            image_format, base64_string = matches[0]
-                                            if await save_base64_image(base64_string, image_format):
-                                                logger.info(f"API密钥 #{current_index} 成功生成图像")
-                                                return await get_saved_image_info()
-
-                                logger.info("API调用成功，但未找到图像数据")
-                                # 这种情况也算成功，不需要重试
-                                return None, None
+            headers = dict(_REQUEST_HEADERS, Authorization=f"Bearer {current_api_key}")
+
+            # 单次请求的超时不超过整体时间预算的剩余时间
+            total_timeout = None if streaming else 60
+            if deadline is not None:
+                total_timeout = deadline.cap(total_timeout)
+            timeout = stream_settings.client_timeout(total_timeout) if streaming else aiohttp.ClientTimeout(total=total_timeout)
+            session = await get_http_session()
+            request_start = time.perf_counter()
+            stream_start = time.monotonic()
+            async with session.post(url, data=body, headers=headers, timeout=timeout) as response:
+                metrics.observe(
+                    "upstream_ttfb", time.perf_counter() - request_start,
+                    key=current_index, model=model, endpoint=endpoint.name, outcome=response.status,
+                )
+                status = response.status
+                endpoint_ok = status < 500
+                if status == 200:
+                    # 流式解析响应体：图像数据边接收边解码，不再整体载入内存
+                    sse_reader = None
+                    if streaming and response.content_type == "text/event-stream":
+                        sse_reader = SSEChunkReader(response, stream_settings, stream_start)
+                    image, data = await _stream_image_response(response, in_memory=in_memory, model=model, sse_reader=sse_reader)
+                    if sse_reader is not None and sse_reader.first_token_latency is not None:
+                        metrics.observe("upstream_first_token", sse_reader.first_token_latency, model=model, endpoint=endpoint.name)
+
+                    if retry_attempt == 0:  # 只在第一次尝试时打印详细调试信息
+                        logger.debug(f"API响应状态: {response.status}")
+                        logger.debug(f"响应数据键: {list(data.keys()) if isinstance(data, dict) else 'Not dict'}")
+
+                    if image is None and sse_reader is not None and isinstance(data, dict) and data.get("error"):
+                        # 流式响应已经返回200，上游出错时错误信息在事件流中，按其中的错误码与 HTTP 错误同样分类处理
+                        status = _stream_error_status(data["error"])
+                        endpoint_ok = status < 500
+                        logger.debug(f"流式响应中返回错误 (HTTP {status})")
+
+                if status == 200:
+                    outcome = "success"
+                    get_hedge_policy().record_latency(time.monotonic() - attempt_start)
+                    if image is not None:
+                        logger.info(f"API密钥 #{current_index} 成功生成图像")
+                        return True, image
+
+                    # 处理OpenAI格式中以URL返回的图像 (nano-banana等)
+                    if isinstance(data, dict) and data.get("data"):
+                        logger.info(f"收到 {len(data['data'])} 个图像")
+
+                        for image_item in data["data"]:
+                            if "url" in image_item:
+                                image_url = image_item["url"]
+
+                                # 下载图像并保存
+                                download_timeout = aiohttp.ClientTimeout(total=deadline.cap(60) if deadline is not None else 60)
+                                async with session.get(image_url, timeout=download_timeout) as img_response:
+                                    if img_response.status == 200:
+                                        if in_memory:
+                                            image_data = await img_response.read()
+                                            image = GeneratedImage(image_data, sniff_image_format(image_data) or "png", prefix="openai_image")
+                                            logger.info(f"API密钥 #{current_index} 成功生成图像")
+                                            return True, image
+
+                                        image_path = await _new_image_path("openai_image", "png")
+                                        image_size = 0
+                                        async with aiofiles.open(image_path, "wb") as f:
+                                            async for chunk in img_response.content.iter_chunked(STREAM_CHUNK_SIZE):
+                                                await f.write(chunk)
+                                                image_size += len(chunk)
+
+                                        await _register_saved_image(image_path, image_size)
+                                        logger.info(f"API密钥 #{current_index} 成功生成图像: {image_path.absolute()}")
+                                        return True, GeneratedImage(image_format="png", path=image_path, prefix="openai_image")
+                                    else:
+                                        logger.error(f"下载图像失败: {image_url}")
+
+                    logger.info("API调用成功，但未找到图像数据")
+                    # 这种情况也算成功，不需要重试
+                    return True, None
+
+                if response.status != 200:
+                    data = await _read_error_json(response)
+                    if retry_attempt == 0:  # 只在第一次尝试时打印详细调试信息
+                        logger.debug(f"API响应状态: {response.status}")
+
+                error = data.get("error")
+                error_msg = error.get("message", f"HTTP {status}") if isinstance(error, dict) else error or f"HTTP {status}"
+                status_class = classify_status(status, data)
+                if status_class in (RATE_LIMITED, EXHAUSTED):
+                    # 额度耗尽或速率限制，让该密钥进入冷却并直接尝试下一个密钥，不进行重试
+                    outcome = status_class
+                    retry_after = parse_retry_after(response.headers, data)
+                    logger.warning(f"API密钥 #{current_index} 额度耗尽或速率限制: {error_msg}")
+                    break  # 跳出重试循环，尝试下一个API密钥
+                elif status_class == NEXT_KEY:
+                    # 密钥无效或无权限，重试没有意义，让该密钥进入较长的冷却
+                    outcome = "key_invalid"
+                    logger.warning(f"API密钥 #{current_index} 不可用 (HTTP {status}): {error_msg}")
+                    break  # 跳出重试循环，尝试下一个API密钥
+                elif status_class == FATAL:
+                    # 请求本身有问题（参数错误、模型不存在等），换密钥也不会成功，也不计为密钥的失败
+                    outcome = "rejected"
+                    logger.error(f"OpenRouter API 拒绝了请求 (HTTP {status})，不再重试: {error_msg}")
+                    if "error" in data:
+                        logger.debug(f"完整错误信息: {data['error']}")
+                    return True, None
+                else:
+                    # 临时性错误，可以重试
+                    retry_after = parse_retry_after(response.headers, data)
+                    logger.warning(f"OpenRouter API 错误 (重试 {retry_attempt + 1}/{max_retry_attempts}): {error_msg}")
+                    if "error" in data:
+                        logger.debug(f"完整错误信息: {data['error']}")
 
-                            elif response.status == 429 or (response.status == 402 and "insufficient" in str(data).lower()):
-                                # 额度耗尽或速率限制，直接尝试下一个密钥，不进行重试
-                                error_msg = data.get("error", {}).get("message", f"HTTP {response.status}")
-                                logger.warning(f"API密钥 #{current_index} 额度耗尽或速率限制: {error_msg}")
-                                break  # 跳出重试循环，尝试下一个API密钥
-                            else:
-                                # 其他错误，可以重试
-                                error_msg = data.get("error", {}).get("message", f"HTTP {response.status}")
-                                logger.warning(f"OpenRouter API 错误 (重试 {retry_attempt + 1}/{max_retry_attempts}): {error_msg}")
-                                if "error" in data:
-                                    logger.debug(f"完整错误信息: {data['error']}")
-                                
-                                if retry_attempt == max_retry_attempts - 1:
-                                    logger.error(f"API密钥 #{current_index} 达到最大重试次数")
-                                    break  # 跳出重试循环，尝试下一个API密钥
-
-                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
-                    logger.warning(f"网络请求失败 (密钥 #{current_index}, 重试 {retry_attempt + 1}/{max_retry_attempts}): {str(e)}")
-                    if retry_attempt == max_retry_attempts - 1:
-                        logger.error(f"API密钥 #{current_index} 网络连接达到最大重试次数")
-                        break  # 跳出重试循环，尝试下一个API密钥
-                except Exception as e:
-                    logger.error(f"调用 OpenRouter API 时发生异常 (密钥 #{current_index}, 重试 {retry_attempt + 1}/{max_retry_attempts}): {str(e)}")
                     if retry_attempt == max_retry_attempts - 1:
-                        logger.error(f"API密钥 #{current_index} 异常达到最大重试次数")
+                        logger.error(f"API密钥 #{current_index} 达到最大重试次数")
                         break  # 跳出重试循环，尝试下一个API密钥
-        
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if deadline is not None and deadline.remaining() < 1:
+                # 被整体时间预算截断的请求不计入端点和密钥的失败统计
+                outcome = "cancelled"
+                endpoint_ok = None
+                logger.warning(f"时间预算已用尽，放弃API密钥 #{current_index} 的请求")
+                break
+            endpoint_ok = False
+            logger.warning(f"网络请求失败 (密钥 #{current_index}, 重试 {retry_attempt + 1}/{max_retry_attempts}): {str(e)}")
+            if retry_attempt == max_retry_attempts - 1:
+                logger.error(f"API密钥 #{current_index} 网络连接达到最大重试次数")
+                break  # 跳出重试循环，尝试下一个API密钥
         except Exception as e:
-            logger.error(f"处理API密钥 #{current_index} 时发生异常: {str(e)}")
-        
-        # 尝试下一个API密钥
-        if api_attempt < max_api_attempts - 1:
-            await rotate_to_next_api_key(api_keys)
-            logger.info(f"切换到下一个API密钥")
-    
-    logger.error("所有API密钥和重试次数已耗尽")
-    return None, None
+            logger.error(f"调用 OpenRouter API 时发生异常 (密钥 #{current_index}, 重试 {retry_attempt + 1}/{max_retry_attempts}): {str(e)}")
+            if retry_attempt == max_retry_attempts - 1:
+                logger.error(f"API密钥 #{current_index} 异常达到最大重试次数")
+                break  # 跳出重试循环，尝试下一个API密钥
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+            endpoint_ok = None
+            raise
+        finally:
+            metrics.observe(
+                "upstream_attempt", time.monotonic() - attempt_start,
+                key=current_index, model=model, endpoint=endpoint.name, outcome=outcome,
+            )
+            retry_policy.record(url, endpoint_ok, request_id)
+            endpoint.record(endpoint_ok, time.monotonic() - attempt_start if outcome == "success" else None)
+            await scheduler.release(current_api_key, outcome, time.monotonic() - attempt_start, retry_after)
+
+    return False, None
+
+
+async def _retry_backoff(previous_delay, retry_after=None, model=None, deadline=None):
+    """
+    消耗一次重试预算，并按去相关抖动计算的间隔等待
+
+    Args:
+        previous_delay (float): 上一次的等待时间，第一次重试时为 None
+        retry_after (float): 上游要求的等待时间（可选）
+        model (str): 模型名称，仅用于统计
+        deadline (Deadline): 整体时间预算（可选）
+
+    Returns:
+        float or None: 实际等待的秒数；重试预算不足或等待后来不及完成请求时不等待，返回 None
+    """
+    retry_policy = get_retry_policy()
+    delay = retry_policy.next_delay(previous_delay, retry_after)
+    if deadline is not None and not deadline.can_fit(delay):
+        logger.warning(f"剩余时间（{deadline.remaining():.0f} 秒）不足以完成一次重试")
+        return None
+    if not retry_policy.try_acquire_retry():
+        logger.warning("重试预算已用尽")
+        return None
+    get_metrics().observe("retry_backoff", delay, model=model)
+    await asyncio.sleep(delay)
+    return delay
 
 
 async def generate_image(prompt, api_key, model="stabilityai/stable-diffusion-3-5-large", seed=None, image_size="1024x1024"):
@@ -471,53 +969,68 @@ async def generate_image(prompt, api_key, model="stabilityai/stable-diffusion-3-
 
     max_retries = 10  # 最大重试次数
     retry_count = 0
+    delay = None
+    retry_policy = get_retry_policy()
+    request_id = retry_policy.on_request()
     
     timeout = aiohttp.ClientTimeout(total=60)
-    async with aiohttp.ClientSession(timeout=timeout) as session:
-        while retry_count < max_retries:
-            try:
-                async with session.post(url, json=payload, headers=headers) as response:
-                    data = await response.json()
-
-                    if data.get("code") == 50603:
-                        logger.warning("系统繁忙，1秒后重试")
-                        await asyncio.sleep(1)
-                        retry_count += 1
-                        continue
-
-                    if "images" in data:
-                        for image in data["images"]:
-                            image_url = image["url"]
-                            async with session.get(image_url) as img_response:
-                                if img_response.status == 200:
-                                    # 生成唯一文件名
-                                    script_dir = Path(__file__).parent.parent
-                                    images_dir = script_dir / "images"
-                                    images_dir.mkdir(exist_ok=True)
+    session = await get_http_session()
+    while retry_count < max_retries:
+        if retry_count > 0:
+            # 重试间隔带随机抖动且有上限，并受进程级重试预算限制
+            delay = await _retry_backoff(delay, model=model)
+            if delay is None:
+                logger.error("不再重试，生成失败")
+                return None, None
+        if not retry_policy.allow(url):
+            logger.error("SiliconFlow 端点暂时不可用（熔断中），生成失败")
+            return None, None
+        endpoint_ok = None
+        try:
+            async with session.post(url, json=payload, headers=headers, timeout=timeout) as response:
+                endpoint_ok = response.status < 500
+                data = await response.json()
+
+                if data.get("code") == 50603:
+                    endpoint_ok = False
+                    logger.warning(f"系统繁忙，稍后重试 ({retry_count + 1}/{max_retries})")
+                    retry_count += 1
+                    continue
+
+                if "images" in data:
+                    for image in data["images"]:
+                        image_url = image["url"]
+                        async with session.get(image_url, timeout=timeout) as img_response:
+                            if img_response.status == 200:
+                                # 生成唯一文件名
+                                script_dir = Path(__file__).parent.parent
+                                images_dir = script_dir / "images"
+                                images_dir.mkdir(exist_ok=True)
                                     
-                                    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                                    unique_id = str(uuid.uuid4())[:8]
-                                    image_path = images_dir / f"siliconflow_image_{timestamp}_{unique_id}.jpeg"
+                                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+                                unique_id = str(uuid.uuid4())[:8]
+                                image_path = images_dir / f"siliconflow_image_{timestamp}_{unique_id}.jpeg"
                                     
-                                    async with aiofiles.open(image_path, "wb") as f:
-                                        await f.write(await img_response.read())
+                                image_data = await img_response.read()
+                                async with aiofiles.open(image_path, "wb") as f:
+                                    await f.write(image_data)
+                                track_image(image_path, len(image_data))
                                     
-                                    logger.info(f"图像已下载: {image_url} -> {image_path}")
-                                    return image_url, str(image_path)
-                                else:
-                                    logger.error(f"下载图像失败: {image_url}")
-                                    return None, None
-                    else:
-                        logger.warning("响应中未找到图像")
-                        return None, None
-                        
-            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
-                logger.error(f"网络请求失败 (重试 {retry_count + 1}/{max_retries}): {e}")
-                retry_count += 1
-                if retry_count < max_retries:
-                    await asyncio.sleep(2 ** retry_count)  # 指数退避
+                                logger.info(f"图像已下载: {image_url} -> {image_path}")
+                                return image_url, str(image_path)
+                            else:
+                                logger.error(f"下载图像失败: {image_url}")
+                                return None, None
                 else:
+                    logger.warning("响应中未找到图像")
                     return None, None
+                        
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            endpoint_ok = False
+            logger.error(f"网络请求失败 (重试 {retry_count + 1}/{max_retries}): {e}")
+            retry_count += 1
+        finally:
+            retry_policy.record(url, endpoint_ok, request_id)
                     
     logger.error(f"达到最大重试次数 ({max_retries})，生成失败")
     return None, None
@@ -0,0 +1,171 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from astrbot.api import logger
+
+
+class WorkerPools:
+    """
+    插件共享的后台线程池和进程池
+
+    线程池用于图片编解码等CPU密集型工作，避免阻塞事件循环；
+    进程池用于耗时较长的图片编码，不与事件循环所在进程争抢GIL。
+    """
+    def __init__(self):
+        self.max_workers = min(4, os.cpu_count() or 1)
+        self.process_workers = min(2, os.cpu_count() or 1)
+        self._cpu_executor = None
+        self._process_executor = None
+        # 进程池不可用（平台不支持或工作进程异常退出）时改用线程池
+        self._process_disabled = False
+
+    def configure(self, max_workers=None, process_workers=None):
+        """更新线程池和进程池大小，已创建的池不受影响，关闭后重新创建时生效"""
+        if max_workers is not None:
+            self.max_workers = max(1, int(max_workers))
+        if process_workers is not None:
+            self.process_workers = max(0, int(process_workers))
+            self._process_disabled = self.process_workers == 0
+
+    def cpu_executor(self):
+        if self._cpu_executor is None:
+            self._cpu_executor = ThreadPoolExecutor(
+                max_workers=self.max_workers,
+                thread_name_prefix="gemini-image-cpu",
+            )
+        return self._cpu_executor
+
+    def process_executor(self):
+        """
+        Returns:
+            ProcessPoolExecutor or None: 进程池，不可用时返回 None
+        """
+        if self._process_disabled:
+            return None
+        if self._process_executor is None:
+            try:
+                self._process_executor = ProcessPoolExecutor(max_workers=self.process_workers)
+            except (OSError, NotImplementedError, ValueError) as e:
+                logger.warning(f"无法创建进程池，改用线程池: {e}")
+                self._process_disabled = True
+                return None
+        return self._process_executor
+
+    def disable_processes(self, reason):
+        """进程池出现故障时关闭进程池，之后的任务改在线程池中执行"""
+        logger.warning(f"进程池不可用，改用线程池: {reason}")
+        self._process_disabled = True
+        if self._process_executor is not None:
+            self._process_executor.shutdown(wait=False, cancel_futures=True)
+            self._process_executor = None
+
+    def shutdown(self):
+        if self._cpu_executor is not None:
+            self._cpu_executor.shutdown(wait=False, cancel_futures=True)
+            self._cpu_executor = None
+        if self._process_executor is not None:
+            self._process_executor.shutdown(wait=False, cancel_futures=True)
+            self._process_executor = None
+
+
+class LoopLagProbe:
+    """
+    测量事件循环的调度延迟
+
+    以固定间隔休眠并记录实际唤醒时间与预期的差值，差值越大说明事件循环被同步代码阻塞得越久。
+
+    用法:
+        async with LoopLagProbe() as probe:
+            ...
+        probe.max_lag
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    @property
+    def max_lag(self):
+        return max(self.samples, default=0.0)
+
+    def percentile(self, percent):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - start - self.interval))
+
+    async def __aenter__(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        # 让测量任务先运行一次
+        await asyncio.sleep(0)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        return False
+
+
+# 全局线程池实例
+_pools = WorkerPools()
+
+
+def configure_workers(**kwargs):
+    """
+    配置后台线程池
+
+    Args:
+        **kwargs: max_workers / process_workers
+    """
+    _pools.configure(**kwargs)
+
+
+async def run_cpu_bound(func, *args):
+    """
+    在共享线程池中执行CPU密集型函数
+
+    Args:
+        func (Callable): 要执行的函数
+        *args: 函数参数
+
+    Returns:
+        Any: 函数返回值
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_pools.cpu_executor(), func, *args)
+
+
+async def run_in_process(func, *args):
+    """
+    在共享进程池中执行CPU密集型函数，进程池不可用时退回到线程池
+
+    函数和参数需要可以被 pickle（模块级函数、bytes 等）。
+
+    Args:
+        func (Callable): 要执行的函数
+        *args: 函数参数
+
+    Returns:
+        Any: 函数返回值
+    """
+    executor = _pools.process_executor()
+    if executor is not None:
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(executor, func, *args)
+        except BrokenProcessPool as e:
+            _pools.disable_processes(e)
+    return await run_cpu_bound(func, *args)
+
+
+def shutdown_workers():
+    """关闭后台线程池和进程池，在插件卸载时调用"""
+    _pools.shutdown()